@@ -3,3 +3,9 @@ from storages.backends.s3boto3 import S3Boto3Storage
 
 class TINETUserFilesStorage(S3Boto3Storage):
     bucket_name = 'tinetuserfiles'
+
+
+class TINETAuditArchiveStorage(S3Boto3Storage):
+    bucket_name = 'tinetauditarchive'
+    # Segments and manifests are rewritten under the same name
+    file_overwrite = True
@@ -1,3 +1,143 @@
-from django.test import TestCase
+import asyncio
+import json
+from contextlib import contextmanager
+from django.core.cache import cache
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections
+from django.test import RequestFactory, TestCase, override_settings
 
-# Create your tests here.
+from leaderboards.models import Leaderboard, LeaderboardEntry
+from tinetbackend import asgi, wsgi
+from tinetbackend.routing import TokenAPIWSGIHandler, is_token_api_path
+from users.models import AppAPIKey, TINETUser, digest_secret
+
+
+class TokenAPIRoutingTests(TestCase):
+
+    def test_only_token_routes_take_the_lean_handler(self):
+        self.assertTrue(is_token_api_path('/api/v1/user/calc/auth'))
+        self.assertTrue(is_token_api_path('/api/v1/leaderboards/3'))
+        self.assertFalse(is_token_api_path('/api/v1/user/info'))
+        self.assertFalse(is_token_api_path('/dashboard/'))
+
+    def test_lean_handler_skips_browser_middleware(self):
+        statuses = []
+        handler = TokenAPIWSGIHandler()
+        response = handler(
+            RequestFactory().get('/api/v1/apps/jwks.json').environ,
+            lambda status, headers: statuses.append((status, dict(headers)))
+        )
+        self.assertEqual(b''.join(response), b'{"keys": []}')
+        status, headers = statuses[0]
+        self.assertEqual(status, '200 OK')
+        self.assertNotIn('X-Frame-Options', headers)
+        self.assertNotIn('Set-Cookie', headers)
+
+    @override_settings(CORS_ALLOWED_ORIGINS=['https://game.example.com'])
+    def test_lean_handler_answers_cors_preflight(self):
+        statuses = []
+        handler = TokenAPIWSGIHandler()
+        handler(
+            RequestFactory().options(
+                '/api/v1/leaderboards/increment',
+                HTTP_ORIGIN='https://game.example.com',
+                HTTP_ACCESS_CONTROL_REQUEST_METHOD='POST'
+            ).environ,
+            lambda status, headers: statuses.append((status, dict(headers)))
+        )
+        status, headers = statuses[0]
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['access-control-allow-origin'], 'https://game.example.com')
+
+
+@contextmanager
+def keep_test_connection():
+    # The handlers close the database connection around every request like
+    # in production, which would take the test transaction with it.
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    try:
+        yield
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
+
+
+@override_settings(AUDIT_LOG_FLUSH_INTERVAL=0)
+class TokenAPIEntryPointTests(TestCase):
+    """Token routes sent through the WSGI and ASGI applications the servers load."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = TINETUser.objects.create(username='player', password='testpass')
+        self.calc_key = self.user.set_calc_key()
+        self.user.save()
+        self.app = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        self.leaderboard = Leaderboard.objects.create(title='Test board', app=self.app)
+
+    def wsgi_post(self, path, data, **headers):
+        statuses = []
+        environ = RequestFactory().post(path, json.dumps(data), content_type='application/json', **headers).environ
+        with keep_test_connection():
+            response = wsgi.application(environ, lambda status, response_headers: statuses.append(status))
+            body = b''.join(response)
+            response.close()
+        return statuses[0], json.loads(body)
+
+    async def asgi_request(self, method, path, body=b'', headers=(), chunks=1):
+        """Returns the response start message and the first chunks body messages, then disconnects."""
+        messages = []
+        done = asyncio.Event()
+
+        async def receive():
+            if not messages:
+                messages.append(None)
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+            if len(messages) > chunks + 1:
+                done.set()
+
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'testserver'), *headers], 'client': ('10.0.0.1', 5000), 'server': ('testserver', 80),
+        }
+        with keep_test_connection():
+            await asyncio.wait_for(asgi.application(scope, receive, send), timeout=5)
+        return messages[1], messages[2:]
+
+    def test_calc_auth_through_wsgi(self):
+        status, body = self.wsgi_post('/api/v1/user/calc/auth', {'username': 'player', 'calc_key': self.calc_key})
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body['username'], 'player')
+
+    def test_leaderboard_write_through_wsgi(self):
+        status, body = self.wsgi_post(
+            '/api/v1/leaderboards/increment',
+            {'leaderboard_id': self.leaderboard.id, 'username': 'player', 'count': 5},
+            HTTP_API_KEY='gamekey123'
+        )
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body['score'], 5)
+        self.assertEqual(LeaderboardEntry.objects.get().score, 5)
+
+    async def test_leaderboard_write_through_asgi(self):
+        start, body = await self.asgi_request(
+            'POST', '/api/v1/leaderboards/increment',
+            json.dumps({'leaderboard_id': self.leaderboard.id, 'username': 'player', 'count': 5}).encode(),
+            headers=[(b'content-type', b'application/json'), (b'api-key', b'gamekey123')]
+        )
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(json.loads(body[0]['body'])['score'], 5)
+
+    async def test_event_stream_through_asgi(self):
+        start, body = await self.asgi_request(
+            'GET', f'/api/v1/leaderboards/{self.leaderboard.id}/events', headers=[(b'api-key', b'gamekey123')]
+        )
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'Content-Type', b'text/event-stream'), start['headers'])
+        self.assertEqual(body[0]['body'], b'retry: 3000\n\n')
@@ -0,0 +1,8 @@
+from django.urls import include, path
+
+from API.urls import token_urlpatterns
+
+# URLconf of the token API handler, which only serves these routes
+urlpatterns = [
+    path("api/", include(token_urlpatterns)),
+]
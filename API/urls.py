@@ -1,26 +1,44 @@
 from django.urls import path
 from django.views.decorators.csrf import csrf_exempt
 
+from tinetbackend.ratelimit import rate_limit
 from . import views
 
+# Routes authenticated by app keys or calc session tokens only, served through the
+# minimal TOKEN_API_MIDDLEWARE chain as well, see tinetbackend.routing
+token_urlpatterns = [
+    path("v1/user/calc/auth", csrf_exempt(rate_limit('calc_auth', failures_only=('user',))(views.CalcAuthView.as_view())), name="api_user_calc_auth"),
+    path("v1/user/calc/login", csrf_exempt(rate_limit('calc_auth', failures_only=('user',))(views.CalcAppLoginView.as_view())), name="api_user_calc_login"),
+    path("v1/user/sessions/auth", csrf_exempt(rate_limit('session_check')(views.SessionAuthView.as_view())), name="api_user_sessions_auth"),
+    path("v1/apps/jwks.json", views.AppTokenKeysView.as_view(), name="api_apps_jwks"),
+    path("v1/apps/revoked-grants", views.AppRevokedGrantsView.as_view(), name="api_apps_revoked_grants"),
+    path("v1/user/sessions/validity-check", csrf_exempt(rate_limit('session_check')(views.CalcSessionsValidityCheck.as_view())), name="api_user_sessions_validity_check"),
+    path("v1/user/sessions/validity-check/batch", csrf_exempt(rate_limit('session_check')(views.SessionBatchValidityView.as_view())), name="api_user_sessions_validity_check_batch"),
+    path("v1/leaderboards/increment", csrf_exempt(rate_limit('leaderboard_write')(views.LeaderboardIncrementScoreView.as_view())), name="api_leaderboards_increment"),
+    path("v1/leaderboards/decrement", csrf_exempt(rate_limit('leaderboard_write')(views.LeaderboardDecrementScoreView.as_view())), name="api_leaderboards_decrement"),
+    path("v1/leaderboards/set", csrf_exempt(rate_limit('leaderboard_write')(views.LeaderboardSetScoreView.as_view())), name="api_leaderboards_set"),
+    path("v1/leaderboards/delete", csrf_exempt(rate_limit('leaderboard_write')(views.LeaderboardDeleteScoreView.as_view())), name="api_leaderboards_delete"),
+    path("v1/leaderboards/batch", csrf_exempt(rate_limit('leaderboard_write')(views.LeaderboardBatchView.as_view())), name="api_leaderboards_batch"),
+    path("v1/leaderboards/rank", csrf_exempt(views.LeaderboardRankView.as_view()), name="api_leaderboards_rank"),
+    path("v1/leaderboards/around", csrf_exempt(views.LeaderboardAroundView.as_view()), name="api_leaderboards_around"),
+    path("v1/leaderboards/window", views.LeaderboardWindowView.as_view(), name="api_leaderboards_window"),
+    path("v1/leaderboards/<int:leaderboard_id>/events", views.LeaderboardEventsView.as_view(), name="api_leaderboards_events"),
+    path("v1/leaderboards/<int:leaderboard_id>", views.LeaderboardSnapshotView.as_view(), name="api_leaderboards_snapshot"),
+    # TODO: add API routes to create/delete leaderboards
+]
+
 urlpatterns = [
     path("v1", views.RootView.as_view(), name="api_root"),
     path("v1/user/info", csrf_exempt(views.UserInfoView.as_view()), name="api_user_info"),
+    path("v1/user/audit", views.UserAuditLogView.as_view(), name="api_user_audit"),
     path("v1/user/edit/bio", csrf_exempt(views.EditBioView.as_view()), name="api_user_edit_bio"),
     path("v1/user/keyfile/download", views.DownloadKeyFileView.as_view(), name="api_user_keyfile_download"),
     path("v1/user/apikey/new", views.NewApiKeyView.as_view(), name="api_user_apikey_new"),
     path("v1/user/sessions/expireallweb", views.ExpireUserWebSessionsView.as_view(), name="api_user_sessions_expireall"),
-    path("v1/user/calc/auth", csrf_exempt(views.CalcAuthView.as_view()), name="api_user_calc_auth"),
-    path("v1/user/sessions/auth", csrf_exempt(views.SessionAuthView.as_view()), name="api_user_sessions_auth"),
-    path("v1/user/sessions/validity-check", csrf_exempt(views.CalcSessionsValidityCheck.as_view()), name="api_user_sessions_validity_check"),
     path("v1/user/sessions/expireallcalc", views.ExpireAllCalcSessionTokensView.as_view(), name="api_user_sessions_expire_all"),
     path("v1/user/files/upload", csrf_exempt(views.FileUploadView.as_view()), name="api_user_files_upload"),
     path("v1/user/files/list", csrf_exempt(views.FileListView.as_view()), name="api_user_files_list"),
     path("v1/user/files/delete", csrf_exempt(views.FileDeleteView.as_view()), name="api_user_files_delete"),
     path("v1/user/files/download", csrf_exempt(views.FileDownloadView.as_view()), name="api_user_files_download"),
-    path("v1/leaderboards/increment", csrf_exempt(views.LeaderboardIncrementScoreView.as_view()), name="api_leaderboards_increment"),
-    path("v1/leaderboards/decrement", csrf_exempt(views.LeaderboardDecrementScoreView.as_view()), name="api_leaderboards_decrement"),
-    path("v1/leaderboards/set", csrf_exempt(views.LeaderboardSetScoreView.as_view()), name="api_leaderboards_set"),
-    path("v1/leaderboards/delete", csrf_exempt(views.LeaderboardDeleteScoreView.as_view()), name="api_leaderboards_delete"),
-    # TODO: add API routes to create/delete leaderboards
-]
+    path("v1/leaderboards/buffer/metrics", views.LeaderboardBufferMetricsView.as_view(), name="api_leaderboards_buffer_metrics"),
+] + token_urlpatterns
@@ -1,24 +1,38 @@
 import json
 import os
-import random
-import string
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.sessions.models import Session
-from django.http import JsonResponse, HttpResponse
+from django.db import transaction
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django.views import View
 from django.utils.decorators import method_decorator
 from functools import wraps
 import time
 import io
+import datetime
 from django.views.decorators.csrf import csrf_exempt
 from tivars.types import TIAppVar
 from tivars.var import TIHeader
 from tivars.models import TI_84PCE
 
 from API.storages import TINETUserFilesStorage
-from leaderboards.models import LeaderboardEntry, Leaderboard
-from users.models import SessionToken, AuditEntry, AppAPIKey, AllowedApp, AllowedAppAuditEntry, TINETUser
+from leaderboards.live import get_hub
+from leaderboards.buffer import add_buffered_scores, discard_buffered_scores, merge_buffered_scores, buffer_metrics
+from leaderboards.models import LeaderboardEntry, Leaderboard, LeaderboardWindowEntry
+from leaderboards.ranking import get_ranking_backend
+from leaderboards.snapshots import get_version, get_snapshot
+from leaderboards.windows import record_window_scores, remove_window_scores, top_window_entries, bucket_for, bucket_label
+from users.app_tokens import app_tokens_enabled, issue_app_token, jwks, revoked_grants
+from users.audit import audit_history, record_app_audit_entry, record_audit_entry
+from users.calc_sessions import INVALID, VALID, SessionExpired, check_session_token, check_session_tokens, expire_all_sessions, issue_session_token
+from users.janitor import get_janitor
+from users.models import SessionToken, AppAPIKey, AllowedApp, TINETUser
 
 User = get_user_model()
 
@@ -43,20 +57,6 @@ def new_ti_app_var_stream(username, key):
     return kf_stream
 
 
-def generate_api_key():
-    apikey = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(70))
-    return apikey
-
-
-def generate_calc_key():
-    token = ''.join(random.choice(
-        string.ascii_lowercase +
-        string.ascii_uppercase +
-        string.digits
-    ) for _ in range(50))
-    return token
-
-
 def get_client_ip(request):
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
     if x_forwarded_for:
@@ -72,7 +72,7 @@ def api_auth_required(view_func):
         api_key = request.headers.get('Api-Key')
         if api_key:
             try:
-                user = User.objects.get(api_key=api_key)
+                user = User.objects.get_by_api_key(api_key)
                 request.user = user
             except User.DoesNotExist:
                 return JsonResponse({'success': False, 'message': 'Invalid API key'}, status=401)
@@ -94,13 +94,23 @@ def api_auth_required(view_func):
     return wrapped_view
 
 
+def get_request_app(request):
+    """Returns the AppAPIKey sent in the Api-Key header and records that it was used."""
+    app_api_key_obj = AppAPIKey.objects.get_by_key(request.headers.get('Api-Key'))
+    # Lapsed keys are expired by the janitor, started by the first app request of the process
+    get_janitor().ensure_started()
+    if app_api_key_obj.is_valid():
+        app_api_key_obj.mark_as_used()
+    return app_api_key_obj
+
+
 def log_audit_entry(request, user, message):
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
     if x_forwarded_for:
         ip = x_forwarded_for.split(',')[0]
     else:
         ip = request.META.get('REMOTE_ADDR')
-    AuditEntry.objects.create(action=message, ip=ip, username=user.username)
+    record_audit_entry(message, ip, user.username)
 
 
 def log_app_audit_entry(request, user, message, app):
@@ -109,7 +119,17 @@ def log_app_audit_entry(request, user, message, app):
         ip = x_forwarded_for.split(',')[0]
     else:
         ip = request.META.get('REMOTE_ADDR')
-    AllowedAppAuditEntry.objects.create(action=message, ip=ip, username=user.username, allowed_app=app)
+    record_app_audit_entry(message, ip, user.username, app.allow_id)
+
+
+def user_profile(user):
+    return {
+        'username': user.username,
+        'email': user.email,
+        'bio': user.bio,
+        'date_joined': user.date_joined,
+        'last_login': user.last_login
+    }
 
 
 class RootView(View):
@@ -145,6 +165,26 @@ class UserInfoView(View):
         return response
 
 
+class UserAuditLogView(View):
+    MAX_LIMIT = 100
+
+    @method_decorator(api_auth_required)
+    def get(self, request):
+        try:
+            limit = min(max(int(request.GET.get('limit', 50)), 1), UserAuditLogView.MAX_LIMIT)
+            entries, next_cursor = audit_history(request.user.username, request.GET.get('cursor'), limit)
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid cursor or limit'}, status=400)
+        return JsonResponse({
+            'success': True,
+            'events': [
+                {'action': entry.action, 'ip': entry.ip, 'created_at': entry.created_at and entry.created_at.isoformat()}
+                for entry in entries
+            ],
+            'next_cursor': next_cursor
+        }, status=200)
+
+
 class ExpireUserWebSessionsView(View):
     @staticmethod
     def post(request):
@@ -167,9 +207,8 @@ class DownloadKeyFileView(View):
     def get(request):
         user = request.user
         if user.is_authenticated:
-            new_token = generate_calc_key()
-            user.calc_key = new_token
-            user.save()
+            new_token = user.set_calc_key()
+            user.save(update_fields=['calc_key_prefix', 'calc_key_digest'])
             kf_stream = new_ti_app_var_stream(user.username.encode(), new_token.encode())
             response = HttpResponse(kf_stream, content_type='application/octet-stream')
             response['Content-Disposition'] = 'attachment; filename="NetKey.8xv"'
@@ -183,9 +222,8 @@ class NewApiKeyView(View):
     def get(request):
         user = request.user
         if user.is_authenticated:
-            new_apikey = generate_api_key()
-            user.api_key = new_apikey
-            user.save()
+            new_apikey = user.set_api_key()
+            user.save(update_fields=['api_key_prefix', 'api_key_digest'])
             response_data = {
                 'api_key': new_apikey
             }
@@ -201,15 +239,16 @@ class CalcAuthView(View):
             data = json.loads(request.body)
             username = data.get('username')
             calc_key = data.get('calc_key')
-            user = User.objects.get(username=username, calc_key=calc_key)
+            user = User.objects.get_by_calc_key(calc_key)
+            if user.username != username:
+                raise User.DoesNotExist
             if user is not None:
-                session_token = SessionToken.create_token(user)
-                request.session['session_token'] = session_token.token
+                token = issue_session_token(user)
                 log_audit_entry(request, user, "requested a new session token")
                 return JsonResponse({
                     'auth_success': True,
                     'username': user.username,
-                    'session_token': session_token.token
+                    'session_token': token
                 }, status=200)
             else:
                 return JsonResponse({
@@ -223,43 +262,84 @@ class CalcAuthView(View):
             }, status=500)
 
 
+class CalcAppLoginView(View):
+    """Calc login and app session auth in one request, for calculators on slow links."""
+
+    @staticmethod
+    def post(request):
+        try:
+            data = json.loads(request.body)
+            app_api_key_obj = get_request_app(request)
+            user = User.objects.get_by_calc_key(data.get('calc_key'))
+            if user.username != data.get('username'):
+                raise User.DoesNotExist
+
+            token = issue_session_token(user)
+            log_audit_entry(request, user, "requested a new session token")
+            allowed_app = AllowedApp.objects.get_grant(user.id, app_api_key_obj.id)
+            if not allowed_app:
+                return JsonResponse({
+                    'auth_success': False,
+                    'session_token': token,
+                    'error': 'User has not granted access to the app',
+                    'grant_url': f'https://tinet.tkbstudios.com/oauth/request?appid={app_api_key_obj.id}'
+                }, status=403)
+
+            log_app_audit_entry(request, user, "Authenticated using calc key", allowed_app)
+            return JsonResponse({
+                'auth_success': True,
+                'session_token': token,
+                **user_profile(user)
+            }, status=200)
+
+        except User.DoesNotExist:
+            return JsonResponse({
+                'auth_success': False,
+                'error': 'User not found or invalid credentials'
+            }, status=404)
+        except AppAPIKey.DoesNotExist:
+            return JsonResponse({
+                'auth_success': False,
+                'error': 'Invalid App API Key'
+            }, status=401)
+        except Exception:
+            return JsonResponse({
+                'auth_success': False,
+                'error': 'Unexpected Error, are you sure all fields are correct?'
+            }, status=500)
+
+
 class SessionAuthView(View):
     @staticmethod
     def post(request):
         try:
             data = json.loads(request.body)
-            app_api_key = request.headers.get('Api-Key')
-            app_api_key_obj = AppAPIKey.objects.get(key=app_api_key)
-            if app_api_key_obj.is_valid():
-                app_api_key_obj.mark_as_used()
+            app_api_key_obj = get_request_app(request)
 
             session_token = data.get('session_token')
-            session_token_obj = SessionToken.objects.get(token=session_token)
-            if session_token_obj.is_valid():
-                allowed_app = AllowedApp.objects.filter(user=session_token_obj.user, app=app_api_key_obj).first()
-                if allowed_app:
-                    log_app_audit_entry(request, request.user, "Authenticated using session token", app_api_key_obj)
-                    user = session_token_obj.user
-                    return_json = {
-                        'username': user.username,
-                        'email': user.email,
-                        'bio': user.bio,
-                        'date_joined': user.date_joined,
-                        'last_login': user.last_login
-                    }
-                    return JsonResponse(return_json, status=200)
-                else:
-                    return JsonResponse({
-                        'auth_success': False,
-                        'error': 'User has not granted access to the app',
-                        'grant_url': f'https://tinet.tkbstudios.com/oauth/request?appid={app_api_key_obj.id}'
-                    }, status=403)
+            user_id, _ = check_session_token(session_token)
+            user = User.objects.get(id=user_id)
+            allowed_app = AllowedApp.objects.get_grant(user.id, app_api_key_obj.id)
+            if allowed_app:
+                log_app_audit_entry(request, user, "Authenticated using session token", allowed_app)
+                return_json = user_profile(user)
+                if data.get('issue_token') and app_tokens_enabled():
+                    return_json['access_token'] = issue_app_token(user, allowed_app)
+                    return_json['token_type'] = 'Bearer'
+                    return_json['expires_in'] = settings.APP_TOKEN_LIFETIME
+                return JsonResponse(return_json, status=200)
             else:
                 return JsonResponse({
                     'auth_success': False,
-                    'error': 'Session token expired'
-                }, status=401)
-        except SessionToken.DoesNotExist:
+                    'error': 'User has not granted access to the app',
+                    'grant_url': f'https://tinet.tkbstudios.com/oauth/request?appid={app_api_key_obj.id}'
+                }, status=403)
+        except SessionExpired:
+            return JsonResponse({
+                'auth_success': False,
+                'error': 'Session token expired'
+            }, status=401)
+        except (SessionToken.DoesNotExist, User.DoesNotExist):
             return JsonResponse({
                 'auth_success': False,
                 'error': 'Invalid session token'
@@ -276,6 +356,35 @@ class SessionAuthView(View):
             }, status=500)
 
 
+class AppTokenKeysView(View):
+    @staticmethod
+    def get(request):
+        response = JsonResponse(jwks(), status=200)
+        response['Cache-Control'] = f'public, max-age={settings.APP_TOKEN_LIFETIME}'
+        return response
+
+
+class AppRevokedGrantsView(View):
+    @staticmethod
+    def get(request):
+        try:
+            app_api_key_obj = get_request_app(request)
+            return JsonResponse({
+                'success': True,
+                'max_age': settings.APP_TOKEN_LIFETIME,
+                'revoked': revoked_grants(app_api_key_obj.id)
+            }, status=200)
+        except AppAPIKey.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Invalid App API Key'
+            }, status=401)
+        except Exception:
+            return JsonResponse({
+                'success': False
+            }, status=500)
+
+
 class CalcSessionsValidityCheck(View):
     @staticmethod
     def post(request):
@@ -283,19 +392,19 @@ class CalcSessionsValidityCheck(View):
             data = json.loads(request.body)
             username = data.get('username')
             session_token = data.get('session_token')
-            user = User.objects.get(username=username)
-            session_token_obj = SessionToken.objects.get(user=user, token=session_token)
-            if session_token_obj.is_valid():
-                return_json = {
-                    "success": True,
-                    "valid": True
-                }
-                return JsonResponse(return_json, status=200)
-            else:
-                return JsonResponse({
-                    'auth_success': False,
-                    'error': 'Session token expired'
-                }, status=401)
+            _, token_username = check_session_token(session_token)
+            if token_username != username:
+                raise SessionToken.DoesNotExist
+            return_json = {
+                "success": True,
+                "valid": True
+            }
+            return JsonResponse(return_json, status=200)
+        except SessionExpired:
+            return JsonResponse({
+                'auth_success': False,
+                'error': 'Session token expired'
+            }, status=401)
         except SessionToken.DoesNotExist:
             return JsonResponse({
                 'auth_success': False,
@@ -309,6 +418,63 @@ class CalcSessionsValidityCheck(View):
             }, status=500)
 
 
+class SessionBatchValidityView(View):
+    MAX_SESSIONS = 500
+
+    @staticmethod
+    def post(request):
+        try:
+            data = json.loads(request.body)
+            app_api_key_obj = get_request_app(request)
+
+            sessions = data.get('sessions')
+            if not isinstance(sessions, list) or len(sessions) > SessionBatchValidityView.MAX_SESSIONS:
+                return JsonResponse({
+                    'success': False,
+                    'error': f'sessions must be a list of at most {SessionBatchValidityView.MAX_SESSIONS} entries'
+                }, status=400)
+            pairs = []
+            for session in sessions:
+                if not isinstance(session, dict) or not isinstance(session.get('username'), str) \
+                        or not isinstance(session.get('session_token'), str):
+                    return JsonResponse({
+                        'success': False,
+                        'error': 'Each session needs a username and a session_token'
+                    }, status=400)
+                pairs.append((session['username'], session['session_token']))
+
+            checked = check_session_tokens([token for _, token in pairs])
+            valid_user_ids = {user_id for status, user_id, _ in checked.values() if status == VALID}
+            granted_user_ids = set(AllowedApp.objects.filter(
+                app=app_api_key_obj,
+                user_id__in=valid_user_ids
+            ).values_list('user_id', flat=True))
+
+            # One result per entry in request order, as usernames may repeat with different tokens
+            results = []
+            for username, token in pairs:
+                status, user_id, token_username = checked[token]
+                if token_username != username:
+                    status = INVALID
+                elif status == VALID and user_id not in granted_user_ids:
+                    status = 'not_granted'
+                results.append({'username': username, 'status': status})
+            return JsonResponse({
+                'success': True,
+                'results': results
+            }, status=200)
+
+        except AppAPIKey.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Invalid App API Key'
+            }, status=401)
+        except Exception:
+            return JsonResponse({
+                'success': False
+            }, status=500)
+
+
 class ExpireAllCalcSessionTokensView(View):
     @staticmethod
     def post(request):
@@ -318,7 +484,7 @@ class ExpireAllCalcSessionTokensView(View):
                 "error": "not authenticated"
             }, status=401)
         try:
-            SessionToken.objects.filter(user=request.user).update(expired=True)
+            expire_all_sessions(request.user)
             return JsonResponse({
                 'success': True,
                 'message': f"All tokens associated with user {request.user} have been expired."
@@ -501,10 +667,7 @@ class LeaderboardIncrementScoreView(View):
     def post(request):
         try:
             data = json.loads(request.body)
-            app_api_key = request.headers.get('Api-Key')
-            app_api_key_obj = AppAPIKey.objects.get(key=app_api_key)
-            if app_api_key_obj.is_valid():
-                app_api_key_obj.mark_as_used()
+            app_api_key_obj = get_request_app(request)
 
             leaderboard_id = data['leaderboard_id']
             leaderboard_obj = Leaderboard.objects.get(id=leaderboard_id)
@@ -519,22 +682,21 @@ class LeaderboardIncrementScoreView(View):
             user_obj = TINETUser.objects.get(username=username)
             count = data['count']
 
-            entry, created = LeaderboardEntry.objects.get_or_create(
-                user=user_obj,
-                leaderboard=leaderboard_obj,
-                defaults={
-                    'score': count
-                }
-            )
-
-            if not created:
-                entry.score += count
-                entry.save()
+            if leaderboard_obj.write_behind:
+                entry_key = (user_obj.id, leaderboard_obj.id)
+                score = add_buffered_scores({entry_key: count})[entry_key]
+            else:
+                with transaction.atomic():
+                    score = LeaderboardEntry.objects.add_score(user_obj.id, leaderboard_obj.id, count)
+                    record_window_scores(
+                        {leaderboard_obj.id: leaderboard_obj},
+                        {(user_obj.id, leaderboard_obj.id): count}
+                    )
 
             return JsonResponse({
                 'success': True,
-                'message': 'Leaderboard entry updated successfully' if not created else 'Leaderboard entry created successfully',
-                'score': entry.score
+                'message': 'Leaderboard entry updated successfully',
+                'score': score
             }, status=200)
 
         except AppAPIKey.DoesNotExist:
@@ -553,10 +715,7 @@ class LeaderboardDecrementScoreView(View):
     def post(request):
         try:
             data = json.loads(request.body)
-            app_api_key = request.headers.get('Api-Key')
-            app_api_key_obj = AppAPIKey.objects.get(key=app_api_key)
-            if app_api_key_obj.is_valid():
-                app_api_key_obj.mark_as_used()
+            app_api_key_obj = get_request_app(request)
 
             leaderboard_id = data['leaderboard_id']
             leaderboard_obj = Leaderboard.objects.get(id=leaderboard_id)
@@ -571,22 +730,21 @@ class LeaderboardDecrementScoreView(View):
             user_obj = TINETUser.objects.get(username=username)
             count = data['count']
 
-            entry, created = LeaderboardEntry.objects.get_or_create(
-                user=user_obj,
-                leaderboard=leaderboard_obj,
-                defaults={
-                    'score': count
-                }
-            )
-
-            if not created:
-                entry.score -= count
-                entry.save()
+            if leaderboard_obj.write_behind:
+                entry_key = (user_obj.id, leaderboard_obj.id)
+                score = add_buffered_scores({entry_key: -count})[entry_key]
+            else:
+                with transaction.atomic():
+                    score = LeaderboardEntry.objects.add_score(user_obj.id, leaderboard_obj.id, -count)
+                    record_window_scores(
+                        {leaderboard_obj.id: leaderboard_obj},
+                        {(user_obj.id, leaderboard_obj.id): -count}
+                    )
 
             return JsonResponse({
                 'success': True,
-                'message': 'Leaderboard entry updated successfully' if not created else 'Leaderboard entry created successfully',
-                'score': entry.score
+                'message': 'Leaderboard entry updated successfully',
+                'score': score
             }, status=200)
 
         except AppAPIKey.DoesNotExist:
@@ -605,10 +763,7 @@ class LeaderboardSetScoreView(View):
     def post(request):
         try:
             data = json.loads(request.body)
-            app_api_key = request.headers.get('Api-Key')
-            app_api_key_obj = AppAPIKey.objects.get(key=app_api_key)
-            if app_api_key_obj.is_valid():
-                app_api_key_obj.mark_as_used()
+            app_api_key_obj = get_request_app(request)
 
             leaderboard_id = data['leaderboard_id']
             leaderboard_obj = Leaderboard.objects.get(id=leaderboard_id)
@@ -623,22 +778,20 @@ class LeaderboardSetScoreView(View):
             user_obj = TINETUser.objects.get(username=username)
             count = data['count']
 
-            entry, created = LeaderboardEntry.objects.get_or_create(
-                user=user_obj,
-                leaderboard=leaderboard_obj,
-                defaults={
-                    'score': count
-                }
-            )
-
-            if not created:
-                entry.score -= count
-                entry.save()
+            entry_key = (user_obj.id, leaderboard_obj.id)
+            with transaction.atomic():
+                # The windows only get the difference to the previous all-time score
+                previous = LeaderboardEntry.objects.get_scores([entry_key], for_update=True).get(entry_key, 0)
+                if leaderboard_obj.write_behind:
+                    previous = merge_buffered_scores({entry_key: previous})[entry_key]
+                    discard_buffered_scores([entry_key])
+                score = LeaderboardEntry.objects.set_score(user_obj.id, leaderboard_obj.id, count)
+                record_window_scores({leaderboard_obj.id: leaderboard_obj}, {entry_key: count - previous})
 
             return JsonResponse({
                 'success': True,
-                'message': 'Leaderboard entry updated successfully' if not created else 'Leaderboard entry created successfully',
-                'score': entry.score
+                'message': 'Leaderboard entry updated successfully',
+                'score': score
             }, status=200)
 
         except AppAPIKey.DoesNotExist:
@@ -657,10 +810,7 @@ class LeaderboardDeleteScoreView(View):
     def delete(request):
         try:
             data = json.loads(request.body)
-            app_api_key = request.headers.get('Api-Key')
-            app_api_key_obj = AppAPIKey.objects.get(key=app_api_key)
-            if app_api_key_obj.is_valid():
-                app_api_key_obj.mark_as_used()
+            app_api_key_obj = get_request_app(request)
 
             leaderboard_id = data['leaderboard_id']
             leaderboard_obj = Leaderboard.objects.get(id=leaderboard_id)
@@ -674,19 +824,389 @@ class LeaderboardDeleteScoreView(View):
             username = data['username']
             user_obj = TINETUser.objects.get(username=username)
 
-            try:
-                entry = LeaderboardEntry.objects.get(user=user_obj, leaderboard=leaderboard_obj)
-                entry.delete()
+            if leaderboard_obj.write_behind:
+                discard_buffered_scores([(user_obj.id, leaderboard_obj.id)], windows=True)
+            remove_window_scores(leaderboard_obj, user_obj.id)
+            if LeaderboardEntry.objects.remove_score(user_obj.id, leaderboard_obj.id):
                 return JsonResponse({
                     'success': True,
                     'message': 'Leaderboard entry deleted successfully'
                 }, status=200)
-            except LeaderboardEntry.DoesNotExist:
+            else:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Leaderboard entry does not exist for the given username'
+                }, status=404)
+
+        except AppAPIKey.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Invalid App API Key'
+            }, status=401)
+        except Exception:
+            return JsonResponse({
+                'success': False
+            }, status=500)
+
+
+class LeaderboardBatchView(View):
+    MAX_OPERATIONS = 500
+    OPERATIONS = {'increment', 'decrement', 'set'}
+
+    @staticmethod
+    def post(request):
+        try:
+            data = json.loads(request.body)
+            app_api_key_obj = get_request_app(request)
+
+            operations = data['operations']
+            if not isinstance(operations, list) or not operations:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'operations must be a non-empty list'
+                }, status=400)
+            if len(operations) > LeaderboardBatchView.MAX_OPERATIONS:
+                return JsonResponse({
+                    'success': False,
+                    'error': f'Too many operations, the maximum is {LeaderboardBatchView.MAX_OPERATIONS}'
+                }, status=400)
+
+            leaderboard_ids = set()
+            usernames = set()
+            for operation in operations:
+                if isinstance(operation, dict):
+                    if isinstance(operation.get('leaderboard_id'), int):
+                        leaderboard_ids.add(operation['leaderboard_id'])
+                    if isinstance(operation.get('username'), str):
+                        usernames.add(operation['username'])
+            app_leaderboards = {
+                leaderboard.id: leaderboard
+                for leaderboard in Leaderboard.objects.filter(id__in=leaderboard_ids, app=app_api_key_obj)
+            }
+            user_ids = dict(TINETUser.objects.filter(username__in=usernames).values_list('username', 'id'))
+
+            # Fold the operations per entry in submission order so each entry is written
+            # by exactly one upsert: either a pure delta or an absolute score.
+            results = []
+            pending = {}
+            for operation in operations:
+                error = None
+                if not isinstance(operation, dict):
+                    error = 'Invalid operation'
+                elif operation.get('op') not in LeaderboardBatchView.OPERATIONS:
+                    error = 'Unknown op, expected increment, decrement or set'
+                elif not isinstance(operation.get('count'), int) or isinstance(operation.get('count'), bool):
+                    error = 'count must be an integer'
+                elif not isinstance(operation.get('leaderboard_id'), int) \
+                        or operation['leaderboard_id'] not in app_leaderboards:
+                    error = 'Leaderboard does not exist or does not match the App API Key'
+                elif not isinstance(operation.get('username'), str) or operation['username'] not in user_ids:
+                    error = 'User does not exist'
+                if error:
+                    results.append({'success': False, 'error': error})
+                    continue
+
+                entry_key = (user_ids[operation['username']], operation['leaderboard_id'])
+                mode, value = pending.get(entry_key, ('add', 0))
+                if operation['op'] == 'set':
+                    mode, value = 'set', operation['count']
+                elif operation['op'] == 'increment':
+                    value += operation['count']
+                else:
+                    value -= operation['count']
+                pending[entry_key] = (mode, value)
+                results.append(entry_key)
+
+            buffered = {entry_key for entry_key in pending if app_leaderboards[entry_key[1]].write_behind}
+            direct_deltas = {
+                entry_key: value for entry_key, (mode, value) in pending.items()
+                if mode == 'add' and entry_key not in buffered
+            }
+            absolute_scores = {entry_key: value for entry_key, (mode, value) in pending.items() if mode == 'set'}
+            with transaction.atomic():
+                # The windows only get the difference between a set and the previous all-time score
+                previous = LeaderboardEntry.objects.get_scores(absolute_scores.keys(), for_update=True)
+                buffered_sets = [entry_key for entry_key in absolute_scores if entry_key in buffered]
+                if buffered_sets:
+                    previous.update(merge_buffered_scores({
+                        entry_key: previous.get(entry_key, 0) for entry_key in buffered_sets
+                    }))
+                    discard_buffered_scores(buffered_sets)
+                scores = LeaderboardEntry.objects.bulk_add_scores(direct_deltas)
+                scores.update(LeaderboardEntry.objects.bulk_set_scores(absolute_scores))
+                record_window_scores(app_leaderboards, {
+                    **direct_deltas,
+                    **{entry_key: score - previous.get(entry_key, 0) for entry_key, score in absolute_scores.items()}
+                })
+            scores.update(add_buffered_scores({
+                entry_key: value for entry_key, (mode, value) in pending.items()
+                if mode == 'add' and entry_key in buffered
+            }))
+
+            # Applied operations report the score of their entry once the whole batch is in.
+            return JsonResponse({
+                'success': True,
+                'results': [
+                    result if isinstance(result, dict) else {'success': True, 'score': scores[result]}
+                    for result in results
+                ]
+            }, status=200)
+
+        except AppAPIKey.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Invalid App API Key'
+            }, status=401)
+        except Exception:
+            return JsonResponse({
+                'success': False
+            }, status=500)
+
+
+class LeaderboardRankView(View):
+    @staticmethod
+    def get(request):
+        try:
+            app_api_key_obj = get_request_app(request)
+
+            leaderboard_id = int(request.GET['leaderboard_id'])
+            leaderboard_obj = Leaderboard.objects.get(id=leaderboard_id)
+
+            if leaderboard_obj.app != app_api_key_obj:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Leaderboard does not match the App API Key'
+                }, status=403)
+
+            user_obj = TINETUser.objects.get(username=request.GET['username'])
+            ranking = get_ranking_backend()
+            rank = ranking.rank(leaderboard_obj.id, user_obj.id)
+            if rank is None:
                 return JsonResponse({
                     'success': False,
                     'error': 'Leaderboard entry does not exist for the given username'
                 }, status=404)
 
+            score = rank[1]
+            if leaderboard_obj.write_behind:
+                entry_key = (user_obj.id, leaderboard_obj.id)
+                score = merge_buffered_scores({entry_key: score})[entry_key]
+
+            return JsonResponse({
+                'success': True,
+                'rank': rank[0],
+                'score': score,
+                'total': ranking.count(leaderboard_obj.id)
+            }, status=200)
+
+        except AppAPIKey.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Invalid App API Key'
+            }, status=401)
+        except Exception:
+            return JsonResponse({
+                'success': False
+            }, status=500)
+
+
+class LeaderboardAroundView(View):
+    MAX_RADIUS = 10
+
+    @staticmethod
+    def get(request):
+        try:
+            app_api_key_obj = get_request_app(request)
+
+            leaderboard_id = int(request.GET['leaderboard_id'])
+            leaderboard_obj = Leaderboard.objects.get(id=leaderboard_id)
+
+            if leaderboard_obj.app != app_api_key_obj:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Leaderboard does not match the App API Key'
+                }, status=403)
+
+            user_obj = TINETUser.objects.get(username=request.GET['username'])
+            radius = min(max(int(request.GET.get('radius', 2)), 0), LeaderboardAroundView.MAX_RADIUS)
+            ranking = get_ranking_backend()
+            neighbourhood = ranking.around(leaderboard_obj.id, user_obj.id, radius)
+            if not neighbourhood:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Leaderboard entry does not exist for the given username'
+                }, status=404)
+
+            user_ids = [user_id for _, user_id, _ in neighbourhood]
+            usernames = dict(TINETUser.objects.filter(id__in=user_ids).values_list('id', 'username'))
+            scores = {(user_id, leaderboard_obj.id): score for _, user_id, score in neighbourhood}
+            if leaderboard_obj.write_behind:
+                scores = merge_buffered_scores(scores)
+            return JsonResponse({
+                'success': True,
+                'total': ranking.count(leaderboard_obj.id),
+                'entries': [
+                    {'rank': rank, 'username': usernames.get(user_id), 'score': scores[(user_id, leaderboard_obj.id)]}
+                    for rank, user_id, _ in neighbourhood
+                ]
+            }, status=200)
+
+        except AppAPIKey.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Invalid App API Key'
+            }, status=401)
+        except Exception:
+            return JsonResponse({
+                'success': False
+            }, status=500)
+
+
+class LeaderboardBufferMetricsView(View):
+    @staticmethod
+    def get(request):
+        if not request.user.is_staff:
+            return JsonResponse({
+                'success': False,
+                'error': 'Permission denied'
+            }, status=403)
+        return JsonResponse({
+            'success': True,
+            'buffer': buffer_metrics()
+        }, status=200)
+
+
+class LeaderboardSnapshotView(View):
+    @staticmethod
+    def get(request, leaderboard_id):
+        try:
+            app_api_key_obj = get_request_app(request)
+
+            leaderboard_obj = Leaderboard.objects.get(id=leaderboard_id)
+
+            if leaderboard_obj.app_id != app_api_key_obj.id:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Leaderboard does not match the App API Key'
+                }, status=403)
+
+            version, modified = get_version(leaderboard_obj.id)
+            etag = f'"{leaderboard_obj.id}-{version}"'
+            response = get_conditional_response(request, etag=etag, last_modified=int(modified))
+            if response is None:
+                response = HttpResponse(get_snapshot(leaderboard_obj, version), content_type='application/json')
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(modified)
+            response['Cache-Control'] = 'no-cache'
+            return response
+
+        except AppAPIKey.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Invalid App API Key'
+            }, status=401)
+        except Leaderboard.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Leaderboard does not exist'
+            }, status=404)
+        except Exception:
+            return JsonResponse({
+                'success': False
+            }, status=500)
+
+
+class LeaderboardEventsView(View):
+    async def get(self, request, leaderboard_id):
+        # Every open stream holds its connection, only the ASGI app can serve them.
+        if not isinstance(request, ASGIRequest):
+            return JsonResponse({
+                'success': False,
+                'error': 'Live updates are only available through the ASGI server'
+            }, status=503)
+        try:
+            app_api_key_obj = await sync_to_async(get_request_app)(request)
+
+            leaderboard_obj = await Leaderboard.objects.aget(id=leaderboard_id)
+
+            if leaderboard_obj.app_id != app_api_key_obj.id:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Leaderboard does not match the App API Key'
+                }, status=403)
+
+            hub = get_hub()
+            client = hub.subscribe(leaderboard_obj.id)
+            response = StreamingHttpResponse(client.stream(hub, leaderboard_obj.id), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        except AppAPIKey.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Invalid App API Key'
+            }, status=401)
+        except Leaderboard.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Leaderboard does not exist'
+            }, status=404)
+        except Exception:
+            return JsonResponse({
+                'success': False
+            }, status=500)
+
+
+class LeaderboardWindowView(View):
+    MAX_ENTRIES = 100
+
+    @staticmethod
+    def get(request):
+        try:
+            app_api_key_obj = get_request_app(request)
+
+            leaderboard_id = int(request.GET['leaderboard_id'])
+            leaderboard_obj = Leaderboard.objects.get(id=leaderboard_id)
+
+            if leaderboard_obj.app_id != app_api_key_obj.id:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Leaderboard does not match the App API Key'
+                }, status=403)
+
+            window = request.GET.get('window')
+            tracked = {
+                LeaderboardWindowEntry.DAILY: leaderboard_obj.track_daily,
+                LeaderboardWindowEntry.WEEKLY: leaderboard_obj.track_weekly,
+                LeaderboardWindowEntry.SEASON: leaderboard_obj.track_season,
+            }
+            if not tracked.get(window):
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Leaderboard does not track this window'
+                }, status=400)
+
+            bucket = request.GET.get('bucket')
+            if bucket is None:
+                bucket = bucket_for(leaderboard_obj, window)
+            elif window == LeaderboardWindowEntry.SEASON:
+                bucket = int(bucket)
+            else:
+                bucket = bucket_for(leaderboard_obj, window, datetime.date.fromisoformat(bucket))
+            count = min(max(int(request.GET.get('count', 10)), 1), LeaderboardWindowView.MAX_ENTRIES)
+
+            entries = top_window_entries(leaderboard_obj, window, bucket, count)
+            return JsonResponse({
+                'success': True,
+                'window': window,
+                'bucket': bucket_label(window, bucket),
+                'entries': [
+                    {'rank': rank, 'username': entry.user.username, 'score': entry.score}
+                    for rank, entry in enumerate(entries, start=1)
+                ]
+            }, status=200)
+
         except AppAPIKey.DoesNotExist:
             return JsonResponse({
                 'success': False,
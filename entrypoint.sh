@@ -70,4 +70,4 @@ echo "Update completed"
 
 ## Run stuff
 echo "Starting server"
-gunicorn -c gunicorn.conf.py tinetbackend.wsgi:application
+gunicorn -c gunicorn.conf.py tinetbackend.asgi:application
@@ -1,3 +1,36 @@
-from django.test import TestCase
+from unittest import mock
+from allauth.socialaccount.models import SocialAccount
+from django.test import TestCase, override_settings
+from leaderboards.models import Leaderboard, LeaderboardEntry
+from users.models import TINETUser
+from .views import LeaderboardsView
 
-# Create your tests here.
+
+@override_settings(AUDIT_LOG_FLUSH_INTERVAL=0)
+class LeaderboardsViewTests(TestCase):
+
+    def setUp(self):
+        self.viewer = TINETUser.objects.create_user(username='viewer', password='testpass')
+        SocialAccount.objects.create(user=self.viewer, provider='tkbstudios', uid='viewer')
+        self.client.force_login(self.viewer)
+        self.leaderboard = Leaderboard.objects.create(title='Big board')
+        self.other_leaderboard = Leaderboard.objects.create(title='Small board')
+        for i in range(8):
+            user = TINETUser.objects.create(username=f'player{i}', password='testpass')
+            LeaderboardEntry.objects.set_score(user.id, self.leaderboard.id, i * 10)
+            if i < 2:
+                LeaderboardEntry.objects.set_score(user.id, self.other_leaderboard.id, i)
+
+    def test_listing_shows_top_entries_of_every_board(self):
+        response = self.client.get('/leaderboards/')
+        boards = {board['title']: board['entries'] for board in response.context['leaderboards']}
+        self.assertEqual([entry.score for entry in boards['Big board']], [70, 60, 50, 40, 30])
+        self.assertEqual([entry.score for entry in boards['Small board']], [1, 0])
+
+    @mock.patch.object(LeaderboardsView, 'PAGE_SIZE', 3)
+    def test_detail_is_keyset_paginated(self):
+        first = self.client.get(f'/leaderboard/{self.leaderboard.id}/').context['leaderboard']
+        second = self.client.get(f'/leaderboard/{self.leaderboard.id}/?{first["next_page"]}').context['leaderboard']
+        self.assertEqual([entry.score for entry in first['entries']], [70, 60, 50])
+        self.assertEqual([entry.score for entry in second['entries']], [40, 30, 20])
+        self.assertEqual(second['start'], 4)
@@ -4,6 +4,8 @@ from django.contrib.auth import login, authenticate, logout, update_session_auth
 from django.contrib.auth.forms import PasswordChangeForm
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth import get_user_model
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
 from django.http import JsonResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse_lazy
@@ -13,10 +15,13 @@ from waffle.mixins import WaffleSwitchMixin
 from waffle.models import Flag
 
 from API.storages import TINETUserFilesStorage
-from leaderboards.models import Leaderboard
-from users.models import AuditEntry, AppAPIKey, UserWebPopUp, WebPopUp, AllowedApp
+from leaderboards.models import Leaderboard, LeaderboardEntry
+from users.audit import audit_history
+from users.popups import confirm_popup, pending_popup_id
+from users.models import AppAPIKey, WebPopUp, AllowedApp
 import waffle
 import re
+from urllib.parse import urlencode
 
 
 class FlagCheckMixin:
@@ -48,20 +53,17 @@ class ShowPopupView(LoginRequiredMixin, View):
     template_name = 'popup.html'
 
     def get(self, request):
-        user = request.user
-        user_popup = UserWebPopUp.objects.filter(user=user, confirmed=False).first()
-        if user_popup:
-            return render(request, self.template_name, {'popup': user_popup})
+        popup_id = pending_popup_id(request)
+        if popup_id:
+            return render(request, self.template_name, {'popup': get_object_or_404(WebPopUp, id=popup_id)})
         else:
             return redirect('index')
 
     @staticmethod
     def post(request):
-        user = request.user
-        if not UserWebPopUp.objects.filter(user=user, confirmed=True).exists():
-            popup = UserWebPopUp.objects.get_or_create(user=user)[0]
-            popup.confirmed = True
-            popup.save()
+        popup_id = pending_popup_id(request)
+        if popup_id:
+            confirm_popup(request, popup_id)
         return redirect('index')
 
 
@@ -74,9 +76,13 @@ class DashboardView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         user = self.request.user
-        user_events = reversed(AuditEntry.objects.filter(username=user.username))
+        try:
+            user_events, next_cursor = audit_history(user.username, self.request.GET.get('before'))
+        except ValueError:
+            user_events, next_cursor = audit_history(user.username)
         context['user'] = user
         context['user_events'] = user_events
+        context['older_events'] = urlencode({'before': next_cursor}) if next_cursor else None
         return context
 
 
@@ -161,17 +167,19 @@ class AppAPIKeysView(LoginRequiredMixin, FlagCheckMixin, TemplateView):
         user = self.request.user
         app_api_keys = reversed(AppAPIKey.objects.filter(user=user))
         context['api_keys'] = app_api_keys
+        # Only the digest is stored, a new key is shown once right after creation
+        context['new_key'] = self.request.session.pop('new_app_api_key', None)
         return context
 
     @staticmethod
     def delete(request):
-        if request.method == 'DELETE' and 'key' in request.GET:
-            key = request.GET.get('key')
+        if request.method == 'DELETE' and 'id' in request.GET:
+            key_id = request.GET.get('id')
             try:
-                api_key = AppAPIKey.objects.get(key=key, user=request.user)
+                api_key = AppAPIKey.objects.get(id=key_id, user=request.user)
                 api_key.delete()
                 return JsonResponse({'success': True})
-            except AppAPIKey.DoesNotExist:
+            except (AppAPIKey.DoesNotExist, ValueError):
                 return JsonResponse({'success': False, 'error': 'API key not found'})
         return JsonResponse({'success': False, 'error': 'Invalid request'})
 
@@ -183,7 +191,8 @@ class AppAPIKeysView(LoginRequiredMixin, FlagCheckMixin, TemplateView):
             name = re.sub(r'[^A-Za-z0-9]', '', name)
             description = re.sub(r'[^A-Za-z0-9 .:;/]', '', description)
             if name and description:
-                api_key = AppAPIKey.create_api_key(user=request.user, name=name, description=description)
+                api_key, key = AppAPIKey.create_api_key(user=request.user, name=name, description=description)
+                request.session['new_app_api_key'] = {'id': api_key.id, 'key': key}
                 return redirect('app_api_keys')
         return redirect('app_api_keys')
 
@@ -192,30 +201,66 @@ class LeaderboardsView(LoginRequiredMixin, View):
     login_url = '/login/'
     redirect_field_name = 'redirect_to'
     success_url = reverse_lazy('leaderboards')
+    TOP_ENTRIES = 5
+    PAGE_SIZE = 50
 
     @staticmethod
     def get(request, leaderboard_id=None):
         context = {}
         if leaderboard_id:
             leaderboard = get_object_or_404(Leaderboard, id=leaderboard_id)
-            leaderboard_entries = leaderboard.leaderboardentry_set.all().order_by('-score')
+            leaderboard_entries = leaderboard.leaderboardentry_set.select_related('user').order_by('-score', 'id')
+            start = 1
+            try:
+                after_score = int(request.GET['after_score'])
+                after_id = int(request.GET['after_id'])
+                start = max(int(request.GET.get('start', 1)), 1)
+                # score__lte is redundant but bounds the scan on the (leaderboard, -score, id) index
+                leaderboard_entries = leaderboard_entries.filter(score__lte=after_score).filter(
+                    Q(score__lt=after_score) | Q(score=after_score, id__gt=after_id)
+                )
+            except (KeyError, ValueError):
+                pass
+            page = list(leaderboard_entries[:LeaderboardsView.PAGE_SIZE + 1])
+            next_page = None
+            if len(page) > LeaderboardsView.PAGE_SIZE:
+                page = page[:LeaderboardsView.PAGE_SIZE]
+                next_page = urlencode({
+                    'after_score': page[-1].score,
+                    'after_id': page[-1].id,
+                    'start': start + len(page)
+                })
             context['leaderboard'] = {
                 'id': leaderboard_id,
                 'title': leaderboard.title,
                 'description': leaderboard.description,
-                'entries': leaderboard_entries
+                'entries': page,
+                'start': start,
+                'next_page': next_page
             }
             return render(request, 'leaderboard_detail.html', context=context)
         else:
-            leaderboards_data = Leaderboard.objects.all()
+            top_entries = (
+                LeaderboardEntry.objects
+                .annotate(position=Window(
+                    RowNumber(),
+                    partition_by=[F('leaderboard_id')],
+                    order_by=[F('score').desc(), F('id').asc()]
+                ))
+                .filter(position__lte=LeaderboardsView.TOP_ENTRIES)
+                .select_related('user')
+                .order_by('leaderboard_id', 'position')
+            )
+            entries_by_leaderboard = {}
+            for entry in top_entries:
+                entries_by_leaderboard.setdefault(entry.leaderboard_id, []).append(entry)
             leaderboards = []
-            for leaderboard in leaderboards_data:
-                leaderboard_entries = leaderboard.leaderboardentry_set.all().order_by('-score')
+            for leaderboard in Leaderboard.objects.all():
                 leaderboards.append({
                     'id': leaderboard.id,
                     'title': leaderboard.title,
                     'description': leaderboard.description,
-                    'entries': leaderboard_entries
+                    'entries': entries_by_leaderboard.get(leaderboard.id, [])
                 })
             context['leaderboards'] = leaderboards
             return render(request, 'leaderboards.html', context=context)
@@ -281,7 +326,7 @@ class OAuthRequestView(LoginRequiredMixin, View):
         app_id = request.GET.get('appid')
         try:
             app_api_key = AppAPIKey.objects.get(id=app_id)
-            if AllowedApp.objects.filter(user=request.user, app=app_api_key).exists():
+            if AllowedApp.objects.get_grant(request.user.id, app_api_key.id) is not None:
                 return redirect('allowed_apps')
             context = {
                 'app_id': app_id,
@@ -306,7 +351,7 @@ class OAuthRequestView(LoginRequiredMixin, View):
                 if user is not None:
                     try:
                         app_api_key = AppAPIKey.objects.get(id=app_id)
-                        if AllowedApp.objects.filter(user=request.user, app=app_api_key).exists():
+                        if AllowedApp.objects.get_grant(request.user.id, app_api_key.id) is not None:
                             return redirect('allowed_apps')
                     except AppAPIKey.DoesNotExist:
                         return JsonResponse({
@@ -1,2 +1,4 @@
 bind = "0.0.0.0:8005"
 workers = 1
+# The ASGI worker serves the long-lived live leaderboard streams next to the regular views.
+worker_class = "uvicorn.workers.UvicornWorker"
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Leaderboard, LeaderboardEntry
+from .models import Leaderboard, LeaderboardEntry, LeaderboardWindowEntry
 
 admin.site.register(Leaderboard)
 admin.site.register(LeaderboardEntry)
+admin.site.register(LeaderboardWindowEntry)
@@ -0,0 +1,427 @@
+import datetime
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from leaderboards.models import Leaderboard, LeaderboardEntry, ScoreFlushBatch
+from leaderboards.signals import scores_buffered
+from leaderboards.windows import record_window_scores
+from tinetbackend.redis_client import get_redis, redis_errors
+from tinetbackend.workers import PeriodicWorker
+from users.models import TINETUser
+
+logger = logging.getLogger(__name__)
+
+FLUSH_CHUNK_SIZE = 1000
+# How long a committed batch is remembered, far longer than a retried flush can take
+FLUSH_BATCH_RETENTION = datetime.timedelta(days=1)
+
+_buffer = None
+_flusher = None
+_metrics = {
+    'flushes': 0,
+    'last_flush_at': None,
+    'last_flush_entries': 0,
+    'last_flush_seconds': 0.0,
+}
+
+
+def get_score_buffer():
+    """Returns the score buffer configured by LEADERBOARD_SCORE_BUFFER."""
+    global _buffer
+    if _buffer is None:
+        _buffer = import_string(settings.LEADERBOARD_SCORE_BUFFER)()
+    return _buffer
+
+
+def get_flusher():
+    global _flusher
+    if _flusher is None:
+        _flusher = PeriodicWorker(
+            'leaderboard-buffer-flusher',
+            settings.LEADERBOARD_BUFFER_FLUSH_INTERVAL,
+            flush_score_buffer
+        )
+    return _flusher
+
+
+@receiver(setting_changed)
+def reset_score_buffer(setting, **kwargs):
+    global _buffer, _flusher
+    if setting in ('LEADERBOARD_SCORE_BUFFER', 'LEADERBOARD_BUFFER_FLUSH_INTERVAL', 'REDIS_URL'):
+        _buffer = None
+        _flusher = None
+
+
+def add_buffered_scores(deltas):
+    """
+    Queues {(user_id, leaderboard_id): delta} for the flusher and returns the
+    resulting {(user_id, leaderboard_id): score}, i.e. the stored score plus
+    everything still buffered. Writes straight through if the buffer is down.
+    """
+    score_buffer = get_score_buffer()
+    try:
+        # Window deltas keep the day they were buffered on, whenever they get flushed
+        score_buffer.add_many(deltas, timezone.now().date())
+    except redis_errors() as e:
+        logger.warning('Score buffer unavailable, writing through: %s', e)
+        with transaction.atomic():
+            scores = LeaderboardEntry.objects.bulk_add_scores(deltas)
+            record_window_scores(Leaderboard.objects.in_bulk({leaderboard_id for _, leaderboard_id in deltas}), deltas)
+        return scores
+    get_flusher().ensure_started()
+    # Read once the deltas are in, a flush landing after the append then
+    # moves them from the buffer to the stored score instead of being missed.
+    stored_scores = LeaderboardEntry.objects.get_scores(deltas.keys())
+    try:
+        pending = _pending_scores(score_buffer, deltas.keys())
+    except redis_errors() as e:
+        logger.warning('Could not read buffered scores: %s', e)
+        pending = deltas
+    scores = {key: stored_scores.get(key, 0) + pending.get(key, 0) for key in deltas}
+    scores_buffered.send(sender=LeaderboardEntry, scores=scores)
+    return scores
+
+
+def discard_buffered_scores(keys, windows=False):
+    """
+    Drops buffered deltas that an absolute write or a delete supersedes. The
+    window deltas are dropped only with windows, an absolute write leaves
+    them to be flushed as it only applies its difference to the windows.
+    """
+    try:
+        get_score_buffer().discard(keys, windows)
+    except redis_errors() as e:
+        logger.warning('Could not discard buffered scores: %s', e)
+
+
+def merge_buffered_scores(scores):
+    """Takes {(user_id, leaderboard_id): stored score} and adds any buffered deltas."""
+    try:
+        pending = _pending_scores(get_score_buffer(), scores.keys())
+    except redis_errors() as e:
+        logger.warning('Could not read buffered scores: %s', e)
+        return scores
+    return {key: score + pending.get(key, 0) for key, score in scores.items()}
+
+
+def _pending_scores(score_buffer, keys):
+    """Returns {(user_id, leaderboard_id): buffered delta}, leaving out a flushing batch already committed."""
+    pending, in_flight, batch_id = score_buffer.pending(keys)
+    if in_flight and not ScoreFlushBatch.objects.filter(batch_id=batch_id).exists():
+        for key, delta in in_flight.items():
+            pending[key] = pending.get(key, 0) + delta
+    return pending
+
+
+def flush_score_buffer():
+    """
+    Applies every buffered delta to the database and returns how many entries
+    were written. The deltas stay readable in the buffer until their batch is
+    committed, and a batch that fails is retried by the next flush. A batch
+    is recorded as a ScoreFlushBatch along with its deltas, so one retried
+    after its commit is not applied again. Window deltas go to the buckets of
+    the day they were buffered on.
+    """
+    score_buffer = get_score_buffer()
+    lock = score_buffer.flush_lock()
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        started = time.monotonic()
+        batch_id, deltas, window_deltas = score_buffer.drain()
+        if batch_id is not None and ScoreFlushBatch.objects.filter(batch_id=batch_id).exists():
+            deltas = window_deltas = {}
+        if deltas or window_deltas:
+            # Users or leaderboards deleted since their deltas were buffered would
+            # otherwise fail the whole flush on a foreign key error.
+            existing_users = set(TINETUser.objects.filter(
+                id__in={key[0] for key in deltas} | {key[0] for key in window_deltas}
+            ).values_list('id', flat=True))
+            leaderboards = Leaderboard.objects.in_bulk(
+                {key[1] for key in deltas} | {key[1] for key in window_deltas}
+            )
+            deltas = {
+                key: delta for key, delta in deltas.items()
+                if delta and key[0] in existing_users and key[1] in leaderboards
+            }
+            window_deltas = {
+                key: delta for key, delta in window_deltas.items()
+                if delta and key[0] in existing_users and key[1] in leaderboards
+            }
+            with transaction.atomic():
+                # Written first, a flusher that lost its lock mid-batch then fails on the unique batch_id
+                ScoreFlushBatch.objects.create(batch_id=batch_id)
+                items = list(deltas.items())
+                for start in range(0, len(items), FLUSH_CHUNK_SIZE):
+                    # Deltas a set or a delete discarded since the drain are skipped
+                    chunk = score_buffer.flushing(dict(items[start:start + FLUSH_CHUNK_SIZE]).keys())
+                    LeaderboardEntry.objects.bulk_add_scores(chunk)
+                items = list(window_deltas.items())
+                for start in range(0, len(items), FLUSH_CHUNK_SIZE):
+                    days = defaultdict(dict)
+                    chunk = score_buffer.flushing_windows(dict(items[start:start + FLUSH_CHUNK_SIZE]).keys())
+                    for (user_id, leaderboard_id, day), delta in chunk.items():
+                        days[day][(user_id, leaderboard_id)] = delta
+                    for day, day_deltas in days.items():
+                        record_window_scores(leaderboards, day_deltas, day)
+        score_buffer.complete()
+        ScoreFlushBatch.objects.filter(applied_at__lt=timezone.now() - FLUSH_BATCH_RETENTION).delete()
+        _metrics['flushes'] += 1
+        _metrics['last_flush_at'] = timezone.now()
+        _metrics['last_flush_entries'] = len(deltas)
+        _metrics['last_flush_seconds'] = time.monotonic() - started
+        return len(deltas)
+    finally:
+        lock.release()
+
+
+def buffer_metrics():
+    try:
+        depth = get_score_buffer().depth()
+    except redis_errors():
+        depth = None
+    return {'depth': depth, **_metrics}
+
+
+class LocalScoreBuffer:
+    """
+    Process-local buffer, for development and tests or a single worker.
+    Window deltas are kept apart by (user_id, leaderboard_id, day).
+    """
+
+    def __init__(self):
+        self.deltas = {}
+        self.window_deltas = {}
+        # Deltas drained by a flush that has not committed yet
+        self.in_flight = {}
+        self.windows_in_flight = {}
+        self.batch_id = None
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add_many(self, deltas, day):
+        with self.lock:
+            for (user_id, leaderboard_id), delta in deltas.items():
+                self.deltas[(user_id, leaderboard_id)] = self.deltas.get((user_id, leaderboard_id), 0) + delta
+                window_key = (user_id, leaderboard_id, day)
+                self.window_deltas[window_key] = self.window_deltas.get(window_key, 0) + delta
+            return {key: self.deltas[key] for key in deltas}
+
+    def pending(self, keys):
+        """Returns ({key: buffered delta}, {key: delta being flushed}, id of the batch being flushed)."""
+        with self.lock:
+            pending = {key: self.deltas[key] for key in keys if key in self.deltas}
+            in_flight = {key: self.in_flight[key] for key in keys if key in self.in_flight}
+            return pending, in_flight, self.batch_id
+
+    def discard(self, keys, windows=False):
+        with self.lock:
+            keys = set(keys)
+            for key in keys:
+                self.deltas.pop(key, None)
+                self.in_flight.pop(key, None)
+            if windows:
+                for window_deltas in (self.window_deltas, self.windows_in_flight):
+                    for window_key in [window_key for window_key in window_deltas if window_key[:2] in keys]:
+                        del window_deltas[window_key]
+
+    def drain(self):
+        """
+        Returns (batch id, {(user_id, leaderboard_id): delta},
+        {(user_id, leaderboard_id, day): delta}) to flush. The batch id is
+        None when there is nothing to flush.
+        """
+        with self.lock:
+            if self.batch_id is None and (self.deltas or self.window_deltas):
+                self.in_flight, self.deltas = self.deltas, {}
+                self.windows_in_flight, self.window_deltas = self.window_deltas, {}
+                self.batch_id = uuid.uuid4().hex
+            return self.batch_id, dict(self.in_flight), dict(self.windows_in_flight)
+
+    def flushing(self, keys):
+        with self.lock:
+            return {key: self.in_flight[key] for key in keys if key in self.in_flight}
+
+    def flushing_windows(self, keys):
+        with self.lock:
+            return {key: self.windows_in_flight[key] for key in keys if key in self.windows_in_flight}
+
+    def complete(self):
+        with self.lock:
+            self.in_flight = {}
+            self.windows_in_flight = {}
+            self.batch_id = None
+
+    def flush_lock(self):
+        return self._flush_lock
+
+    def depth(self):
+        return len(self.deltas) + len(self.in_flight)
+
+
+class RedisScoreBuffer:
+    """
+    Buffer shared by every worker, kept in one Redis hash of
+    "user_id:leaderboard_id" -> delta updated with HINCRBY, and the window
+    deltas in WINDOWS_KEY as "user_id:leaderboard_id:day ordinal" -> delta,
+    with the day ordinals it holds in WINDOWS_DAYS_KEY.
+    A flush renames both hashes to their flushing keys under a new batch id
+    in BATCH_KEY and deletes those once its batch is committed, so deltas
+    stay readable and a crashed flush is retried rather than lost.
+    """
+    KEY = 'tinet:leaderboard:score-buffer'
+    FLUSHING_KEY = f'{KEY}:flushing'
+    WINDOWS_KEY = f'{KEY}:windows'
+    WINDOWS_FLUSHING_KEY = f'{WINDOWS_KEY}:flushing'
+    WINDOWS_DAYS_KEY = f'{WINDOWS_KEY}:days'
+    WINDOWS_FLUSHING_DAYS_KEY = f'{WINDOWS_FLUSHING_KEY}:days'
+    BATCH_KEY = f'{FLUSHING_KEY}:batch'
+    FLUSH_LOCK_TIMEOUT = 600
+
+    # Keeps a batch left behind by a crashed flush, and its id, until it is written
+    DRAIN = """
+    if redis.call('EXISTS', KEYS[2]) == 0 and redis.call('EXISTS', KEYS[4]) == 0 then
+        redis.call('DEL', KEYS[5], KEYS[7])
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            redis.call('RENAME', KEYS[1], KEYS[2])
+        end
+        if redis.call('EXISTS', KEYS[3]) == 1 then
+            redis.call('RENAME', KEYS[3], KEYS[4])
+        end
+        if redis.call('EXISTS', KEYS[6]) == 1 then
+            redis.call('RENAME', KEYS[6], KEYS[7])
+        end
+    end
+    if redis.call('EXISTS', KEYS[5]) == 0 and redis.call('EXISTS', KEYS[2], KEYS[4]) > 0 then
+        redis.call('SET', KEYS[5], ARGV[1])
+    end
+    return {redis.call('GET', KEYS[5]) or '', redis.call('HGETALL', KEYS[2]), redis.call('HGETALL', KEYS[4])}
+    """
+
+    # Drops the window fields of ARGV ("user_id:leaderboard_id") for every
+    # day buffered, in both the buffered and the flushing window hashes.
+    DISCARD_WINDOWS = """
+    for i = 1, #KEYS, 2 do
+        for _, day in ipairs(redis.call('SMEMBERS', KEYS[i + 1])) do
+            for j = 1, #ARGV do
+                redis.call('HDEL', KEYS[i], ARGV[j] .. ':' .. day)
+            end
+        end
+    end
+    return 0
+    """
+
+    def __init__(self, client=None):
+        self.client = client or get_redis()
+        self._drain = self.client.register_script(self.DRAIN)
+        self._discard_windows = self.client.register_script(self.DISCARD_WINDOWS)
+
+    def add_many(self, deltas, day):
+        # One transaction, so a drain never takes a delta without its window delta
+        pipeline = self.client.pipeline()
+        for key, delta in deltas.items():
+            pipeline.hincrby(self.KEY, self._field(key), delta)
+            pipeline.hincrby(self.WINDOWS_KEY, self._field((*key, day.toordinal())), delta)
+        pipeline.sadd(self.WINDOWS_DAYS_KEY, day.toordinal())
+        return dict(zip(deltas.keys(), pipeline.execute()[:-1:2]))
+
+    def pending(self, keys):
+        """Returns ({key: buffered delta}, {key: delta being flushed}, id of the batch being flushed)."""
+        keys = list(keys)
+        if not keys:
+            return {}, {}, None
+        fields = [self._field(key) for key in keys]
+        pipeline = self.client.pipeline()
+        pipeline.hmget(self.KEY, fields)
+        pipeline.hmget(self.FLUSHING_KEY, fields)
+        pipeline.get(self.BATCH_KEY)
+        buffered, in_flight, batch_id = pipeline.execute()
+        return (
+            {key: int(value) for key, value in zip(keys, buffered) if value is not None},
+            {key: int(value) for key, value in zip(keys, in_flight) if value is not None},
+            batch_id and batch_id.decode()
+        )
+
+    def discard(self, keys, windows=False):
+        if keys:
+            fields = [self._field(key) for key in keys]
+            pipeline = self.client.pipeline()
+            pipeline.hdel(self.KEY, *fields)
+            pipeline.hdel(self.FLUSHING_KEY, *fields)
+            if windows:
+                self._discard_windows(
+                    keys=[
+                        self.WINDOWS_KEY, self.WINDOWS_DAYS_KEY,
+                        self.WINDOWS_FLUSHING_KEY, self.WINDOWS_FLUSHING_DAYS_KEY
+                    ],
+                    args=fields,
+                    client=pipeline
+                )
+            pipeline.execute()
+
+    def drain(self):
+        """
+        Returns (batch id, {(user_id, leaderboard_id): delta},
+        {(user_id, leaderboard_id, day): delta}) to flush. The batch id is
+        None when there is nothing to flush.
+        """
+        batch_id, flat, window_flat = self._drain(
+            keys=[
+                self.KEY, self.FLUSHING_KEY, self.WINDOWS_KEY, self.WINDOWS_FLUSHING_KEY, self.BATCH_KEY,
+                self.WINDOWS_DAYS_KEY, self.WINDOWS_FLUSHING_DAYS_KEY
+            ],
+            args=[uuid.uuid4().hex]
+        )
+        deltas = {}
+        for field, value in zip(flat[::2], flat[1::2]):
+            user_id, leaderboard_id = field.decode().split(':')
+            deltas[(int(user_id), int(leaderboard_id))] = int(value)
+        window_deltas = {}
+        for field, value in zip(window_flat[::2], window_flat[1::2]):
+            user_id, leaderboard_id, day = field.decode().split(':')
+            window_deltas[(int(user_id), int(leaderboard_id), datetime.date.fromordinal(int(day)))] = int(value)
+        return batch_id.decode() or None, deltas, window_deltas
+
+    def flushing(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.hmget(self.FLUSHING_KEY, [self._field(key) for key in keys])
+        return {key: int(value) for key, value in zip(keys, values) if value is not None}
+
+    def flushing_windows(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.hmget(
+            self.WINDOWS_FLUSHING_KEY,
+            [self._field((user_id, leaderboard_id, day.toordinal())) for user_id, leaderboard_id, day in keys]
+        )
+        return {key: int(value) for key, value in zip(keys, values) if value is not None}
+
+    def complete(self):
+        self.client.delete(
+            self.FLUSHING_KEY, self.WINDOWS_FLUSHING_KEY, self.WINDOWS_FLUSHING_DAYS_KEY, self.BATCH_KEY
+        )
+
+    def flush_lock(self):
+        return self.client.lock(f'{self.KEY}:flush', timeout=self.FLUSH_LOCK_TIMEOUT)
+
+    def depth(self):
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.hlen(self.KEY)
+        pipeline.hlen(self.FLUSHING_KEY)
+        return sum(pipeline.execute())
+
+    @staticmethod
+    def _field(key):
+        return ':'.join(str(part) for part in key)
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import receiver
+
+from leaderboards.ranking import get_ranking_backend
+from leaderboards.signals import scores_changed, scores_buffered, scores_removed
+from tinetbackend.redis_client import get_redis, redis_errors
+from users.models import TINETUser
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PATTERN = 'tinet:leaderboard:*:events'
+# Changes arriving within one tick are merged into a single event.
+TICK = 0.25
+# Events a client may have queued before it is considered too slow and only
+# gets told to refresh.
+CLIENT_QUEUE_SIZE = 16
+# Ticks with more changed entries than this send a refresh instead of details.
+MAX_EVENT_ENTRIES = 50
+HEARTBEAT = 15
+
+REFRESH = ('refresh', {})
+
+_hub = None
+
+
+def _channel(leaderboard_id):
+    return f'tinet:leaderboard:{leaderboard_id}:events'
+
+
+def get_hub():
+    global _hub
+    if _hub is None:
+        _hub = LeaderboardHub()
+    return _hub
+
+
+def publish(leaderboard_id, changes):
+    """Publishes {user_id: new score, or None when removed} for a leaderboard."""
+    client = get_redis()
+    if client is None:
+        get_hub().dispatch_threadsafe(leaderboard_id, changes)
+        return
+    message = json.dumps({'leaderboard_id': leaderboard_id, 'changes': list(changes.items())})
+    try:
+        client.publish(_channel(leaderboard_id), message)
+    except redis_errors() as e:
+        logger.warning('Could not publish leaderboard %s changes: %s', leaderboard_id, e)
+
+
+def _publish_on_commit(changes):
+    by_leaderboard = defaultdict(dict)
+    for (user_id, leaderboard_id), score in changes:
+        by_leaderboard[leaderboard_id][user_id] = score
+    for leaderboard_id, leaderboard_changes in by_leaderboard.items():
+        transaction.on_commit(
+            lambda leaderboard_id=leaderboard_id, leaderboard_changes=leaderboard_changes:
+            publish(leaderboard_id, leaderboard_changes)
+        )
+
+
+@receiver(scores_changed)
+@receiver(scores_buffered)
+def publish_changed_scores(sender, scores, **kwargs):
+    _publish_on_commit(scores.items())
+
+
+@receiver(scores_removed)
+def publish_removed_scores(sender, entries, **kwargs):
+    _publish_on_commit((entry, None) for entry in entries)
+
+
+class LiveClient:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # The client is not reading fast enough: drop what it has not seen
+            # and tell it to reload the leaderboard instead.
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(REFRESH)
+
+    async def stream(self, hub, leaderboard_id):
+        """Yields the client's Server-Sent Events until it disconnects."""
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    name, data = await asyncio.wait_for(self.queue.get(), timeout=HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ': ping\n\n'
+                    continue
+                yield f'event: {name}\ndata: {json.dumps(data)}\n\n'
+        finally:
+            hub.unsubscribe(leaderboard_id, self)
+
+
+class LeaderboardHub:
+    """
+    Per-process fan-out of leaderboard changes to live clients. Changes come
+    from a single Redis pattern subscription (or straight from publish() when
+    Redis is not configured), are merged per tick, resolved to usernames and
+    ranks once, and pushed to every client of the leaderboard.
+    """
+
+    def __init__(self):
+        self.clients = defaultdict(set)
+        self.changes = defaultdict(dict)
+        self.loop = None
+        self.wakeup = None
+        self.tasks = []
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.changes.clear()
+        self.tasks = [loop.create_task(self._broadcast())]
+        if aioredis is not None and settings.REDIS_URL:
+            self.tasks.append(loop.create_task(self._listen()))
+
+    def subscribe(self, leaderboard_id):
+        self.start()
+        client = LiveClient()
+        self.clients[leaderboard_id].add(client)
+        return client
+
+    def unsubscribe(self, leaderboard_id, client):
+        clients = self.clients.get(leaderboard_id)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.clients[leaderboard_id]
+
+    def dispatch(self, leaderboard_id, changes):
+        if leaderboard_id in self.clients:
+            self.changes[leaderboard_id].update(changes)
+            self.wakeup.set()
+
+    def dispatch_threadsafe(self, leaderboard_id, changes):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.dispatch, leaderboard_id, changes)
+
+    async def _listen(self):
+        while True:
+            connection = aioredis.Redis.from_url(settings.REDIS_URL)
+            try:
+                pubsub = connection.pubsub(ignore_subscribe_messages=True)
+                await pubsub.psubscribe(CHANNEL_PATTERN)
+                async for message in pubsub.listen():
+                    if message['type'] != 'pmessage':
+                        continue
+                    data = json.loads(message['data'])
+                    self.dispatch(data['leaderboard_id'], {user_id: score for user_id, score in data['changes']})
+            except aioredis.RedisError as e:
+                logger.warning('Lost leaderboard event subscription, retrying: %s', e)
+                await asyncio.sleep(1)
+            finally:
+                await connection.aclose()
+
+    async def _broadcast(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(TICK)
+            self.wakeup.clear()
+            changes, self.changes = self.changes, defaultdict(dict)
+            for leaderboard_id, leaderboard_changes in changes.items():
+                if not self.clients.get(leaderboard_id):
+                    continue
+                try:
+                    event = await sync_to_async(build_event)(leaderboard_id, leaderboard_changes)
+                except Exception:
+                    logger.exception('Could not build live event for leaderboard %s', leaderboard_id)
+                    event = REFRESH
+                for client in list(self.clients.get(leaderboard_id, ())):
+                    client.push(event)
+
+
+def build_event(leaderboard_id, changes):
+    if len(changes) > MAX_EVENT_ENTRIES:
+        return REFRESH
+    usernames = dict(TINETUser.objects.filter(id__in=changes.keys()).values_list('id', 'username'))
+    ranking = get_ranking_backend()
+    entries = []
+    removed = []
+    for user_id, score in changes.items():
+        if user_id not in usernames:
+            continue
+        if score is None:
+            removed.append(usernames[user_id])
+            continue
+        rank = ranking.rank(leaderboard_id, user_id)
+        entries.append({'username': usernames[user_id], 'score': score, 'rank': rank[0] if rank else None})
+    return 'scores', {'leaderboard_id': leaderboard_id, 'entries': entries, 'removed': removed}
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from leaderboards.windows import compact_windows
+
+
+class Command(BaseCommand):
+    help = 'Deletes daily, weekly and season leaderboard buckets past their retention'
+
+    def handle(self, *args, **options):
+        deleted = compact_windows()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired window entries'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from leaderboards.buffer import flush_score_buffer, buffer_metrics
+
+
+class Command(BaseCommand):
+    help = 'Writes buffered write-behind leaderboard scores to the database'
+
+    def handle(self, *args, **options):
+        flushed = flush_score_buffer()
+        metrics = buffer_metrics()
+        self.stdout.write(self.style.SUCCESS(
+            f"Flushed {flushed} entries in {metrics['last_flush_seconds']:.3f}s, {metrics['depth']} still buffered"
+        ))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from leaderboards.models import Leaderboard
+from leaderboards.ranking import get_ranking_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the leaderboard ranking index from the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('leaderboard_ids', nargs='*', type=int, help='Leaderboards to rebuild, defaults to all')
+
+    def handle(self, *args, **options):
+        backend = get_ranking_backend()
+        leaderboard_ids = options['leaderboard_ids'] or Leaderboard.objects.values_list('id', flat=True)
+        rebuilt = 0
+        skipped = []
+        for leaderboard_id in leaderboard_ids:
+            if backend.rebuild(leaderboard_id):
+                rebuilt += 1
+            else:
+                skipped.append(leaderboard_id)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rebuilt} leaderboard rankings'))
+        if skipped:
+            raise CommandError(
+                f"Skipped leaderboards {', '.join(map(str, skipped))}, "
+                f"Redis is unavailable or another rebuild of them is running"
+            )
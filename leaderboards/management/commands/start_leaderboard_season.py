@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from leaderboards.models import Leaderboard
+
+
+class Command(BaseCommand):
+    help = 'Starts a new season on a leaderboard, all-time scores are kept'
+
+    def add_arguments(self, parser):
+        parser.add_argument('leaderboard_id', type=int)
+
+    def handle(self, *args, **options):
+        try:
+            leaderboard = Leaderboard.objects.get(id=options['leaderboard_id'])
+        except Leaderboard.DoesNotExist:
+            raise CommandError(f"Leaderboard {options['leaderboard_id']} does not exist")
+        season = leaderboard.start_new_season()
+        self.stdout.write(self.style.SUCCESS(f'Leaderboard {leaderboard.id} is now in season {season}'))
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_entries(apps, schema_editor):
+    LeaderboardEntry = apps.get_model('leaderboards', 'LeaderboardEntry')
+    duplicates = (
+        LeaderboardEntry.objects
+        .values('user_id', 'leaderboard_id')
+        .annotate(rows=Count('id'), keep_id=Min('id'), total=Sum('score'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates:
+        entries = LeaderboardEntry.objects.filter(
+            user_id=duplicate['user_id'],
+            leaderboard_id=duplicate['leaderboard_id']
+        )
+        entries.exclude(id=duplicate['keep_id']).delete()
+        entries.filter(id=duplicate['keep_id']).update(score=duplicate['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboards', '0002_leaderboard_app'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_entries, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='leaderboardentry',
+            constraint=models.UniqueConstraint(fields=('user', 'leaderboard'), name='unique_leaderboard_entry_per_user'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.3 on 2026-10-18 06:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboards', '0003_merge_duplicate_entries'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='leaderboardentry',
+            index=models.Index(fields=['leaderboard', '-score', 'id'], name='leaderboard_score_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 06:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboards', '0004_leaderboardentry_score_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leaderboard',
+            name='write_behind',
+            field=models.BooleanField(default=False),
+        ),
+    ]
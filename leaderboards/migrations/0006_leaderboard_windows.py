@@ -0,0 +1,54 @@
+# Generated by Django 5.0.3 on 2026-10-18 06:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboards', '0005_leaderboard_write_behind'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leaderboard',
+            name='season',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='leaderboard',
+            name='track_daily',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='leaderboard',
+            name='track_season',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='leaderboard',
+            name='track_weekly',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='LeaderboardWindowEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('window', models.CharField(choices=[('daily', 'Daily'), ('weekly', 'Weekly'), ('season', 'Season')], max_length=6)),
+                ('bucket', models.IntegerField()),
+                ('score', models.BigIntegerField(default=0)),
+                ('leaderboard', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='leaderboards.leaderboard')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['leaderboard', 'window', 'bucket', '-score', 'id'], name='leaderboard_window_score_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='leaderboardwindowentry',
+            constraint=models.UniqueConstraint(fields=('leaderboard', 'window', 'bucket', 'user'), name='unique_leaderboard_window_entry_per_user'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 07:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboards', '0006_leaderboard_windows'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leaderboardentry',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
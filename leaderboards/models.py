@@ -1,14 +1,176 @@
-from django.db import models
+from django.db import models, connections
+from django.db.models import F
+from django.utils import timezone
+from leaderboards.signals import scores_changed, scores_removed
 from users.models import TINETUser, AppAPIKey
 
 
+def upsert_scores(model, using, key_columns, values, increment, versioned=False):
+    """
+    Writes {key tuple: value} into model's score column with one
+    INSERT ... ON CONFLICT statement, adding to or replacing existing scores,
+    and returns {key tuple: resulting score}. The row lock taken by the upsert
+    serializes concurrent writers. Each key may only appear once per call.
+    With versioned, the version column is bumped as well and the values
+    returned are (score, version) pairs.
+    """
+    if not values:
+        return {}
+    conn = connections[using]
+    table = conn.ops.quote_name(model._meta.db_table)
+    columns = ", ".join(conn.ops.quote_name(column) for column in key_columns)
+    if increment:
+        new_score = f"{table}.score + EXCLUDED.score"
+    else:
+        new_score = "EXCLUDED.score"
+    row = ["%s"] * (len(key_columns) + 1)
+    insert_columns, updates, returning = f"{columns}, score", f"score = {new_score}", f"{columns}, score"
+    if versioned:
+        row.append("1")
+        insert_columns += ", version"
+        updates += f", version = {table}.version + 1"
+        returning += ", version"
+    placeholders = ", ".join(["(" + ", ".join(row) + ")"] * len(values))
+    params = []
+    for key, value in values.items():
+        params.extend(key)
+        params.append(value)
+    sql = (
+        f"INSERT INTO {table} ({insert_columns}) VALUES {placeholders} "
+        f"ON CONFLICT ({columns}) DO UPDATE SET {updates} "
+        f"RETURNING {returning}"
+    )
+    with conn.cursor() as cursor:
+        cursor.execute(sql, params)
+        if versioned:
+            return {tuple(row[:-2]): (row[-2], row[-1]) for row in cursor.fetchall()}
+        return {tuple(row[:-1]): row[-1] for row in cursor.fetchall()}
+
+
 class Leaderboard(models.Model):
     title = models.CharField(max_length=20, default="No title")
     description = models.CharField(max_length=100, default="No description")
     app = models.ForeignKey(AppAPIKey, on_delete=models.CASCADE, null=True)
+    write_behind = models.BooleanField(default=False)
+    track_daily = models.BooleanField(default=False)
+    track_weekly = models.BooleanField(default=False)
+    track_season = models.BooleanField(default=False)
+    season = models.PositiveIntegerField(default=1)
+
+    def start_new_season(self):
+        """Moves the season window to a fresh bucket, old seasons are left for compaction."""
+        Leaderboard.objects.filter(id=self.id).update(season=F('season') + 1)
+        self.refresh_from_db(fields=['season'])
+        return self.season
+
+
+class LeaderboardEntryManager(models.Manager):
+    def add_score(self, user_id, leaderboard_id, delta):
+        """Adds delta to the entry (creating it if needed) and returns the new score."""
+        return self.bulk_add_scores({(user_id, leaderboard_id): delta})[(user_id, leaderboard_id)]
+
+    def set_score(self, user_id, leaderboard_id, score):
+        """Sets the entry score (creating it if needed) and returns the new score."""
+        return self.bulk_set_scores({(user_id, leaderboard_id): score})[(user_id, leaderboard_id)]
+
+    def remove_score(self, user_id, leaderboard_id):
+        """Deletes the entry and returns whether it existed."""
+        deleted, _ = self.filter(user_id=user_id, leaderboard_id=leaderboard_id).delete()
+        if deleted:
+            scores_removed.send(sender=self.model, entries=[(user_id, leaderboard_id)])
+        return bool(deleted)
+
+    def get_scores(self, keys, for_update=False):
+        """Returns {(user_id, leaderboard_id): score} of the entries that exist, row locked if for_update."""
+        keys = set(keys)
+        if not keys:
+            return {}
+        entries = self.filter(
+            user_id__in={user_id for user_id, _ in keys},
+            leaderboard_id__in={leaderboard_id for _, leaderboard_id in keys}
+        )
+        if for_update:
+            entries = entries.select_for_update()
+        scores = {
+            (user_id, leaderboard_id): score
+            for user_id, leaderboard_id, score in entries.values_list('user_id', 'leaderboard_id', 'score')
+        }
+        return {key: score for key, score in scores.items() if key in keys}
+
+    def bulk_add_scores(self, deltas):
+        """Takes {(user_id, leaderboard_id): delta} and returns {(user_id, leaderboard_id): new score}."""
+        return self._upsert(deltas, increment=True)
+
+    def bulk_set_scores(self, scores):
+        """Takes {(user_id, leaderboard_id): score} and returns {(user_id, leaderboard_id): new score}."""
+        return self._upsert(scores, increment=False)
+
+    def _upsert(self, values, increment):
+        written = upsert_scores(self.model, self.db, ['user_id', 'leaderboard_id'], values, increment, versioned=True)
+        scores = {key: score for key, (score, _) in written.items()}
+        if scores:
+            scores_changed.send(
+                sender=self.model, scores=scores, versions={key: version for key, (_, version) in written.items()}
+            )
+        return scores
 
 
 class LeaderboardEntry(models.Model):
     user = models.ForeignKey(TINETUser, on_delete=models.CASCADE)
     score = models.BigIntegerField(default=0)
     leaderboard = models.ForeignKey(Leaderboard, on_delete=models.CASCADE)
+    # Bumped by every upsert, lets the ranking index drop writes that arrive out of order
+    version = models.BigIntegerField(default=0)
+
+    objects = LeaderboardEntryManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'leaderboard'], name='unique_leaderboard_entry_per_user'),
+        ]
+        indexes = [
+            models.Index(fields=['leaderboard', '-score', 'id'], name='leaderboard_score_idx'),
+        ]
+
+
+class LeaderboardWindowEntry(models.Model):
+    """
+    Score of a user within one time window of a leaderboard. bucket is the
+    date ordinal of the day (daily), of the week's Monday (weekly), or the
+    leaderboard season number (season).
+    """
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    SEASON = 'season'
+    WINDOW_CHOICES = [
+        (DAILY, 'Daily'),
+        (WEEKLY, 'Weekly'),
+        (SEASON, 'Season'),
+    ]
+
+    leaderboard = models.ForeignKey(Leaderboard, on_delete=models.CASCADE)
+    user = models.ForeignKey(TINETUser, on_delete=models.CASCADE)
+    window = models.CharField(max_length=6, choices=WINDOW_CHOICES)
+    bucket = models.IntegerField()
+    score = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['leaderboard', 'window', 'bucket', 'user'],
+                name='unique_leaderboard_window_entry_per_user'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['leaderboard', 'window', 'bucket', '-score', 'id'], name='leaderboard_window_score_idx'),
+        ]
+
+
+class ScoreFlushBatch(models.Model):
+    """
+    A write-behind flush batch whose deltas are committed. Written in the
+    same transaction as the deltas, so a batch retried after a crash between
+    the commit and clearing the buffer is not applied twice.
+    """
+    batch_id = models.CharField(max_length=32, unique=True)
+    applied_at = models.DateTimeField(default=timezone.now, db_index=True)
@@ -0,0 +1,429 @@
+import logging
+import uuid
+from collections import defaultdict
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from leaderboards.models import Leaderboard, LeaderboardEntry
+from leaderboards.signals import scores_changed, scores_removed
+from users.models import TINETUser
+from tinetbackend.redis_client import get_redis, redis_errors
+
+logger = logging.getLogger(__name__)
+
+_backend = None
+
+
+def get_ranking_backend():
+    """Returns the ranking backend configured by LEADERBOARD_RANKING_BACKEND."""
+    global _backend
+    if _backend is None:
+        _backend = import_string(settings.LEADERBOARD_RANKING_BACKEND)()
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_ranking_backend(setting, **kwargs):
+    global _backend
+    if setting in ('LEADERBOARD_RANKING_BACKEND', 'REDIS_URL'):
+        _backend = None
+
+
+@receiver(scores_changed)
+def sync_changed_scores(sender, scores, versions=None, **kwargs):
+    by_leaderboard = defaultdict(dict)
+    versions_by_leaderboard = defaultdict(dict)
+    for (user_id, leaderboard_id), score in scores.items():
+        by_leaderboard[leaderboard_id][user_id] = score
+        if versions:
+            versions_by_leaderboard[leaderboard_id][user_id] = versions[(user_id, leaderboard_id)]
+    backend = get_ranking_backend()
+    for leaderboard_id, leaderboard_scores in by_leaderboard.items():
+        transaction.on_commit(
+            lambda leaderboard_id=leaderboard_id, leaderboard_scores=leaderboard_scores:
+            backend.update_scores(leaderboard_id, leaderboard_scores, versions_by_leaderboard[leaderboard_id])
+        )
+
+
+@receiver(scores_removed)
+def sync_removed_scores(sender, entries, **kwargs):
+    by_leaderboard = defaultdict(list)
+    for user_id, leaderboard_id in entries:
+        by_leaderboard[leaderboard_id].append(user_id)
+    backend = get_ranking_backend()
+    for leaderboard_id, user_ids in by_leaderboard.items():
+        transaction.on_commit(
+            lambda leaderboard_id=leaderboard_id, user_ids=user_ids: backend.remove_users(leaderboard_id, user_ids)
+        )
+
+
+@receiver(post_delete, sender=Leaderboard)
+def drop_deleted_leaderboard(sender, instance, **kwargs):
+    backend = get_ranking_backend()
+    transaction.on_commit(lambda: backend.drop(instance.id))
+
+
+@receiver(pre_delete, sender=TINETUser)
+def remove_deleted_user(sender, instance, **kwargs):
+    leaderboard_ids = list(
+        LeaderboardEntry.objects.filter(user_id=instance.id).values_list('leaderboard_id', flat=True)
+    )
+    if leaderboard_ids:
+        scores_removed.send(
+            sender=LeaderboardEntry,
+            entries=[(instance.id, leaderboard_id) for leaderboard_id in leaderboard_ids]
+        )
+
+
+class SQLRankingBackend:
+    """
+    Ranks straight from LeaderboardEntry. Ranks are 1-based, ordered by score
+    descending; ties go to the oldest entry.
+    """
+
+    def update_scores(self, leaderboard_id, scores, versions=None):
+        pass
+
+    def remove_users(self, leaderboard_id, user_ids):
+        pass
+
+    def drop(self, leaderboard_id):
+        pass
+
+    def rebuild(self, leaderboard_id):
+        """Rebuilds the ranking index of the leaderboard, returns False if it was skipped."""
+        return True
+
+    def count(self, leaderboard_id):
+        return LeaderboardEntry.objects.filter(leaderboard_id=leaderboard_id).count()
+
+    def top(self, leaderboard_id, count):
+        """Returns [(user_id, score)] for the best count entries."""
+        return list(
+            LeaderboardEntry.objects
+            .filter(leaderboard_id=leaderboard_id)
+            .order_by('-score', 'id')
+            .values_list('user_id', 'score')[:count]
+        )
+
+    def rank(self, leaderboard_id, user_id):
+        """Returns (rank, score) for the user, or None when they have no entry."""
+        entry = self._get_entry(leaderboard_id, user_id)
+        if entry is None:
+            return None
+        return self._rank_of_entry(entry), entry.score
+
+    def around(self, leaderboard_id, user_id, radius):
+        """Returns [(rank, user_id, score)] for the user and up to radius entries on each side."""
+        entry = self._get_entry(leaderboard_id, user_id)
+        if entry is None:
+            return []
+        rank = self._rank_of_entry(entry)
+        entries = LeaderboardEntry.objects.filter(leaderboard_id=leaderboard_id)
+        above = list(
+            entries.filter(Q(score__gt=entry.score) | Q(score=entry.score, id__lt=entry.id))
+            .order_by('score', '-id')
+            .values_list('user_id', 'score')[:radius]
+        )
+        below = list(
+            entries.filter(Q(score__lt=entry.score) | Q(score=entry.score, id__gt=entry.id))
+            .order_by('-score', 'id')
+            .values_list('user_id', 'score')[:radius]
+        )
+        neighbourhood = list(reversed(above)) + [(entry.user_id, entry.score)] + below
+        first_rank = rank - len(above)
+        return [(first_rank + offset, member, score) for offset, (member, score) in enumerate(neighbourhood)]
+
+    @staticmethod
+    def _get_entry(leaderboard_id, user_id):
+        return LeaderboardEntry.objects.filter(leaderboard_id=leaderboard_id, user_id=user_id).only(
+            'id', 'user_id', 'score'
+        ).first()
+
+    @staticmethod
+    def _rank_of_entry(entry):
+        higher = LeaderboardEntry.objects.filter(leaderboard_id=entry.leaderboard_id).filter(
+            Q(score__gt=entry.score) | Q(score=entry.score, id__lt=entry.id)
+        ).count()
+        return higher + 1
+
+
+class RedisRankingBackend(SQLRankingBackend):
+    """
+    Mirrors every leaderboard into a Redis sorted set (member: user id, score:
+    entry score), giving O(log n) rank lookups. A sorted set is built from
+    Postgres the first time it is read and only updated while it exists, so a
+    missing or flushed key never serves partial data. Every operation falls
+    back to SQL when Redis is unavailable; ties are ordered by Redis.
+    """
+    KEY_PREFIX = 'tinet:leaderboard:'
+
+    # Only touch sets that have been built, otherwise a single write would
+    # create a set holding just that one entry. While a rebuild is running
+    # (KEYS[2] exists) writes also go to the set being built, so none that
+    # commit after its snapshot was read get lost when it is swapped in.
+    # ARGV holds (score, member, version) triples. Writes are committed in
+    # version order but may arrive out of it, so a write older than the
+    # version recorded in KEYS[5] is dropped. Version 0 always applies.
+    UPDATE_IF_EXISTS = """
+    local added = 0
+    local live = redis.call('EXISTS', KEYS[1]) == 1
+    local building = redis.call('EXISTS', KEYS[2]) == 1
+    for i = 1, #ARGV, 3 do
+        local score, member, version = ARGV[i], ARGV[i + 1], tonumber(ARGV[i + 2])
+        if version == 0 or version > tonumber(redis.call('HGET', KEYS[5], member) or '0') then
+            if version > 0 and (live or building) then
+                redis.call('HSET', KEYS[5], member, version)
+            end
+            if live then
+                added = added + redis.call('ZADD', KEYS[1], score, member)
+            end
+            if building then
+                redis.call('ZADD', KEYS[3], score, member)
+                redis.call('SREM', KEYS[4], member)
+            end
+        end
+    end
+    return added
+    """
+
+    # Removals during a rebuild are remembered in KEYS[4] so the snapshot
+    # does not bring the users back. Their versions go, a new entry starts over.
+    REMOVE = """
+    redis.call('ZREM', KEYS[1], unpack(ARGV))
+    redis.call('HDEL', KEYS[5], unpack(ARGV))
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        redis.call('ZREM', KEYS[3], unpack(ARGV))
+        redis.call('SADD', KEYS[4], unpack(ARGV))
+        redis.call('EXPIRE', KEYS[4], tonumber(redis.call('TTL', KEYS[2])))
+    end
+    return 0
+    """
+
+    # Snapshot entries never overwrite a score written since the rebuild
+    # started, and raise the recorded versions so older writes still in
+    # flight are dropped.
+    LOAD_SNAPSHOT = """
+    for i = 1, #ARGV, 3 do
+        local member, version = ARGV[i + 1], tonumber(ARGV[i + 2])
+        if not redis.call('ZSCORE', KEYS[3], member) and redis.call('SISMEMBER', KEYS[4], member) == 0 then
+            redis.call('ZADD', KEYS[3], ARGV[i], member)
+            if version > tonumber(redis.call('HGET', KEYS[5], member) or '0') then
+                redis.call('HSET', KEYS[5], member, version)
+            end
+        end
+    end
+    return 0
+    """
+
+    FINISH_REBUILD = """
+    if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+        return 0
+    end
+    if redis.call('EXISTS', KEYS[3]) == 1 then
+        redis.call('RENAME', KEYS[3], KEYS[1])
+    else
+        redis.call('DEL', KEYS[1])
+    end
+    redis.call('DEL', KEYS[2], KEYS[4])
+    return 1
+    """
+
+    REBUILD_TIMEOUT = 600
+    SNAPSHOT_CHUNK_SIZE = 5000
+
+    def __init__(self, client=None):
+        self.client = client or get_redis()
+        self.stale = set()
+        if self.client:
+            self._update_if_exists = self.client.register_script(self.UPDATE_IF_EXISTS)
+            self._remove = self.client.register_script(self.REMOVE)
+            self._load_snapshot = self.client.register_script(self.LOAD_SNAPSHOT)
+            self._finish_rebuild = self.client.register_script(self.FINISH_REBUILD)
+
+    def key(self, leaderboard_id):
+        return f'{self.KEY_PREFIX}{leaderboard_id}'
+
+    def keys(self, leaderboard_id):
+        """
+        Returns [live set, rebuild lock, set being built, users removed during
+        the rebuild, entry versions].
+        """
+        key = self.key(leaderboard_id)
+        return [key, f'{key}:rebuilding', f'{key}:building', f'{key}:building:removed', f'{key}:versions']
+
+    def update_scores(self, leaderboard_id, scores, versions=None):
+        versions = versions or {}
+        args = []
+        for user_id, score in scores.items():
+            args.extend([score, user_id, versions.get(user_id, 0)])
+        self._write(leaderboard_id, lambda: self._update_if_exists(keys=self.keys(leaderboard_id), args=args))
+
+    def remove_users(self, leaderboard_id, user_ids):
+        self._write(leaderboard_id, lambda: self._remove(keys=self.keys(leaderboard_id), args=list(user_ids)))
+
+    def drop(self, leaderboard_id):
+        self._write(leaderboard_id, lambda: self.client.delete(*self.keys(leaderboard_id)))
+
+    def rebuild(self, leaderboard_id):
+        """
+        Rebuilds the sorted set from Postgres and swaps it in atomically.
+        Returns False if Redis is not configured or another rebuild of the
+        set is already running.
+        """
+        if self.client is None:
+            return False
+        keys = self.keys(leaderboard_id)
+        token = uuid.uuid4().hex
+        # Taken before the snapshot is read, from then on writers also update the set being built
+        if not self.client.set(keys[1], token, nx=True, ex=self.REBUILD_TIMEOUT):
+            return False
+        try:
+            self.client.delete(keys[2], keys[3])
+            args = []
+            for user_id, score, version in self._snapshot(leaderboard_id):
+                args.extend([score, user_id, version])
+                if len(args) == 3 * self.SNAPSHOT_CHUNK_SIZE:
+                    self._load_snapshot(keys=keys, args=args)
+                    args = []
+            if args:
+                self._load_snapshot(keys=keys, args=args)
+            self._finish_rebuild(keys=keys, args=[token])
+        except BaseException:
+            self.client.delete(keys[1])
+            raise
+        self.stale.discard(leaderboard_id)
+        return True
+
+    @staticmethod
+    def _snapshot(leaderboard_id):
+        entries = LeaderboardEntry.objects.filter(leaderboard_id=leaderboard_id).values_list(
+            'user_id', 'score', 'version'
+        )
+        return entries.iterator(chunk_size=5000)
+
+    def count(self, leaderboard_id):
+        return self._read('count', leaderboard_id)
+
+    def top(self, leaderboard_id, count):
+        return self._read('top', leaderboard_id, count)
+
+    def rank(self, leaderboard_id, user_id):
+        return self._read('rank', leaderboard_id, user_id)
+
+    def around(self, leaderboard_id, user_id, radius):
+        return self._read('around', leaderboard_id, user_id, radius)
+
+    def _redis_count(self, key):
+        return self.client.zcard(key)
+
+    def _redis_top(self, key, count):
+        members = self.client.zrevrange(key, 0, count - 1, withscores=True)
+        return [(int(member), int(score)) for member, score in members]
+
+    def _redis_rank(self, key, user_id):
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.zrevrank(key, user_id)
+        pipeline.zscore(key, user_id)
+        rank, score = pipeline.execute()
+        if rank is None:
+            return None
+        return rank + 1, int(score)
+
+    def _redis_around(self, key, user_id, radius):
+        rank = self.client.zrevrank(key, user_id)
+        if rank is None:
+            return []
+        start = max(rank - radius, 0)
+        members = self.client.zrevrange(key, start, rank + radius, withscores=True)
+        return [(start + offset + 1, int(member), int(score)) for offset, (member, score) in enumerate(members)]
+
+    def _read(self, name, leaderboard_id, *args):
+        if self.client is not None:
+            try:
+                if self._ensure(leaderboard_id):
+                    return getattr(self, f'_redis_{name}')(self.key(leaderboard_id), *args)
+            except redis_errors() as e:
+                logger.warning('Ranking lookup on leaderboard %s fell back to SQL: %s', leaderboard_id, e)
+        return getattr(super(), name)(leaderboard_id, *args)
+
+    def _ensure(self, leaderboard_id):
+        """Makes sure the sorted set of the leaderboard is built, returns whether it is."""
+        if self.stale:
+            # Writes were lost while Redis was unreachable, drop those sets so
+            # they get rebuilt from Postgres. A rebuild already running may
+            # have missed them too, dropping its lock keeps it from swapping in.
+            self.client.delete(*[key for stale_id in self.stale for key in self.keys(stale_id)])
+            self.stale.clear()
+        if self.client.exists(self.key(leaderboard_id)):
+            return True
+        # Served from SQL while another worker rebuilds the set, or when the leaderboard is empty
+        return self.rebuild(leaderboard_id) and self.client.exists(self.key(leaderboard_id))
+
+    def _write(self, leaderboard_id, operation):
+        if self.client is None:
+            return
+        try:
+            operation()
+        except redis_errors() as e:
+            logger.warning('Could not update ranking of leaderboard %s: %s', leaderboard_id, e)
+            self.stale.add(leaderboard_id)
+
+
+class InMemoryRankingBackend(SQLRankingBackend):
+    """
+    In-process stand-in for RedisRankingBackend, meant for tests. Sets are
+    built from Postgres on first read exactly like the Redis backend does.
+    """
+
+    def __init__(self):
+        self.sets = {}
+
+    def update_scores(self, leaderboard_id, scores, versions=None):
+        if leaderboard_id in self.sets:
+            self.sets[leaderboard_id].update(scores)
+
+    def remove_users(self, leaderboard_id, user_ids):
+        for user_id in user_ids:
+            self.sets.get(leaderboard_id, {}).pop(user_id, None)
+
+    def drop(self, leaderboard_id):
+        self.sets.pop(leaderboard_id, None)
+
+    def rebuild(self, leaderboard_id):
+        self.sets[leaderboard_id] = dict(
+            LeaderboardEntry.objects.filter(leaderboard_id=leaderboard_id).values_list('user_id', 'score')
+        )
+        return True
+
+    def count(self, leaderboard_id):
+        return len(self._sorted(leaderboard_id))
+
+    def top(self, leaderboard_id, count):
+        return self._sorted(leaderboard_id)[:count]
+
+    def rank(self, leaderboard_id, user_id):
+        for rank, member, score in self._ranked(leaderboard_id):
+            if member == user_id:
+                return rank, score
+        return None
+
+    def around(self, leaderboard_id, user_id, radius):
+        ranked = self._ranked(leaderboard_id)
+        for index, (rank, member, score) in enumerate(ranked):
+            if member == user_id:
+                return ranked[max(index - radius, 0):index + radius + 1]
+        return []
+
+    def _sorted(self, leaderboard_id):
+        if leaderboard_id not in self.sets:
+            self.rebuild(leaderboard_id)
+        return sorted(self.sets[leaderboard_id].items(), key=lambda item: (-item[1], item[0]))
+
+    def _ranked(self, leaderboard_id):
+        return [(rank, member, score) for rank, (member, score) in enumerate(self._sorted(leaderboard_id), start=1)]
@@ -0,0 +1,14 @@
+from django.dispatch import Signal
+
+# Sent by LeaderboardEntryManager after writing scores.
+# scores: {(user_id, leaderboard_id): new score}
+# versions: {(user_id, leaderboard_id): entry version after the write}
+scores_changed = Signal()
+
+# Sent by LeaderboardEntryManager after deleting entries.
+# entries: [(user_id, leaderboard_id)]
+scores_removed = Signal()
+
+# Sent after deltas were queued for a write-behind leaderboard instead of written.
+# scores: {(user_id, leaderboard_id): score including buffered deltas}
+scores_buffered = Signal()
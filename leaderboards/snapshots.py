@@ -0,0 +1,115 @@
+import json
+import time
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from leaderboards.buffer import merge_buffered_scores
+from leaderboards.models import Leaderboard
+from leaderboards.ranking import get_ranking_backend
+from leaderboards.signals import scores_changed, scores_removed, scores_buffered
+from users.models import TINETUser
+
+SNAPSHOT_SIZE = 100
+SNAPSHOT_TIMEOUT = 300
+
+
+def _version_key(leaderboard_id):
+    return f'tinet:leaderboard:{leaderboard_id}:version'
+
+
+def _modified_key(leaderboard_id):
+    return f'tinet:leaderboard:{leaderboard_id}:modified'
+
+
+def _snapshot_key(leaderboard_id, version):
+    return f'tinet:leaderboard:{leaderboard_id}:snapshot:{version}'
+
+
+def _seed():
+    # Versions start from the clock so a version lost to cache eviction or a
+    # restart is never handed out again with different content.
+    return time.time_ns() // 1000
+
+
+def get_version(leaderboard_id):
+    """Returns (version, last modified unix time) of the leaderboard, from the cache only."""
+    values = cache.get_many([_version_key(leaderboard_id), _modified_key(leaderboard_id)])
+    version = values.get(_version_key(leaderboard_id))
+    modified = values.get(_modified_key(leaderboard_id))
+    if version is None or modified is None:
+        now = time.time()
+        cache.add(_version_key(leaderboard_id), _seed(), timeout=None)
+        cache.add(_modified_key(leaderboard_id), now, timeout=None)
+        version = cache.get(_version_key(leaderboard_id))
+        modified = cache.get(_modified_key(leaderboard_id), now)
+    return version, modified
+
+
+def bump_version(leaderboard_id):
+    key = _version_key(leaderboard_id)
+    cache.add(key, _seed(), timeout=None)
+    try:
+        version = cache.incr(key)
+    except ValueError:
+        version = _seed()
+        cache.set(key, version, timeout=None)
+    cache.set(_modified_key(leaderboard_id), time.time(), timeout=None)
+    cache.delete(_snapshot_key(leaderboard_id, version - 1))
+    return version
+
+
+def get_snapshot(leaderboard, version):
+    """Returns the serialized JSON snapshot of the leaderboard at the given version."""
+    key = _snapshot_key(leaderboard.id, version)
+    payload = cache.get(key)
+    if payload is None:
+        payload = json.dumps(build_snapshot(leaderboard, version)).encode()
+        cache.set(key, payload, timeout=SNAPSHOT_TIMEOUT)
+    return payload
+
+
+def build_snapshot(leaderboard, version):
+    ranking = get_ranking_backend()
+    top = ranking.top(leaderboard.id, SNAPSHOT_SIZE)
+    usernames = dict(TINETUser.objects.filter(id__in=[user_id for user_id, _ in top]).values_list('id', 'username'))
+    scores = {(user_id, leaderboard.id): score for user_id, score in top}
+    if leaderboard.write_behind:
+        scores = merge_buffered_scores(scores)
+    return {
+        'success': True,
+        'leaderboard': {
+            'id': leaderboard.id,
+            'title': leaderboard.title,
+            'description': leaderboard.description,
+        },
+        'version': version,
+        'total': ranking.count(leaderboard.id),
+        'entries': [
+            {'rank': rank, 'username': usernames.get(user_id), 'score': scores[(user_id, leaderboard.id)]}
+            for rank, (user_id, _) in enumerate(top, start=1)
+        ]
+    }
+
+
+def _bump_on_commit(leaderboard_ids):
+    for leaderboard_id in set(leaderboard_ids):
+        transaction.on_commit(lambda leaderboard_id=leaderboard_id: bump_version(leaderboard_id))
+
+
+@receiver(scores_changed)
+@receiver(scores_buffered)
+def bump_changed_leaderboards(sender, scores, **kwargs):
+    _bump_on_commit(leaderboard_id for _, leaderboard_id in scores)
+
+
+@receiver(scores_removed)
+def bump_removed_leaderboards(sender, entries, **kwargs):
+    _bump_on_commit(leaderboard_id for _, leaderboard_id in entries)
+
+
+@receiver(post_save, sender=Leaderboard)
+@receiver(post_delete, sender=Leaderboard)
+def bump_edited_leaderboard(sender, instance, **kwargs):
+    _bump_on_commit([instance.id])
@@ -1,3 +1,576 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+from datetime import timedelta
+from unittest import mock
+import fakeredis
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from users.models import TINETUser, AppAPIKey, digest_secret
+from .buffer import LocalScoreBuffer, RedisScoreBuffer, buffer_metrics, flush_score_buffer
+from .live import CLIENT_QUEUE_SIZE, REFRESH, LiveClient
+from .models import Leaderboard, LeaderboardEntry, LeaderboardWindowEntry
+from .ranking import RedisRankingBackend, SQLRankingBackend, get_ranking_backend
+from .windows import compact_windows
 
-# Create your tests here.
+
+class LeaderboardEntryManagerTests(TestCase):
+
+    def setUp(self):
+        self.user = TINETUser.objects.create(username='player', password='testpass')
+        self.leaderboard = Leaderboard.objects.create(title='Test board')
+
+    def test_add_score_creates_entry(self):
+        score = LeaderboardEntry.objects.add_score(self.user.id, self.leaderboard.id, 5)
+        self.assertEqual(score, 5)
+        self.assertEqual(LeaderboardEntry.objects.get(user=self.user, leaderboard=self.leaderboard).score, 5)
+
+    def test_add_score_accumulates_on_existing_entry(self):
+        LeaderboardEntry.objects.add_score(self.user.id, self.leaderboard.id, 5)
+        score = LeaderboardEntry.objects.add_score(self.user.id, self.leaderboard.id, -8)
+        self.assertEqual(score, -3)
+        self.assertEqual(LeaderboardEntry.objects.filter(user=self.user, leaderboard=self.leaderboard).count(), 1)
+
+    def test_set_score_overwrites_entry(self):
+        LeaderboardEntry.objects.add_score(self.user.id, self.leaderboard.id, 5)
+        score = LeaderboardEntry.objects.set_score(self.user.id, self.leaderboard.id, 42)
+        self.assertEqual(score, 42)
+
+    def test_every_write_bumps_the_version(self):
+        LeaderboardEntry.objects.add_score(self.user.id, self.leaderboard.id, 5)
+        LeaderboardEntry.objects.set_score(self.user.id, self.leaderboard.id, 3)
+        self.assertEqual(LeaderboardEntry.objects.get().version, 2)
+
+    def test_duplicate_entries_are_rejected(self):
+        LeaderboardEntry.objects.create(user=self.user, leaderboard=self.leaderboard)
+        with self.assertRaises(IntegrityError):
+            LeaderboardEntry.objects.create(user=self.user, leaderboard=self.leaderboard)
+
+
+class LeaderboardScoreViewTests(TestCase):
+
+    def setUp(self):
+        self.user = TINETUser.objects.create(username='player', password='testpass')
+        self.app = AppAPIKey.objects.create(user=self.user, name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        self.leaderboard = Leaderboard.objects.create(title='Test board', app=self.app)
+
+    def post_score(self, route, count):
+        return self.client.post(
+            f'/api/v1/leaderboards/{route}',
+            json.dumps({'leaderboard_id': self.leaderboard.id, 'username': 'player', 'count': count}),
+            content_type='application/json',
+            HTTP_API_KEY='gamekey123'
+        )
+
+    def test_increment_decrement_and_set(self):
+        self.assertEqual(self.post_score('increment', 10).json()['score'], 10)
+        self.assertEqual(self.post_score('decrement', 3).json()['score'], 7)
+        self.assertEqual(self.post_score('set', 100).json()['score'], 100)
+
+    def test_decrement_creates_negative_entry(self):
+        self.assertEqual(self.post_score('decrement', 3).json()['score'], -3)
+
+
+class LeaderboardBatchViewTests(TestCase):
+
+    def setUp(self):
+        self.app = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        self.other_app = AppAPIKey.objects.create(name='Other', description='Another game', key_digest=digest_secret('otherkey123'))
+        self.leaderboard = Leaderboard.objects.create(title='Test board', app=self.app)
+        self.other_leaderboard = Leaderboard.objects.create(title='Other board', app=self.other_app)
+        TINETUser.objects.create(username='alice', password='testpass')
+        TINETUser.objects.create(username='bob', password='testpass')
+
+    def post_batch(self, operations):
+        return self.client.post(
+            '/api/v1/leaderboards/batch',
+            json.dumps({'operations': operations}),
+            content_type='application/json',
+            HTTP_API_KEY='gamekey123'
+        )
+
+    def test_batch_applies_operations_in_order(self):
+        response = self.post_batch([
+            {'leaderboard_id': self.leaderboard.id, 'username': 'alice', 'op': 'increment', 'count': 10},
+            {'leaderboard_id': self.leaderboard.id, 'username': 'bob', 'op': 'set', 'count': 50},
+            {'leaderboard_id': self.leaderboard.id, 'username': 'alice', 'op': 'decrement', 'count': 4},
+            {'leaderboard_id': self.leaderboard.id, 'username': 'bob', 'op': 'increment', 'count': 5},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['score'] for result in response.json()['results']], [6, 55, 6, 55])
+        scores = dict(LeaderboardEntry.objects.values_list('user__username', 'score'))
+        self.assertEqual(scores, {'alice': 6, 'bob': 55})
+
+    def test_batch_reports_invalid_operations(self):
+        results = self.post_batch([
+            {'leaderboard_id': self.other_leaderboard.id, 'username': 'alice', 'op': 'increment', 'count': 1},
+            {'leaderboard_id': self.leaderboard.id, 'username': 'nobody', 'op': 'increment', 'count': 1},
+            {'leaderboard_id': self.leaderboard.id, 'username': 'alice', 'op': 'multiply', 'count': 1},
+            {'leaderboard_id': self.leaderboard.id, 'username': 'alice', 'op': 'increment', 'count': 1},
+        ]).json()['results']
+        self.assertEqual([result['success'] for result in results], [False, False, False, True])
+        self.assertFalse(LeaderboardEntry.objects.filter(leaderboard=self.other_leaderboard).exists())
+
+
+class SQLRankingBackendTests(TestCase):
+
+    def setUp(self):
+        self.leaderboard = Leaderboard.objects.create(title='Test board')
+        self.users = [TINETUser.objects.create(username=f'player{i}', password='testpass') for i in range(5)]
+        for user, score in zip(self.users, [10, 50, 30, 30, 0]):
+            LeaderboardEntry.objects.set_score(user.id, self.leaderboard.id, score)
+        self.backend = SQLRankingBackend()
+
+    def test_top(self):
+        self.assertEqual(
+            self.backend.top(self.leaderboard.id, 3),
+            [(self.users[1].id, 50), (self.users[2].id, 30), (self.users[3].id, 30)]
+        )
+
+    def test_rank(self):
+        self.assertEqual(self.backend.rank(self.leaderboard.id, self.users[3].id), (3, 30))
+        self.assertIsNone(self.backend.rank(self.leaderboard.id, 0))
+
+    def test_around(self):
+        self.assertEqual(self.backend.around(self.leaderboard.id, self.users[0].id, 1), [
+            (3, self.users[3].id, 30), (4, self.users[0].id, 10), (5, self.users[4].id, 0)
+        ])
+
+
+@override_settings(LEADERBOARD_RANKING_BACKEND='leaderboards.ranking.InMemoryRankingBackend')
+class InMemoryRankingBackendTests(TestCase):
+
+    def setUp(self):
+        self.leaderboard = Leaderboard.objects.create(title='Test board')
+        self.alice = TINETUser.objects.create(username='alice', password='testpass')
+        self.bob = TINETUser.objects.create(username='bob', password='testpass')
+        LeaderboardEntry.objects.set_score(self.alice.id, self.leaderboard.id, 10)
+
+    def test_index_follows_score_mutations(self):
+        backend = get_ranking_backend()
+        self.assertEqual(backend.rank(self.leaderboard.id, self.alice.id), (1, 10))
+        with self.captureOnCommitCallbacks(execute=True):
+            LeaderboardEntry.objects.add_score(self.bob.id, self.leaderboard.id, 20)
+        self.assertEqual(backend.rank(self.leaderboard.id, self.alice.id), (2, 10))
+        with self.captureOnCommitCallbacks(execute=True):
+            LeaderboardEntry.objects.remove_score(self.bob.id, self.leaderboard.id)
+        self.assertEqual(backend.top(self.leaderboard.id, 10), [(self.alice.id, 10)])
+
+
+class RedisRankingBackendTests(TestCase):
+
+    def setUp(self):
+        self.leaderboard = Leaderboard.objects.create(title='Test board')
+        self.alice = TINETUser.objects.create(username='alice', password='testpass')
+        self.bob = TINETUser.objects.create(username='bob', password='testpass')
+        LeaderboardEntry.objects.set_score(self.alice.id, self.leaderboard.id, 10)
+        LeaderboardEntry.objects.set_score(self.bob.id, self.leaderboard.id, 5)
+        self.backend = RedisRankingBackend(fakeredis.FakeRedis())
+
+    def rebuild_with(self, write):
+        """Rebuilds the set, running write once the Postgres snapshot has been read."""
+        snapshot = RedisRankingBackend._snapshot
+
+        def snapshot_then_write(leaderboard_id):
+            entries = list(snapshot(leaderboard_id))
+            write()
+            return entries
+
+        with mock.patch.object(RedisRankingBackend, '_snapshot', side_effect=snapshot_then_write):
+            self.assertTrue(self.backend.rebuild(self.leaderboard.id))
+
+    def test_rank_is_built_on_first_read(self):
+        self.assertEqual(self.backend.rank(self.leaderboard.id, self.bob.id), (2, 5))
+        self.backend.update_scores(self.leaderboard.id, {self.bob.id: 20})
+        self.assertEqual(self.backend.rank(self.leaderboard.id, self.bob.id), (1, 20))
+
+    def test_writes_arriving_out_of_order_keep_the_newest_score(self):
+        self.assertEqual(self.backend.count(self.leaderboard.id), 2)
+        self.backend.update_scores(self.leaderboard.id, {self.bob.id: 30}, {self.bob.id: 3})
+        self.backend.update_scores(self.leaderboard.id, {self.bob.id: 20}, {self.bob.id: 2})
+        self.assertEqual(self.backend.rank(self.leaderboard.id, self.bob.id), (1, 30))
+
+    def test_write_older_than_the_snapshot_is_dropped(self):
+        with mock.patch('leaderboards.ranking.get_ranking_backend', return_value=self.backend):
+            with self.captureOnCommitCallbacks() as callbacks:
+                LeaderboardEntry.objects.add_score(self.bob.id, self.leaderboard.id, 10)
+            LeaderboardEntry.objects.add_score(self.bob.id, self.leaderboard.id, 10)
+        self.assertEqual(self.backend.count(self.leaderboard.id), 2)
+        # The first write's commit hook runs after the set was built from the second
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.backend.rank(self.leaderboard.id, self.bob.id), (1, 25))
+
+    def test_write_during_rebuild_is_kept(self):
+        self.assertEqual(self.backend.count(self.leaderboard.id), 2)
+        self.rebuild_with(lambda: self.backend.update_scores(self.leaderboard.id, {self.bob.id: 20}))
+        self.assertEqual(self.backend.rank(self.leaderboard.id, self.bob.id), (1, 20))
+
+    def test_write_during_first_build_is_kept(self):
+        self.rebuild_with(lambda: self.backend.update_scores(self.leaderboard.id, {self.bob.id: 20}))
+        self.assertEqual(self.backend.top(self.leaderboard.id, 2), [(self.bob.id, 20), (self.alice.id, 10)])
+
+    def test_removal_during_rebuild_is_kept(self):
+        self.rebuild_with(lambda: self.backend.remove_users(self.leaderboard.id, [self.bob.id]))
+        self.assertEqual(self.backend.top(self.leaderboard.id, 10), [(self.alice.id, 10)])
+
+    def test_reads_fall_back_to_sql_while_another_rebuild_runs(self):
+        self.backend.client.set(self.backend.keys(self.leaderboard.id)[1], 'other')
+        self.assertFalse(self.backend.rebuild(self.leaderboard.id))
+        self.assertEqual(self.backend.rank(self.leaderboard.id, self.bob.id), (2, 5))
+        self.assertFalse(self.backend.client.exists(self.backend.key(self.leaderboard.id)))
+
+    def test_rebuild_command_reports_skipped_leaderboards(self):
+        other = Leaderboard.objects.create(title='Other board')
+        self.backend.client.set(self.backend.keys(self.leaderboard.id)[1], 'other')
+        stdout = io.StringIO()
+        with mock.patch(
+            'leaderboards.management.commands.rebuild_leaderboard_rankings.get_ranking_backend',
+            return_value=self.backend
+        ):
+            with self.assertRaisesMessage(CommandError, f'Skipped leaderboards {self.leaderboard.id},'):
+                call_command('rebuild_leaderboard_rankings', self.leaderboard.id, other.id, stdout=stdout)
+        self.assertIn('Rebuilt 1 leaderboard rankings', stdout.getvalue())
+
+
+class LeaderboardRankViewTests(TestCase):
+
+    def setUp(self):
+        self.app = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        self.leaderboard = Leaderboard.objects.create(title='Test board', app=self.app)
+        for i in range(10):
+            user = TINETUser.objects.create(username=f'player{i}', password='testpass')
+            LeaderboardEntry.objects.set_score(user.id, self.leaderboard.id, i * 10)
+
+    def get(self, route, **params):
+        return self.client.get(
+            f'/api/v1/leaderboards/{route}',
+            {'leaderboard_id': self.leaderboard.id, **params},
+            HTTP_API_KEY='gamekey123'
+        )
+
+    def test_rank(self):
+        self.assertEqual(
+            self.get('rank', username='player6').json(),
+            {'success': True, 'rank': 4, 'score': 60, 'total': 10}
+        )
+
+    def test_rank_without_entry(self):
+        TINETUser.objects.create(username='newcomer', password='testpass')
+        self.assertEqual(self.get('rank', username='newcomer').status_code, 404)
+
+    def test_around(self):
+        entries = self.get('around', username='player1').json()['entries']
+        self.assertEqual([(entry['rank'], entry['username']) for entry in entries], [
+            (7, 'player3'), (8, 'player2'), (9, 'player1'), (10, 'player0')
+        ])
+
+
+@override_settings(
+    LEADERBOARD_SCORE_BUFFER='leaderboards.buffer.LocalScoreBuffer',
+    LEADERBOARD_BUFFER_FLUSH_INTERVAL=0
+)
+class WriteBehindLeaderboardTests(TestCase):
+
+    def setUp(self):
+        self.app = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        self.leaderboard = Leaderboard.objects.create(title='Hot board', app=self.app, write_behind=True)
+        self.user = TINETUser.objects.create(username='player', password='testpass')
+
+    def post_score(self, route, count):
+        return self.client.post(
+            f'/api/v1/leaderboards/{route}',
+            json.dumps({'leaderboard_id': self.leaderboard.id, 'username': 'player', 'count': count}),
+            content_type='application/json',
+            HTTP_API_KEY='gamekey123'
+        )
+
+    def test_increments_are_buffered_until_flushed(self):
+        self.assertEqual(self.post_score('increment', 10).json()['score'], 10)
+        self.assertEqual(self.post_score('increment', 5).json()['score'], 15)
+        self.assertFalse(LeaderboardEntry.objects.exists())
+        self.assertEqual(buffer_metrics()['depth'], 1)
+
+        self.assertEqual(flush_score_buffer(), 1)
+        self.assertEqual(LeaderboardEntry.objects.get().score, 15)
+        self.assertEqual(self.post_score('decrement', 3).json()['score'], 12)
+
+    def test_flush_during_increment_is_counted_once(self):
+        self.post_score('increment', 10)
+        add_many = LocalScoreBuffer.add_many
+
+        def add_then_flush(score_buffer, deltas, day):
+            add_many(score_buffer, deltas, day)
+            flush_score_buffer()
+
+        with mock.patch.object(LocalScoreBuffer, 'add_many', add_then_flush):
+            self.assertEqual(self.post_score('increment', 5).json()['score'], 15)
+        self.assertEqual(LeaderboardEntry.objects.get().score, 15)
+
+    def test_set_discards_buffered_deltas(self):
+        self.post_score('increment', 10)
+        self.assertEqual(self.post_score('set', 100).json()['score'], 100)
+        flush_score_buffer()
+        self.assertEqual(LeaderboardEntry.objects.get().score, 100)
+
+    def test_failed_flush_keeps_deltas_readable(self):
+        self.post_score('increment', 10)
+        with mock.patch.object(LeaderboardEntry.objects, 'bulk_add_scores', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                flush_score_buffer()
+        self.assertEqual(self.post_score('increment', 5).json()['score'], 15)
+        self.assertEqual(flush_score_buffer(), 1)
+        self.assertEqual(LeaderboardEntry.objects.get().score, 10)
+        self.assertEqual(flush_score_buffer(), 1)
+        self.assertEqual(LeaderboardEntry.objects.get().score, 15)
+
+    def test_set_discards_deltas_being_flushed(self):
+        self.post_score('increment', 10)
+        drain = LocalScoreBuffer.drain
+
+        def drain_then_set(score_buffer):
+            deltas = drain(score_buffer)
+            self.post_score('set', 100)
+            return deltas
+
+        with mock.patch.object(LocalScoreBuffer, 'drain', drain_then_set):
+            flush_score_buffer()
+        self.assertEqual(LeaderboardEntry.objects.get().score, 100)
+
+    def test_batch_committed_before_a_failed_complete_is_not_applied_again(self):
+        self.post_score('increment', 10)
+        with mock.patch.object(LocalScoreBuffer, 'complete', side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                flush_score_buffer()
+        self.assertEqual(LeaderboardEntry.objects.get().score, 10)
+        # The committed batch is still in flight but no longer counted on reads
+        self.assertEqual(self.post_score('increment', 5).json()['score'], 15)
+
+        self.assertEqual(flush_score_buffer(), 0)
+        self.assertEqual(LeaderboardEntry.objects.get().score, 10)
+        self.assertEqual(flush_score_buffer(), 1)
+        self.assertEqual(LeaderboardEntry.objects.get().score, 15)
+
+
+class RedisScoreBufferTests(TestCase):
+
+    def setUp(self):
+        self.buffer = RedisScoreBuffer(fakeredis.FakeRedis())
+        self.today = timezone.now().date()
+
+    def test_drained_deltas_stay_pending_until_complete(self):
+        self.buffer.add_many({(1, 1): 10, (2, 1): 3}, self.today)
+        batch_id, deltas, window_deltas = self.buffer.drain()
+        self.assertEqual(deltas, {(1, 1): 10, (2, 1): 3})
+        self.assertEqual(window_deltas, {(1, 1, self.today): 10, (2, 1, self.today): 3})
+        self.buffer.add_many({(1, 1): 5}, self.today)
+        self.assertEqual(
+            self.buffer.pending([(1, 1), (2, 1), (3, 1)]),
+            ({(1, 1): 5}, {(1, 1): 10, (2, 1): 3}, batch_id)
+        )
+
+        self.buffer.discard([(2, 1)])
+        self.assertEqual(self.buffer.flushing([(1, 1), (2, 1)]), {(1, 1): 10})
+        self.assertEqual(
+            self.buffer.flushing_windows([(1, 1, self.today), (2, 1, self.today)]),
+            {(1, 1, self.today): 10, (2, 1, self.today): 3}
+        )
+        self.buffer.discard([(2, 1)], windows=True)
+        self.assertEqual(self.buffer.flushing_windows([(2, 1, self.today)]), {})
+        self.buffer.complete()
+        self.assertEqual(self.buffer.pending([(1, 1), (2, 1)]), ({(1, 1): 5}, {}, None))
+
+    def test_unfinished_batch_is_drained_again(self):
+        self.buffer.add_many({(1, 1): 10}, self.today)
+        batch_id, _, _ = self.buffer.drain()
+        self.buffer.add_many({(1, 1): 5}, self.today)
+        self.assertEqual(self.buffer.drain(), (batch_id, {(1, 1): 10}, {(1, 1, self.today): 10}))
+        self.buffer.complete()
+        next_batch_id, deltas, window_deltas = self.buffer.drain()
+        self.assertNotEqual(next_batch_id, batch_id)
+        self.assertEqual((deltas, window_deltas), ({(1, 1): 5}, {(1, 1, self.today): 5}))
+        self.buffer.complete()
+        self.assertEqual(self.buffer.drain(), (None, {}, {}))
+
+    def test_window_deltas_keep_their_day(self):
+        yesterday = self.today - timedelta(days=1)
+        self.buffer.add_many({(1, 1): 10}, yesterday)
+        self.buffer.add_many({(1, 1): 5}, self.today)
+        _, deltas, window_deltas = self.buffer.drain()
+        self.assertEqual(deltas, {(1, 1): 15})
+        self.assertEqual(window_deltas, {(1, 1, yesterday): 10, (1, 1, self.today): 5})
+
+    def test_discarding_windows_drops_every_buffered_day_of_the_entry(self):
+        yesterday = self.today - timedelta(days=1)
+        self.buffer.add_many({(1, 1): 10, (2, 1): 1}, yesterday)
+        self.buffer.drain()
+        self.buffer.add_many({(1, 1): 5, (2, 1): 2}, self.today)
+        self.buffer.discard([(1, 1)], windows=True)
+        self.assertEqual(self.buffer.flushing_windows([(1, 1, yesterday), (2, 1, yesterday)]), {(2, 1, yesterday): 1})
+        self.buffer.complete()
+        self.assertEqual(self.buffer.drain()[2], {(2, 1, self.today): 2})
+
+
+class LeaderboardSnapshotViewTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.app = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        self.leaderboard = Leaderboard.objects.create(title='Test board', app=self.app)
+        self.user = TINETUser.objects.create(username='player', password='testpass')
+        LeaderboardEntry.objects.set_score(self.user.id, self.leaderboard.id, 10)
+
+    def get(self, **headers):
+        return self.client.get(f'/api/v1/leaderboards/{self.leaderboard.id}', HTTP_API_KEY='gamekey123', **headers)
+
+    def test_snapshot_and_conditional_get(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['entries'], [{'rank': 1, 'username': 'player', 'score': 10}])
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertFalse([query for query in queries if 'leaderboardentry' in query['sql']])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            LeaderboardEntry.objects.add_score(self.user.id, self.leaderboard.id, 5)
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['entries'][0]['score'], 15)
+
+
+class LiveLeaderboardTests(TestCase):
+
+    def setUp(self):
+        self.app = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        self.leaderboard = Leaderboard.objects.create(title='Live board', app=self.app)
+        self.user = TINETUser.objects.create(username='player', password='testpass')
+        LeaderboardEntry.objects.set_score(self.user.id, self.leaderboard.id, 10)
+
+    def add_scores(self, *deltas):
+        with self.captureOnCommitCallbacks(execute=True):
+            for delta in deltas:
+                LeaderboardEntry.objects.add_score(self.user.id, self.leaderboard.id, delta)
+
+    async def test_stream_receives_coalesced_updates(self):
+        response = await self.async_client.get(
+            f'/api/v1/leaderboards/{self.leaderboard.id}/events',
+            headers={'Api-Key': 'gamekey123'}
+        )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 3000\n\n')
+
+        await sync_to_async(self.add_scores)(5, 2)
+        event = await asyncio.wait_for(anext(stream), timeout=5)
+        await stream.aclose()
+
+        name, data = event.decode().split('\n')[:2]
+        self.assertEqual(name, 'event: scores')
+        self.assertEqual(json.loads(data.removeprefix('data: ')), {
+            'leaderboard_id': self.leaderboard.id,
+            'entries': [{'username': 'player', 'score': 17, 'rank': 1}],
+            'removed': []
+        })
+
+    def test_requires_asgi(self):
+        response = self.client.get(f'/api/v1/leaderboards/{self.leaderboard.id}/events', HTTP_API_KEY='gamekey123')
+        self.assertEqual(response.status_code, 503)
+
+    def test_slow_client_gets_refresh(self):
+        client = LiveClient()
+        for score in range(CLIENT_QUEUE_SIZE + 1):
+            client.push(('scores', {'score': score}))
+        self.assertEqual(client.queue.qsize(), 1)
+        self.assertEqual(client.queue.get_nowait(), REFRESH)
+
+
+@override_settings(LEADERBOARD_WINDOW_COMPACT_INTERVAL=0)
+class WindowedLeaderboardTests(TestCase):
+
+    def setUp(self):
+        self.app = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        self.leaderboard = Leaderboard.objects.create(
+            title='Windowed board', app=self.app, track_daily=True, track_weekly=True, track_season=True
+        )
+        TINETUser.objects.create(username='alice', password='testpass')
+        TINETUser.objects.create(username='bob', password='testpass')
+
+    def post_score(self, route, username, count):
+        return self.client.post(
+            f'/api/v1/leaderboards/{route}',
+            json.dumps({'leaderboard_id': self.leaderboard.id, 'username': username, 'count': count}),
+            content_type='application/json',
+            HTTP_API_KEY='gamekey123'
+        )
+
+    def get_window(self, window, **params):
+        return self.client.get(
+            '/api/v1/leaderboards/window',
+            {'leaderboard_id': self.leaderboard.id, 'window': window, **params},
+            HTTP_API_KEY='gamekey123'
+        ).json()
+
+    def test_mutations_update_every_window(self):
+        self.post_score('increment', 'alice', 10)
+        self.post_score('increment', 'bob', 30)
+        self.post_score('decrement', 'alice', 4)
+        for window in ('daily', 'weekly', 'season'):
+            entries = self.get_window(window)['entries']
+            self.assertEqual([(entry['username'], entry['score']) for entry in entries], [('bob', 30), ('alice', 6)])
+
+    def test_new_season_starts_empty_and_keeps_all_time_scores(self):
+        self.post_score('increment', 'alice', 10)
+        self.assertEqual(self.leaderboard.start_new_season(), 2)
+        self.post_score('increment', 'bob', 5)
+        season = self.get_window('season')
+        self.assertEqual(season['bucket'], 2)
+        self.assertEqual([entry['username'] for entry in season['entries']], ['bob'])
+        self.assertEqual([entry['username'] for entry in self.get_window('season', bucket=1)['entries']], ['alice'])
+        self.assertEqual(LeaderboardEntry.objects.count(), 2)
+
+    def test_compaction_drops_expired_buckets(self):
+        self.post_score('increment', 'alice', 10)
+        today = timezone.now().date()
+        LeaderboardWindowEntry.objects.filter(window='daily').update(bucket=today.toordinal() - 30)
+        self.leaderboard.start_new_season()
+        self.leaderboard.start_new_season()
+        self.assertEqual(compact_windows(), 2)
+        self.assertEqual(list(LeaderboardWindowEntry.objects.values_list('window', flat=True)), ['weekly'])
+
+    def test_set_adds_the_difference_to_windows(self):
+        self.post_score('increment', 'alice', 10)
+        yesterday = timezone.now().date() - timedelta(days=1)
+        LeaderboardWindowEntry.objects.filter(window='daily').update(bucket=yesterday.toordinal())
+        self.post_score('set', 'alice', 25)
+        self.assertEqual(self.get_window('daily')['entries'][0]['score'], 15)
+        self.assertEqual(self.get_window('weekly')['entries'][0]['score'], 25)
+        self.assertEqual(LeaderboardEntry.objects.get().score, 25)
+
+    @override_settings(
+        LEADERBOARD_SCORE_BUFFER='leaderboards.buffer.LocalScoreBuffer',
+        LEADERBOARD_BUFFER_FLUSH_INTERVAL=0
+    )
+    def test_buffered_deltas_land_in_the_bucket_of_their_day(self):
+        self.leaderboard.write_behind = True
+        self.leaderboard.save()
+        yesterday = timezone.now() - timedelta(days=1)
+        with mock.patch('leaderboards.buffer.timezone.now', return_value=yesterday):
+            self.post_score('increment', 'alice', 10)
+        self.post_score('increment', 'alice', 5)
+        self.post_score('increment', 'bob', 10)
+        self.post_score('set', 'bob', 25)
+        flush_score_buffer()
+
+        daily = self.get_window('daily', bucket=yesterday.date().isoformat())['entries']
+        self.assertEqual([(entry['username'], entry['score']) for entry in daily], [('alice', 10)])
+        daily = self.get_window('daily')['entries']
+        self.assertEqual([(entry['username'], entry['score']) for entry in daily], [('bob', 25), ('alice', 5)])
+        self.assertEqual(dict(LeaderboardEntry.objects.values_list('user__username', 'score')), {'alice': 15, 'bob': 25})
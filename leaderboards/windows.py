@@ -0,0 +1,112 @@
+import datetime
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import F, Q
+from django.dispatch import receiver
+from django.utils import timezone
+
+from leaderboards.models import LeaderboardWindowEntry, upsert_scores
+from tinetbackend.workers import PeriodicWorker
+
+DAILY = LeaderboardWindowEntry.DAILY
+WEEKLY = LeaderboardWindowEntry.WEEKLY
+SEASON = LeaderboardWindowEntry.SEASON
+
+COMPACT_BATCH_SIZE = 5000
+
+_compactor = None
+
+
+def get_compactor():
+    global _compactor
+    if _compactor is None:
+        _compactor = PeriodicWorker(
+            'leaderboard-window-compactor',
+            settings.LEADERBOARD_WINDOW_COMPACT_INTERVAL,
+            compact_windows
+        )
+    return _compactor
+
+
+@receiver(setting_changed)
+def reset_compactor(setting, **kwargs):
+    global _compactor
+    if setting == 'LEADERBOARD_WINDOW_COMPACT_INTERVAL':
+        _compactor = None
+
+
+def bucket_for(leaderboard, window, day=None):
+    """Returns the bucket of window that contains day (today by default)."""
+    day = day or timezone.now().date()
+    if window == DAILY:
+        return day.toordinal()
+    if window == WEEKLY:
+        return day.toordinal() - day.weekday()
+    return leaderboard.season
+
+
+def bucket_label(window, bucket):
+    if window == SEASON:
+        return bucket
+    return datetime.date.fromordinal(bucket).isoformat()
+
+
+def current_buckets(leaderboard, day=None):
+    """Returns {window: bucket containing day (today by default)} for every window the leaderboard tracks."""
+    tracked = {DAILY: leaderboard.track_daily, WEEKLY: leaderboard.track_weekly, SEASON: leaderboard.track_season}
+    return {window: bucket_for(leaderboard, window, day) for window, enabled in tracked.items() if enabled}
+
+
+def record_window_scores(leaderboards, deltas, day=None):
+    """
+    Adds {(user_id, leaderboard_id): delta} to the bucket containing day
+    (today by default) of every window tracked by those leaderboards. An
+    absolute write passes the difference to the previous all-time score.
+    leaderboards maps id to Leaderboard.
+    """
+    rows = {}
+    for (user_id, leaderboard_id), delta in deltas.items():
+        for window, bucket in current_buckets(leaderboards[leaderboard_id], day).items():
+            rows[(leaderboard_id, window, bucket, user_id)] = delta
+    if rows:
+        upsert_scores(
+            LeaderboardWindowEntry, LeaderboardWindowEntry.objects.db,
+            ['leaderboard_id', 'window', 'bucket', 'user_id'], rows, increment=True
+        )
+        get_compactor().ensure_started()
+
+
+def remove_window_scores(leaderboard, user_id):
+    buckets = current_buckets(leaderboard)
+    if buckets:
+        current = Q()
+        for window, bucket in buckets.items():
+            current |= Q(window=window, bucket=bucket)
+        LeaderboardWindowEntry.objects.filter(current, leaderboard=leaderboard, user_id=user_id).delete()
+
+
+def top_window_entries(leaderboard, window, bucket, count):
+    return list(
+        LeaderboardWindowEntry.objects
+        .filter(leaderboard=leaderboard, window=window, bucket=bucket)
+        .select_related('user')
+        .order_by('-score', 'id')[:count]
+    )
+
+
+def compact_windows():
+    """Deletes window buckets past their retention in bounded batches and returns how many rows went."""
+    retention = settings.LEADERBOARD_WINDOW_RETENTION
+    today = timezone.now().date()
+    stale = (
+        Q(window=DAILY, bucket__lte=today.toordinal() - retention[DAILY])
+        | Q(window=WEEKLY, bucket__lte=today.toordinal() - today.weekday() - 7 * retention[WEEKLY])
+        | Q(window=SEASON, bucket__lte=F('leaderboard__season') - retention[SEASON])
+    )
+    deleted = 0
+    while True:
+        ids = list(LeaderboardWindowEntry.objects.filter(stale).values_list('id', flat=True)[:COMPACT_BATCH_SIZE])
+        if not ids:
+            return deleted
+        LeaderboardWindowEntry.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
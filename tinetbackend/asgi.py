@@ -13,4 +13,6 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tinetbackend.settings')
 
-application = get_asgi_application()
+from tinetbackend.routing import ASGIRouter  # noqa: E402
+
+application = ASGIRouter(get_asgi_application())
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import math
+import threading
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import JsonResponse
+
+from tinetbackend.redis_client import get_redis, redis_errors
+
+logger = logging.getLogger(__name__)
+
+_local_buckets = None
+_redis_buckets = None
+
+
+class LocalTokenBuckets:
+    """Process-local buckets, used for tests and when Redis is not available."""
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        # key -> (tokens, last update, time the bucket is full again)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.next_sweep = 0
+
+    def take(self, key, rate, burst, now, cost=1):
+        with self.lock:
+            if now >= self.next_sweep:
+                self._sweep(now)
+            tokens, last, _ = self.buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= cost
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            return wait
+
+    def _sweep(self, now):
+        # A bucket that refilled is the same as a missing one, so idle keys go
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+        self.next_sweep = now + self.SWEEP_INTERVAL
+
+
+class RedisTokenBuckets:
+    """Buckets shared by every worker, each one a Redis hash updated atomically by a script."""
+
+    TAKE = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local cost = tonumber(ARGV[4])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local last = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+    local retry = 0
+    if tokens >= 1 then
+        tokens = tokens - cost
+    else
+        retry = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(retry)
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.take_script = client.register_script(self.TAKE)
+
+    def take(self, key, rate, burst, now, cost=1):
+        return float(self.take_script(keys=[key], args=[rate, burst, now, cost]))
+
+
+def get_redis_buckets():
+    """Returns the Redis buckets, or None when Redis is not configured."""
+    global _redis_buckets
+    client = get_redis()
+    if client is None:
+        return None
+    if _redis_buckets is None or _redis_buckets.client is not client:
+        _redis_buckets = RedisTokenBuckets(client)
+    return _redis_buckets
+
+
+def get_local_buckets():
+    global _local_buckets
+    if _local_buckets is None:
+        _local_buckets = LocalTokenBuckets()
+    return _local_buckets
+
+
+@receiver(setting_changed)
+def reset_local_buckets(setting, **kwargs):
+    global _local_buckets
+    if setting == 'RATE_LIMITS':
+        _local_buckets = None
+
+
+def _client_ip(request):
+    """
+    The address the outermost of the RATE_LIMIT_TRUSTED_PROXIES proxies saw.
+    Hops to the left of it are set by the client and prove nothing.
+    """
+    proxies = settings.RATE_LIMIT_TRUSTED_PROXIES
+    if proxies:
+        hops = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if hop.strip()]
+        if len(hops) >= proxies:
+            return hops[-proxies]
+    return request.META.get('REMOTE_ADDR')
+
+
+def _app(request):
+    api_key = request.headers.get('Api-Key')
+    if api_key:
+        return hashlib.sha256(api_key.encode()).hexdigest()[:32]
+
+
+def _user(request):
+    if request.content_type != 'application/json':
+        return None
+    try:
+        username = json.loads(request.body).get('username')
+    except (ValueError, AttributeError):
+        return None
+    return username if isinstance(username, str) else None
+
+
+IDENTITIES = {
+    'ip': _client_ip,
+    'app': _app,
+    'user': _user,
+}
+
+
+def retry_after(request, scope, identities=None, cost=1):
+    """
+    Takes cost tokens from every bucket of scope that applies to the request,
+    only those of identities when given, and returns 0 if all had one,
+    otherwise the seconds until the emptiest refills. A cost of 0 only checks.
+    No database access, only the bucket backend.
+    """
+    now = time.time()
+    redis_buckets = get_redis_buckets()
+    wait = 0
+    for identity, (rate, burst) in settings.RATE_LIMITS.get(scope, {}).items():
+        if identities is not None and identity not in identities:
+            continue
+        value = IDENTITIES[identity](request)
+        if value is None:
+            continue
+        key = f'tinet:ratelimit:{scope}:{identity}:{value}'
+        bucket_wait = None
+        if redis_buckets is not None:
+            try:
+                bucket_wait = redis_buckets.take(key, rate, burst, now, cost)
+            except redis_errors() as e:
+                logger.warning('Rate limiter falling back to local buckets: %s', e)
+        if bucket_wait is None:
+            bucket_wait = get_local_buckets().take(key, rate, burst, now, cost)
+        wait = max(wait, bucket_wait)
+    return wait
+
+
+def rate_limit(scope, failures_only=()):
+    """
+    Rejects requests with 429 once any bucket configured for scope in
+    RATE_LIMITS runs dry. The buckets of the identities in failures_only are
+    only charged for requests the view answers with an error, so nobody can
+    use up someone else's bucket with requests that succeed.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapped_view(request, *args, **kwargs):
+            charged = set(settings.RATE_LIMITS.get(scope, {})) - set(failures_only)
+            wait = max(
+                retry_after(request, scope, charged),
+                retry_after(request, scope, failures_only, cost=0)
+            )
+            if wait:
+                response = JsonResponse({
+                    'success': False,
+                    'error': 'Too many requests'
+                }, status=429)
+                response['Retry-After'] = str(math.ceil(wait))
+                return response
+            response = view_func(request, *args, **kwargs)
+            if failures_only and response.status_code >= 400:
+                retry_after(request, scope, failures_only)
+            return response
+        return wrapped_view
+    return decorator
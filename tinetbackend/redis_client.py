@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+_client = None
+
+
+def get_redis():
+    """Returns the shared Redis client, or None when Redis is not configured or not installed."""
+    global _client
+    if _client is None and redis is not None and settings.REDIS_URL:
+        _client = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _client
+
+
+def redis_errors():
+    """Exception types that mean Redis is unavailable and callers should fall back."""
+    if redis is None:
+        return ()
+    return redis.RedisError,
+
+
+@receiver(setting_changed)
+def reset_redis_client(setting, **kwargs):
+    global _client
+    if setting == 'REDIS_URL':
+        _client = None
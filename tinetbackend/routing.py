@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.exception import convert_exception_to_response
+from django.core.handlers.wsgi import WSGIHandler
+from django.urls import Resolver404, get_resolver
+from django.utils.module_loading import import_string
+
+
+def is_token_api_path(path):
+    """Returns whether path is one of the routes in TOKEN_API_URLCONF."""
+    try:
+        get_resolver(settings.TOKEN_API_URLCONF).resolve(path)
+    except Resolver404:
+        return False
+    return True
+
+
+class TokenAPIHandlerMixin:
+    """
+    Serves TOKEN_API_URLCONF through TOKEN_API_MIDDLEWARE instead of the
+    full MIDDLEWARE stack. Calculators and app servers authenticate every
+    request with a key or token, so sessions, CSRF, messages, waffle and
+    the account middleware are only overhead for them. CORS stays, apps
+    running in a browser call these routes too.
+    """
+
+    def load_middleware(self, is_async=False):
+        # Middleware allowed here has to work in both modes and have no view,
+        # template response or exception hooks, which spares this handler
+        # the adapting BaseHandler.load_middleware does for the full stack.
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._exception_middleware = []
+        get_response = self._get_response_async if is_async else self._get_response
+        handler = convert_exception_to_response(get_response)
+        for middleware_path in reversed(settings.TOKEN_API_MIDDLEWARE):
+            middleware = import_string(middleware_path)
+            hooks = ('process_view', 'process_template_response', 'process_exception')
+            if not getattr(middleware, 'async_capable', False) or any(hasattr(middleware, hook) for hook in hooks):
+                raise ImproperlyConfigured(f'{middleware_path} cannot be used in TOKEN_API_MIDDLEWARE')
+            handler = convert_exception_to_response(middleware(handler))
+        self._middleware_chain = handler
+
+    def resolve_request(self, request):
+        request.urlconf = settings.TOKEN_API_URLCONF
+        return super().resolve_request(request)
+
+
+class TokenAPIWSGIHandler(TokenAPIHandlerMixin, WSGIHandler):
+    pass
+
+
+class TokenAPIASGIHandler(TokenAPIHandlerMixin, ASGIHandler):
+    pass
+
+
+class WSGIRouter:
+    """Sends token API routes to their own lean handler and everything else to Django's."""
+
+    def __init__(self, application):
+        self.application = application
+        self.token_api_application = TokenAPIWSGIHandler()
+
+    def __call__(self, environ, start_response):
+        if is_token_api_path(environ.get('PATH_INFO', '')):
+            return self.token_api_application(environ, start_response)
+        return self.application(environ, start_response)
+
+
+class ASGIRouter:
+    """ASGI counterpart of WSGIRouter, websocket and lifespan scopes go to Django's handler."""
+
+    def __init__(self, application):
+        self.application = application
+        self.token_api_application = TokenAPIASGIHandler()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and is_token_api_path(scope['path']):
+            return await self.token_api_application(scope, receive, send)
+        return await self.application(scope, receive, send)
@@ -63,6 +63,14 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'tinetbackend.urls'
 
+# Calculator and app server routes, served by tinetbackend.routing through this chain alone
+TOKEN_API_URLCONF = 'API.token_urls'
+TOKEN_API_MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    # Browser-based apps call these routes cross-origin, and answers their preflight requests
+    'corsheaders.middleware.CorsMiddleware',
+]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -94,6 +102,80 @@ DATABASES = {
     }
 }
 
+REDIS_URL = os.environ.get("REDIS_URL", default=None) or None
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+
+LEADERBOARD_RANKING_BACKEND = os.environ.get(
+    "LEADERBOARD_RANKING_BACKEND",
+    default='leaderboards.ranking.RedisRankingBackend' if REDIS_URL else 'leaderboards.ranking.SQLRankingBackend'
+)
+
+LEADERBOARD_SCORE_BUFFER = os.environ.get(
+    "LEADERBOARD_SCORE_BUFFER",
+    default='leaderboards.buffer.RedisScoreBuffer' if REDIS_URL else 'leaderboards.buffer.LocalScoreBuffer'
+)
+LEADERBOARD_BUFFER_FLUSH_INTERVAL = float(os.environ.get("LEADERBOARD_BUFFER_FLUSH_INTERVAL", default=1))
+
+# Number of buckets kept per window, the current one included
+LEADERBOARD_WINDOW_RETENTION = {
+    'daily': int(os.environ.get("LEADERBOARD_DAILY_RETENTION", default=14)),
+    'weekly': int(os.environ.get("LEADERBOARD_WEEKLY_RETENTION", default=8)),
+    'season': int(os.environ.get("LEADERBOARD_SEASON_RETENTION", default=2)),
+}
+LEADERBOARD_WINDOW_COMPACT_INTERVAL = float(os.environ.get("LEADERBOARD_WINDOW_COMPACT_INTERVAL", default=3600))
+
+APP_API_KEY_CACHE_TIMEOUT = int(os.environ.get("APP_API_KEY_CACHE_TIMEOUT", default=300))
+# last_used is written at most once per key per interval
+APP_API_KEY_LAST_USED_INTERVAL = int(os.environ.get("APP_API_KEY_LAST_USED_INTERVAL", default=60))
+
+ALLOWED_APP_CACHE_TIMEOUT = int(os.environ.get("ALLOWED_APP_CACHE_TIMEOUT", default=300))
+
+# 'signed' tokens are checked without a database query, 'database' ones are stored as SessionToken rows
+CALC_SESSION_TOKENS = os.environ.get("CALC_SESSION_TOKENS", default='signed')
+CALC_SESSION_LIFETIME = int(os.environ.get("CALC_SESSION_LIFETIME", default=12 * 3600))
+
+# PEM private keys (EC P-256) signing app access tokens, the first one signs and all are
+# published. App access tokens are disabled when none are configured.
+APP_TOKEN_SIGNING_KEYS = [
+    open(path).read() for path in os.environ.get("APP_TOKEN_SIGNING_KEY_FILES", default="").split(",") if path
+]
+APP_TOKEN_ISSUER = os.environ.get("APP_TOKEN_ISSUER", default="https://tinet.tkbstudios.com")
+APP_TOKEN_LIFETIME = int(os.environ.get("APP_TOKEN_LIFETIME", default=300))
+
+# Reverse proxies in front of the app, the address the outermost one saw in
+# X-Forwarded-For identifies the client. 0 uses REMOTE_ADDR.
+RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get("RATE_LIMIT_TRUSTED_PROXIES", default=1))
+
+# Token buckets per route scope and client identity: (tokens refilled per second, bucket size)
+# The calc_auth user bucket only counts failed attempts, see API/urls.py
+RATE_LIMITS = {
+    'calc_auth': {'ip': (1, 30), 'user': (0.2, 10)},
+    'session_check': {'ip': (10, 100), 'app': (50, 500)},
+    'leaderboard_write': {'ip': (20, 200), 'app': (100, 1000)},
+}
+
+USERS_JANITOR_INTERVAL = float(os.environ.get("USERS_JANITOR_INTERVAL", default=3600))
+
+# Audit entries are queued and written in batches, an interval of 0 writes each one synchronously
+AUDIT_LOG_QUEUE = os.environ.get(
+    "AUDIT_LOG_QUEUE",
+    default='users.audit.RedisAuditQueue' if REDIS_URL else 'users.audit.LocalAuditQueue'
+)
+AUDIT_LOG_FLUSH_INTERVAL = float(os.environ.get("AUDIT_LOG_FLUSH_INTERVAL", default=2))
+AUDIT_LOG_FLUSH_SIZE = int(os.environ.get("AUDIT_LOG_FLUSH_SIZE", default=500))
+
+# Audit entries older than this are moved to compressed archive segments, kept on
+# local disk under AUDIT_ARCHIVE_DIR if set, otherwise in the audit archive bucket
+AUDIT_RETENTION_DAYS = int(os.environ.get("AUDIT_RETENTION_DAYS", default=90))
+AUDIT_ARCHIVE_DIR = os.environ.get("AUDIT_ARCHIVE_DIR", default=None) or None
+
 AUTH_USER_MODEL = "users.TINETUser"
 
 AUTH_PASSWORD_VALIDATORS = [
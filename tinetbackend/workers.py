@@ -0,0 +1,60 @@
+import atexit
+import logging
+import threading
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicWorker:
+    """
+    Runs func every interval seconds on a daemon thread, and one last time
+    when the interpreter shuts down so buffered work is not lost on a
+    graceful gunicorn restart. Started lazily by whoever first needs it.
+    """
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def wake(self):
+        """Runs func as soon as possible instead of at the end of the current interval."""
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.interval + 5)
+        self._run_once()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self._run_once()
+
+    def _run_once(self):
+        close_old_connections()
+        try:
+            self.func()
+        except Exception:
+            logger.exception('%s failed', self.name)
+        finally:
+            close_old_connections()
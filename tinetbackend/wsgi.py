@@ -13,4 +13,6 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tinetbackend.settings')
 
-application = get_wsgi_application()
+from tinetbackend.routing import WSGIRouter  # noqa: E402
+
+application = WSGIRouter(get_wsgi_application())
@@ -20,24 +20,25 @@ class CustomUserAdmin(BaseUserAdmin):
 
     fieldsets = (
         (None, {'fields': ('username', 'password')}),
-        ('Personal info', {'fields': ('first_name', 'last_name', 'email', 'bio', 'calc_key', 'api_key')}),
+        ('Personal info', {'fields': ('first_name', 'last_name', 'email', 'bio', 'calc_key_prefix', 'api_key_prefix')}),
         ('Permissions', {'fields': ('is_active', 'is_staff', 'is_superuser', 'groups', 'user_permissions')}),
         ('Important dates', {'fields': ('last_login', 'date_joined')}),
     )
+    readonly_fields = ('calc_key_prefix', 'api_key_prefix')
     list_display = ('username', 'email', 'first_name', 'last_name', 'is_staff')
-    search_fields = ('username', 'email', 'first_name', 'last_name')
+    search_fields = ('username', 'email', 'first_name', 'last_name', 'api_key_prefix', 'calc_key_prefix')
     ordering = ('username',)
 
 
 class SessionTokenAdmin(admin.ModelAdmin):
-    list_display = ('user', 'token', 'expiry_date', 'expired')
-    search_fields = ('user__username', 'token')
+    list_display = ('user', 'expiry_date', 'expired')
+    search_fields = ('user__username',)
     list_filter = ('expired',)
 
 
 class AppAPIKeyAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'name', 'key', 'expires', 'last_used', 'expired')
-    search_fields = ('id', 'user__username', 'name', 'key')
+    list_display = ('id', 'user', 'name', 'expires', 'last_used', 'expired')
+    search_fields = ('id', 'user__username', 'name')
     list_filter = ('id', 'expired', 'expires')
 
 
@@ -0,0 +1,125 @@
+import base64
+import hashlib
+import json
+import logging
+import secrets
+import time
+import jwt
+from cryptography.hazmat.primitives import serialization
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from tinetbackend.redis_client import get_redis, redis_errors
+from users.models import AllowedApp
+
+logger = logging.getLogger(__name__)
+
+ALGORITHM = 'ES256'
+
+_signing_keys = None
+
+
+def get_signing_keys():
+    """
+    Returns [(kid, private key)] loaded from APP_TOKEN_SIGNING_KEYS. The first
+    key signs new tokens, the others are still published so tokens signed
+    before a rotation verify until they expire.
+    """
+    global _signing_keys
+    if _signing_keys is None:
+        _signing_keys = []
+        for pem in settings.APP_TOKEN_SIGNING_KEYS:
+            private_key = serialization.load_pem_private_key(pem.encode(), password=None)
+            public_der = private_key.public_key().public_bytes(
+                serialization.Encoding.DER,
+                serialization.PublicFormat.SubjectPublicKeyInfo
+            )
+            kid = base64.urlsafe_b64encode(hashlib.sha256(public_der).digest()[:12]).decode()
+            _signing_keys.append((kid, private_key))
+    return _signing_keys
+
+
+@receiver(setting_changed)
+def reset_signing_keys(setting, **kwargs):
+    global _signing_keys
+    if setting == 'APP_TOKEN_SIGNING_KEYS':
+        _signing_keys = None
+
+
+def app_tokens_enabled():
+    return bool(get_signing_keys())
+
+
+def issue_app_token(user, allowed_app):
+    """Returns a signed access token for user under their AllowedApp grant, valid for that app only."""
+    kid, private_key = get_signing_keys()[0]
+    now = int(time.time())
+    claims = {
+        'iss': settings.APP_TOKEN_ISSUER,
+        'sub': str(user.id),
+        'aud': str(allowed_app.app_id),
+        'iat': now,
+        'exp': now + settings.APP_TOKEN_LIFETIME,
+        'jti': secrets.token_urlsafe(12),
+        'grant': allowed_app.allow_id,
+        'username': user.username,
+    }
+    return jwt.encode(claims, private_key, algorithm=ALGORITHM, headers={'kid': kid})
+
+
+def jwks():
+    keys = []
+    for kid, private_key in get_signing_keys():
+        jwk = jwt.algorithms.ECAlgorithm.to_jwk(private_key.public_key(), as_dict=True)
+        jwk.update({'kid': kid, 'alg': ALGORITHM, 'use': 'sig'})
+        keys.append(jwk)
+    return {'keys': keys}
+
+
+def _revoked_key(app_id):
+    return f'tinet:app:{app_id}:revoked-grants'
+
+
+def revoked_grants(app_id):
+    """
+    Returns the grants of an app revoked within the last token lifetime, as
+    [{'grant', 'sub', 'revoked_at'}]. Older revocations need no listing since
+    every token issued for them has expired.
+    """
+    horizon = time.time() - settings.APP_TOKEN_LIFETIME
+    client = get_redis()
+    if client is not None:
+        try:
+            members = client.zrangebyscore(_revoked_key(app_id), f'({horizon}', '+inf', withscores=True)
+            return [{**json.loads(member), 'revoked_at': int(revoked_at)} for member, revoked_at in members]
+        except redis_errors() as e:
+            logger.warning('Could not read revoked grants of app %s: %s', app_id, e)
+    return [entry for entry in cache.get(_revoked_key(app_id), []) if entry['revoked_at'] > horizon]
+
+
+@receiver(post_delete, sender=AllowedApp)
+def record_revoked_grant(sender, instance, **kwargs):
+    if instance.app_id is None:
+        return
+    key = _revoked_key(instance.app_id)
+    entry = {'grant': instance.allow_id, 'sub': str(instance.user_id)}
+    revoked_at = int(time.time())
+    client = get_redis()
+    if client is not None:
+        # One sorted set scored by revocation time, so concurrent revocations
+        # of the same app never overwrite each other.
+        try:
+            pipeline = client.pipeline()
+            pipeline.zadd(key, {json.dumps(entry): revoked_at})
+            pipeline.zremrangebyscore(key, '-inf', revoked_at - settings.APP_TOKEN_LIFETIME)
+            pipeline.expire(key, settings.APP_TOKEN_LIFETIME)
+            pipeline.execute()
+            return
+        except redis_errors() as e:
+            logger.warning('Could not record revoked grant %s: %s', instance.allow_id, e)
+    entries = revoked_grants(instance.app_id)
+    entries.append({**entry, 'revoked_at': revoked_at})
+    cache.set(key, entries, timeout=settings.APP_TOKEN_LIFETIME)
@@ -0,0 +1,289 @@
+import ipaddress
+import json
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import F, Q
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from tinetbackend.redis_client import get_redis, redis_errors
+from tinetbackend.workers import PeriodicWorker
+from users.models import AllowedApp, AllowedAppAuditEntry, AuditEntry
+
+logger = logging.getLogger(__name__)
+
+FLUSH_CHUNK_SIZE = 1000
+MAX_FLUSH_ATTEMPTS = 5
+PAGE_SIZE = 50
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+# Cursor position among the entries without a created_at, which come last
+LEGACY_CURSOR = 'legacy'
+
+_queue = None
+_flusher = None
+
+
+def get_audit_queue():
+    """Returns the audit queue configured by AUDIT_LOG_QUEUE."""
+    global _queue
+    if _queue is None:
+        _queue = import_string(settings.AUDIT_LOG_QUEUE)()
+    return _queue
+
+
+def get_flusher():
+    global _flusher
+    if _flusher is None:
+        _flusher = PeriodicWorker('audit-log-flusher', settings.AUDIT_LOG_FLUSH_INTERVAL, flush_audit_queue)
+    return _flusher
+
+
+@receiver(setting_changed)
+def reset_audit_queue(setting, **kwargs):
+    global _queue, _flusher
+    if setting in ('AUDIT_LOG_QUEUE', 'AUDIT_LOG_FLUSH_INTERVAL', 'REDIS_URL'):
+        _queue = None
+        _flusher = None
+
+
+def record_audit_entry(action, ip, username):
+    _record({'action': action, 'ip': ip, 'username': username})
+
+
+def record_app_audit_entry(action, ip, username, allowed_app_id):
+    _record({'action': action, 'ip': ip, 'username': username, 'allowed_app_id': allowed_app_id})
+
+
+def _record(entry):
+    """
+    Queues an audit entry for the flusher, which writes a batch once
+    AUDIT_LOG_FLUSH_SIZE entries are waiting or every AUDIT_LOG_FLUSH_INTERVAL
+    seconds. An interval of 0 writes the entry right away, and so does an
+    unreachable queue.
+    """
+    entry['ip'] = _valid_ip(entry['ip'])
+    # Stamped now rather than when the batch is written
+    entry['created_at'] = timezone.now().isoformat()
+    if settings.AUDIT_LOG_FLUSH_INTERVAL <= 0:
+        write_audit_entries([entry])
+        return
+    try:
+        depth = get_audit_queue().append(entry)
+    except redis_errors() as e:
+        logger.warning('Audit queue unavailable, writing through: %s', e)
+        write_audit_entries([entry])
+        return
+    flusher = get_flusher()
+    flusher.ensure_started()
+    if depth >= settings.AUDIT_LOG_FLUSH_SIZE:
+        flusher.wake()
+
+
+def _valid_ip(ip):
+    # X-Forwarded-For is client controlled, and one bad address would fail a whole batch
+    try:
+        return str(ipaddress.ip_address(ip.strip()))
+    except (AttributeError, ValueError):
+        return None
+
+
+def flush_audit_queue():
+    """
+    Writes every queued audit entry and returns how many were written.
+    Entries leave the queue only once their batch is committed, so a crash
+    mid-flush writes some of them twice rather than losing them. A batch that
+    fails MAX_FLUSH_ATTEMPTS times in a row is moved to the dead letter queue
+    so it stops blocking the entries behind it.
+    """
+    audit_queue = get_audit_queue()
+    written = 0
+    while True:
+        # Taken per batch, so a lock never has to outlive one bulk insert
+        lock = audit_queue.flush_lock()
+        if not lock.acquire(blocking=False):
+            return written
+        try:
+            entries = audit_queue.peek(FLUSH_CHUNK_SIZE)
+            if entries:
+                try:
+                    write_audit_entries(entries)
+                except Exception:
+                    if audit_queue.record_failure() < MAX_FLUSH_ATTEMPTS:
+                        raise
+                    logger.exception('Moving %d audit entries to the dead letter queue', len(entries))
+                    audit_queue.dead_letter(len(entries))
+                else:
+                    audit_queue.remove(len(entries))
+                    written += len(entries)
+        finally:
+            lock.release()
+        if len(entries) < FLUSH_CHUNK_SIZE:
+            return written
+
+
+def write_audit_entries(entries):
+    app_entries = [entry for entry in entries if 'allowed_app_id' in entry]
+    # Entries of grants revoked since they were queued go the way of the
+    # grant's other entries, which were deleted along with it.
+    existing_grants = set(AllowedApp.objects.filter(
+        allow_id__in={entry['allowed_app_id'] for entry in app_entries}
+    ).values_list('allow_id', flat=True)) if app_entries else set()
+    with transaction.atomic():
+        AuditEntry.objects.bulk_create([
+            AuditEntry(**entry) for entry in entries if 'allowed_app_id' not in entry
+        ])
+        AllowedAppAuditEntry.objects.bulk_create([
+            AllowedAppAuditEntry(**entry) for entry in app_entries if entry['allowed_app_id'] in existing_grants
+        ])
+
+
+def audit_history(username, cursor=None, page_size=PAGE_SIZE):
+    """
+    Returns (entries, next cursor) for one page of a user's audit entries,
+    newest first, starting after cursor. The cursor is None on the last
+    page. Pages are read by keyset on the (username, created_at, id) index,
+    so every page costs the same however long the history is. Entries
+    without a created_at come last. Raises ValueError for a malformed cursor.
+    """
+    entries = AuditEntry.objects.filter(username=username)
+    dated = entries.filter(created_at__isnull=False).order_by(F('created_at').desc(nulls_last=True), '-id')
+    legacy = entries.filter(created_at__isnull=True).order_by('-id')
+    created_at = entry_id = None
+    if cursor:
+        created_at, entry_id = _decode_cursor(cursor)
+    if cursor and created_at is None:
+        page = list(legacy.filter(id__lt=entry_id)[:page_size + 1])
+    else:
+        if cursor:
+            # The created_at__lte bound is redundant but gives the index a range to start from
+            dated = dated.filter(created_at__lte=created_at).filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=entry_id)
+            )
+        page = list(dated[:page_size + 1])
+        if len(page) <= page_size:
+            page += list(legacy[:page_size + 1 - len(page)])
+    if len(page) <= page_size:
+        return page, None
+    page = page[:page_size]
+    return page, _encode_cursor(page[-1])
+
+
+def _encode_cursor(entry):
+    if entry.created_at is None:
+        return f'{LEGACY_CURSOR}-{entry.id}'
+    return f'{(entry.created_at - EPOCH) // timedelta(microseconds=1)}-{entry.id}'
+
+
+def _decode_cursor(cursor):
+    microseconds, entry_id = cursor.split('-')
+    if microseconds == LEGACY_CURSOR:
+        return None, int(entry_id)
+    try:
+        return EPOCH + timedelta(microseconds=int(microseconds)), int(entry_id)
+    except OverflowError:
+        raise ValueError(f'Invalid audit cursor: {cursor}')
+
+
+class LocalAuditQueue:
+    """
+    Process-local queue, for development or a single worker. Flushed one last
+    time at exit. Dead-lettered entries are logged in full so they can be
+    replayed from the logs.
+    """
+
+    def __init__(self):
+        self.entries = deque()
+        self.failures = 0
+        self.lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def append(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+            return len(self.entries)
+
+    def peek(self, count):
+        with self.lock:
+            return [self.entries[index] for index in range(min(count, len(self.entries)))]
+
+    def remove(self, count):
+        with self.lock:
+            for _ in range(count):
+                self.entries.popleft()
+            self.failures = 0
+
+    def record_failure(self):
+        """Counts a failed write of the head of the queue and returns how many happened in a row."""
+        with self.lock:
+            self.failures += 1
+            return self.failures
+
+    def dead_letter(self, count):
+        with self.lock:
+            for _ in range(count):
+                logger.error('Dead-lettered audit entry: %s', json.dumps(self.entries.popleft()))
+            self.failures = 0
+
+    def flush_lock(self):
+        return self._flush_lock
+
+    def depth(self):
+        return len(self.entries)
+
+
+class RedisAuditQueue:
+    """
+    Queue shared by every worker, kept in one Redis list of JSON entries.
+    Whichever worker holds the flush lock writes the head of the list and
+    then trims it, the others skip their turn. Batches that keep failing are
+    moved to DEAD_LETTER_KEY for an operator to look at.
+    """
+    KEY = 'tinet:audit:queue'
+    DEAD_LETTER_KEY = f'{KEY}:dead'
+    FAILURES_KEY = f'{KEY}:failures'
+    FLUSH_LOCK_TIMEOUT = 60
+
+    DEAD_LETTER = """
+    local entries = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    if #entries > 0 then
+        redis.call('RPUSH', KEYS[2], unpack(entries))
+        redis.call('LTRIM', KEYS[1], #entries, -1)
+    end
+    redis.call('DEL', KEYS[3])
+    return #entries
+    """
+
+    def __init__(self, client=None):
+        self.client = client or get_redis()
+        self._dead_letter = self.client.register_script(self.DEAD_LETTER)
+
+    def append(self, entry):
+        return self.client.rpush(self.KEY, json.dumps(entry))
+
+    def peek(self, count):
+        return [json.loads(entry) for entry in self.client.lrange(self.KEY, 0, count - 1)]
+
+    def remove(self, count):
+        pipeline = self.client.pipeline()
+        pipeline.ltrim(self.KEY, count, -1)
+        pipeline.delete(self.FAILURES_KEY)
+        pipeline.execute()
+
+    def record_failure(self):
+        """Counts a failed write of the head of the queue and returns how many happened in a row."""
+        return self.client.incr(self.FAILURES_KEY)
+
+    def dead_letter(self, count):
+        self._dead_letter(keys=[self.KEY, self.DEAD_LETTER_KEY, self.FAILURES_KEY], args=[count])
+
+    def flush_lock(self):
+        return self.client.lock(f'{self.KEY}:flush', timeout=self.FLUSH_LOCK_TIMEOUT)
+
+    def depth(self):
+        return self.client.llen(self.KEY)
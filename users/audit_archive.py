@@ -0,0 +1,167 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from collections import defaultdict
+from datetime import date, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+
+from users.models import AllowedAppAuditEntry, AuditEntry
+
+BATCH_SIZE = 5000
+# Segments are split by a hash of the username so a lookup for one user only
+# has to read one in USER_BUCKETS of the segments of a day.
+USER_BUCKETS = 16
+ROOT = 'audit'
+LOCK_KEY = 'tinet:audit:archive-lock'
+LOCK_TIMEOUT = 3600
+# Entries written before created_at was recorded are archived under this day
+LEGACY_DAY = date(1970, 1, 1)
+
+TABLES = {
+    'user': (AuditEntry, ('id', 'action', 'ip', 'username', 'created_at')),
+    'app': (AllowedAppAuditEntry, ('id', 'action', 'ip', 'username', 'created_at', 'allowed_app_id')),
+}
+
+
+def get_archive_storage():
+    if settings.AUDIT_ARCHIVE_DIR:
+        return FileSystemStorage(location=settings.AUDIT_ARCHIVE_DIR)
+    from API.storages import TINETAuditArchiveStorage
+    return TINETAuditArchiveStorage()
+
+
+def user_bucket(username):
+    return hashlib.sha256((username or '').encode()).digest()[0] % USER_BUCKETS
+
+
+def archive_audit_entries(max_batches=None, include_legacy=False):
+    """
+    Moves audit rows older than AUDIT_RETENTION_DAYS into archive segments,
+    BATCH_SIZE rows at a time, and returns {table: rows moved}. Rows without
+    a created_at stay in the database unless include_legacy is set. Rows are
+    deleted only once their segments and manifests are stored, and a batch
+    retried after a crash rewrites the same segments.
+    """
+    if not cache.add(LOCK_KEY, True, timeout=LOCK_TIMEOUT):
+        return {table: 0 for table in TABLES}
+    try:
+        cutoff = timezone.now() - timedelta(days=settings.AUDIT_RETENTION_DAYS)
+        storage = get_archive_storage()
+        archived = Q(created_at__lt=cutoff)
+        if include_legacy:
+            archived |= Q(created_at__isnull=True)
+        moved = {}
+        for table, (model, fields) in TABLES.items():
+            moved[table] = 0
+            batches = 0
+            while max_batches is None or batches < max_batches:
+                rows = list(
+                    model.objects.filter(archived)
+                    .order_by('id').values(*fields)[:BATCH_SIZE]
+                )
+                if not rows:
+                    break
+                _write_segments(storage, table, rows)
+                model.objects.filter(id__in=[row['id'] for row in rows]).delete()
+                moved[table] += len(rows)
+                batches += 1
+        return moved
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def _write_segments(storage, table, rows):
+    segments = defaultdict(list)
+    for row in rows:
+        day = row['created_at'].astimezone(dt_timezone.utc).date() if row['created_at'] else LEGACY_DAY
+        segments[(day, user_bucket(row['username']))].append(row)
+
+    new_segments = defaultdict(list)
+    for (day, bucket), segment_rows in segments.items():
+        name = f'{ROOT}/{day.isoformat()}/{table}-{bucket:02d}-{segment_rows[0]["id"]}.ndjson.gz'
+        lines = ''.join(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in segment_rows)
+        _store(storage, name, gzip.compress(lines.encode()))
+        new_segments[day].append({
+            'name': name,
+            'table': table,
+            'bucket': bucket,
+            'rows': len(segment_rows),
+            'first_id': segment_rows[0]['id'],
+            'last_id': segment_rows[-1]['id'],
+        })
+
+    for day, day_segments in new_segments.items():
+        manifest = read_manifest(storage, day)
+        known = {segment['name'] for segment in manifest['segments']}
+        manifest['segments'] += [segment for segment in day_segments if segment['name'] not in known]
+        _store(storage, _manifest_name(day), json.dumps(manifest).encode())
+
+
+def _store(storage, name, content):
+    """Replaces name with content, the previous copy stays readable until the new one is complete."""
+    if not isinstance(storage, FileSystemStorage):
+        # S3 replaces the object in one PUT, TINETAuditArchiveStorage overwrites in place
+        storage.save(name, ContentFile(content))
+        return
+    # FileSystemStorage would save under a new name rather than replace
+    path = storage.path(name)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as temporary:
+        temporary.write(content)
+        temporary.flush()
+        os.fsync(temporary.fileno())
+    if storage.file_permissions_mode is not None:
+        os.chmod(temporary.name, storage.file_permissions_mode)
+    os.replace(temporary.name, path)
+
+
+def _manifest_name(day):
+    return f'{ROOT}/{day.isoformat()}/manifest.json'
+
+
+def read_manifest(storage, day):
+    """Returns the manifest of a day, {'segments': [{name, table, bucket, rows, first_id, last_id}]}."""
+    name = _manifest_name(day)
+    if not storage.exists(name):
+        return {'segments': []}
+    with storage.open(name) as manifest:
+        return json.load(manifest)
+
+
+def archived_days(storage):
+    try:
+        directories, _ = storage.listdir(ROOT)
+    except FileNotFoundError:
+        return []
+    return sorted(date.fromisoformat(directory) for directory in directories)
+
+
+def read_archived_entries(username, since=None, until=None):
+    """
+    Yields the archived audit rows of username as dicts with a 'table' key,
+    day by day from since to until (dates, both included). Segments are
+    decompressed as they are read, so memory use does not grow with the
+    size of the archive.
+    """
+    storage = get_archive_storage()
+    bucket = user_bucket(username)
+    for day in archived_days(storage):
+        if (since and day < since) or (until and day > until):
+            continue
+        for segment in read_manifest(storage, day)['segments']:
+            if segment['bucket'] != bucket:
+                continue
+            with storage.open(segment['name']) as compressed, gzip.open(compressed, 'rt') as lines:
+                for line in lines:
+                    row = json.loads(line)
+                    if row['username'] == username:
+                        yield {'table': segment['table'], **row}
@@ -0,0 +1,130 @@
+import time
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from users.janitor import get_janitor
+from users.models import SessionToken, TINETUser, digest_secret
+
+SALT = 'users.calc-session'
+GENERATION_TIMEOUT = 3600
+
+
+VALID = 'valid'
+EXPIRED = 'expired'
+INVALID = 'invalid'
+
+
+class SessionExpired(Exception):
+    pass
+
+
+def _generation_key(user_id):
+    return f'tinet:user:{user_id}:session-generation'
+
+
+def get_session_generations(user_ids):
+    """Returns {user_id: current session generation}, from the cache when possible. Unknown users are left out."""
+    keys = {_generation_key(user_id): user_id for user_id in user_ids}
+    generations = {keys[key]: generation for key, generation in cache.get_many(keys).items()}
+    missing = set(user_ids) - generations.keys()
+    if missing:
+        loaded = dict(TINETUser.objects.filter(id__in=missing).values_list('id', 'session_generation'))
+        for user_id, generation in loaded.items():
+            # Never overwrites the generation stored by expire_all_sessions after this was read
+            cache.add(_generation_key(user_id), generation, timeout=GENERATION_TIMEOUT)
+        generations.update(loaded)
+    return generations
+
+
+def issue_session_token(user):
+    """Returns a new calc session token for user, in the format set by CALC_SESSION_TOKENS."""
+    # Whatever the format, the janitor also expires app keys and drops orphan app audit entries
+    get_janitor().ensure_started()
+    if settings.CALC_SESSION_TOKENS == 'database':
+        _, token = SessionToken.create_token(user)
+        return token
+    expires = int(time.time() + settings.CALC_SESSION_LIFETIME)
+    payload = [user.id, user.username, expires, get_session_generations([user.id])[user.id]]
+    return signing.Signer(salt=SALT).sign_object(payload)
+
+
+def check_session_token(token):
+    """
+    Returns (user_id, username) for a valid calc session token. Raises
+    SessionToken.DoesNotExist for unknown or forged tokens and SessionExpired
+    for expired or revoked ones.
+    """
+    if not isinstance(token, str):
+        raise SessionToken.DoesNotExist
+    status, user_id, username = check_session_tokens([token])[token]
+    if status == INVALID:
+        raise SessionToken.DoesNotExist
+    if status == EXPIRED:
+        raise SessionExpired
+    return user_id, username
+
+
+def check_session_tokens(tokens):
+    """
+    Returns {token: (status, user_id, username)} for calc session tokens given
+    as strings, status being VALID, EXPIRED or INVALID. Signed tokens are
+    checked without touching the database as long as their users' session
+    generations are cached, database tokens are all loaded in one query.
+    """
+    results = {}
+    signed = {}
+    opaque = {}
+    now = time.time()
+    signer = signing.Signer(salt=SALT)
+    for token in set(tokens):
+        # Database tokens are URL-safe base64 and never contain the signature separator
+        if ':' not in token:
+            opaque[digest_secret(token)] = token
+            continue
+        try:
+            user_id, username, expires, generation = signer.unsign_object(token)
+        except (signing.BadSignature, ValueError, TypeError):
+            results[token] = (INVALID, None, None)
+            continue
+        if expires < now:
+            results[token] = (EXPIRED, user_id, username)
+        else:
+            signed[token] = (user_id, username, generation)
+
+    generations = get_session_generations({user_id for user_id, _, _ in signed.values()})
+    for token, (user_id, username, generation) in signed.items():
+        if user_id not in generations:
+            results[token] = (INVALID, None, None)
+        else:
+            results[token] = (VALID if generations[user_id] == generation else EXPIRED, user_id, username)
+
+    if opaque:
+        session_tokens = SessionToken.objects.select_related('user').filter(token_digest__in=opaque.keys()).only(
+            'user_id', 'token_digest', 'expiry_date', 'expired', 'user__username'
+        )
+        for session_token in session_tokens:
+            token = opaque.pop(bytes(session_token.token_digest))
+            status = VALID if session_token.is_valid() else EXPIRED
+            results[token] = (status, session_token.user_id, session_token.user.username)
+    for token in opaque.values():
+        results[token] = (INVALID, None, None)
+    return results
+
+
+def expire_all_sessions(user):
+    """
+    Revokes every calc session token of user with a single generation bump.
+    The new generation is cached once committed, so a concurrent lookup can
+    neither cache the old one over it nor see it before it is durable.
+    """
+    with transaction.atomic():
+        TINETUser.objects.filter(id=user.id).update(session_generation=F('session_generation') + 1)
+        # Database tokens, only found on the partial index of unexpired tokens
+        SessionToken.objects.filter(user=user, expired=False).update(expired=True)
+        generation = TINETUser.objects.filter(id=user.id).values_list('session_generation', flat=True).get()
+        transaction.on_commit(
+            lambda: cache.set(_generation_key(user.id), generation, timeout=GENERATION_TIMEOUT)
+        )
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+
+from tinetbackend.workers import PeriodicWorker
+from users.models import AllowedAppAuditEntry, AppAPIKey, SessionToken
+
+BATCH_SIZE = 5000
+
+_janitor = None
+
+
+def get_janitor():
+    global _janitor
+    if _janitor is None:
+        _janitor = PeriodicWorker('users-janitor', settings.USERS_JANITOR_INTERVAL, run_janitor)
+    return _janitor
+
+
+@receiver(setting_changed)
+def reset_janitor(setting, **kwargs):
+    global _janitor
+    if setting == 'USERS_JANITOR_INTERVAL':
+        _janitor = None
+
+
+def _delete_in_batches(queryset):
+    # Small id batches keep each statement and its row locks short, and leave
+    # autovacuum a steady trickle instead of one huge bloated delete.
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:BATCH_SIZE])
+        if not ids:
+            return deleted
+        queryset.model.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+
+
+def delete_expired_session_tokens():
+    return _delete_in_batches(SessionToken.objects.filter(Q(expired=True) | Q(expiry_date__lte=timezone.now())))
+
+
+def expire_lapsed_app_keys():
+    """Flags app keys unused for longer than their expiry as expired, returns how many."""
+    now = timezone.now()
+    lapsed = 0
+    live = AppAPIKey.objects.filter(expired=False).exclude(expires=-1)
+    for hours in live.values_list('expires', flat=True).distinct().order_by():
+        # update_expired_status() saves each key so its cached copy is dropped
+        for app_api_key in live.filter(expires=hours, last_used__lt=now - timezone.timedelta(hours=hours)):
+            app_api_key.update_expired_status()
+            lapsed += 1
+    return lapsed
+
+
+def delete_orphan_app_audit_entries():
+    return _delete_in_batches(AllowedAppAuditEntry.objects.filter(allowed_app__isnull=True))
+
+
+def run_janitor():
+    """Runs every cleanup job and returns {job: rows affected}."""
+    return {
+        'session_tokens': delete_expired_session_tokens(),
+        'app_keys': expire_lapsed_app_keys(),
+        'app_audit_entries': delete_orphan_app_audit_entries(),
+    }
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from users.audit_archive import archive_audit_entries
+
+
+class Command(BaseCommand):
+    help = 'Moves audit entries past AUDIT_RETENTION_DAYS out of the database into archive segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batches', type=int, default=None, help='Stop after this many batches per table')
+        parser.add_argument(
+            '--include-legacy', action='store_true',
+            help='Also archive entries written before created_at was recorded, whatever their age'
+        )
+
+    def handle(self, *args, **options):
+        moved = archive_audit_entries(
+            max_batches=options['batches'], include_legacy=options['include_legacy']
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {moved['user']} audit entries and {moved['app']} app audit entries"
+        ))
@@ -0,0 +1,30 @@
+import json
+from datetime import date
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+
+from users.audit_archive import TABLES, read_archived_entries
+
+
+class Command(BaseCommand):
+    help = 'Writes every audit entry of a user, archived ones first, to stdout as NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--since', type=date.fromisoformat, default=None, help='First day, YYYY-MM-DD')
+        parser.add_argument('--until', type=date.fromisoformat, default=None, help='Last day, YYYY-MM-DD')
+
+    def handle(self, *args, **options):
+        username, since, until = options['username'], options['since'], options['until']
+        for row in read_archived_entries(username, since, until):
+            self.stdout.write(json.dumps(row, cls=DjangoJSONEncoder))
+        for table, (model, fields) in TABLES.items():
+            # Entries without a created_at are the oldest, a day filter leaves them out
+            rows = model.objects.filter(username=username).order_by(F('created_at').asc(nulls_first=True), 'id')
+            if since:
+                rows = rows.filter(created_at__date__gte=since)
+            if until:
+                rows = rows.filter(created_at__date__lte=until)
+            for row in rows.values(*fields).iterator():
+                self.stdout.write(json.dumps({'table': table, **row}, cls=DjangoJSONEncoder))
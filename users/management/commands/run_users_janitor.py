@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from users.janitor import run_janitor
+
+
+class Command(BaseCommand):
+    help = 'Deletes expired session tokens and orphan app audit entries, and expires lapsed app keys'
+
+    def handle(self, *args, **options):
+        results = run_janitor()
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {results['session_tokens']} session tokens and {results['app_audit_entries']} "
+            f"app audit entries, expired {results['app_keys']} app keys"
+        ))
@@ -1,64 +1,56 @@
+from django.conf import settings
 from django.urls import reverse
 from django.shortcuts import redirect
-from users.models import UserWebPopUp, WebPopUp
+from users.popups import pending_popup_id, social_account_linked
 
 
 class PopupMiddleware:
-    EXCLUDED_ROUTES = {'privacy_policy', 'terms_of_service'}
+    """
+    Sends users with an unconfirmed popup to it before the view runs. The
+    check only reads the cached popup version and the session.
+    """
+    EXCLUDED_ROUTES = ('popup', 'logout', 'privacy_policy', 'terms_of_service')
+    BYPASSED_PREFIXES = ('/api/', settings.STATIC_URL, '/admin/', '/accounts/')
 
     def __init__(self, get_response):
         self.get_response = get_response
+        self.excluded_paths = None
 
     def __call__(self, request):
-        response = self.get_response(request)
-        if self.should_show_popup(request) and not self.is_excluded_route(request):
-            popup_url = reverse('popup')
-            if request.path != popup_url:
-                return redirect(popup_url)
-        return response
+        if self.should_show_popup(request):
+            return redirect('popup')
+        return self.get_response(request)
 
-    @staticmethod
-    def should_show_popup(request):
-        user = request.user
-        if user.is_authenticated:
-            user_popups = UserWebPopUp.objects.filter(user=user)
-            popup_exists = user_popups.filter(confirmed=True).exists()
-            if not popup_exists:
-                unconfirmed_popup = user_popups.filter(confirmed=False).exists()
-                if unconfirmed_popup:
-                    return True
-                else:
-                    web_popup = WebPopUp.objects.first()
-                    if web_popup:
-                        UserWebPopUp.objects.create(user=user, popup=web_popup)
-                        return True
-        return False
-
-    def is_excluded_route(self, request):
-        current_route_name = request.resolver_match.url_name
-        if current_route_name in self.EXCLUDED_ROUTES:
-            return True
-        return False
+    def should_show_popup(self, request):
+        if request.path.startswith(self.BYPASSED_PREFIXES):
+            return False
+        if self.excluded_paths is None:
+            self.excluded_paths = {reverse(route) for route in self.EXCLUDED_ROUTES}
+        if request.path in self.excluded_paths or not request.user.is_authenticated:
+            return False
+        return pending_popup_id(request) is not None
 
 
 class ForceLinkAccountToTKBStudiosAuthMiddleware:
+    """
+    Sends users without a linked social account to link one before the view
+    runs. Whether they have one is kept in the session, see
+    social_account_linked().
+    """
+    BYPASSED_PREFIXES = ('/api/', settings.STATIC_URL, '/admin/', '/accounts/')
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.link_account_url = None
 
     def __call__(self, request):
-        response = self.get_response(request)
-        link_account_url = reverse('link_account')
-        if self.should_show_popup(request, link_account_url):
-            return redirect(link_account_url)
-        return response
-
-    @staticmethod
-    def should_show_popup(request, link_account_url):
-        if request.user.is_authenticated:
-            if request.path != link_account_url:
-                if not request.path.startswith('/accounts'):
-                    if not request.path.startswith('/admin'):
-                        social_accounts = request.user.socialaccount_set.all()
-                        if not social_accounts:
-                            return True
-        return False
+        if self.link_account_url is None:
+            self.link_account_url = reverse('link_account')
+        if self.should_show_popup(request, self.link_account_url):
+            return redirect(self.link_account_url)
+        return self.get_response(request)
+
+    def should_show_popup(self, request, link_account_url):
+        if request.path == link_account_url or request.path.startswith(self.BYPASSED_PREFIXES):
+            return False
+        return request.user.is_authenticated and not social_account_linked(request)
@@ -0,0 +1,38 @@
+import users.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0029_delete_userdb'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='tinetuser',
+            managers=[
+                ('objects', users.models.TINETUserManager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='tinetuser',
+            name='api_key_digest',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='tinetuser',
+            name='api_key_prefix',
+            field=models.CharField(max_length=12, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='tinetuser',
+            name='calc_key_digest',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='tinetuser',
+            name='calc_key_prefix',
+            field=models.CharField(max_length=12, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+import hashlib
+from django.db import migrations
+
+PREFIX_LENGTH = 12
+
+
+def hash_credentials(apps, schema_editor):
+    """
+    Moves existing plaintext keys to prefix + digest. Keys keep working as they
+    are since the prefix is their leading characters; a key whose prefix is
+    already taken by another user is dropped and has to be regenerated.
+    """
+    TINETUser = apps.get_model('users', 'TINETUser')
+    for field in ('api_key', 'calc_key'):
+        taken = set()
+        users = TINETUser.objects.exclude(**{f'{field}__isnull': True}).exclude(**{field: ''}).only('id', field)
+        for user in users.iterator():
+            key = getattr(user, field)
+            prefix = key[:PREFIX_LENGTH]
+            if len(key) <= PREFIX_LENGTH or prefix in taken:
+                continue
+            taken.add(prefix)
+            TINETUser.objects.filter(id=user.id).update(**{
+                f'{field}_prefix': prefix,
+                f'{field}_digest': hashlib.sha256(key.encode()).hexdigest(),
+            })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0030_tinetuser_hashed_credentials'),
+    ]
+
+    operations = [
+        migrations.RunPython(hash_credentials, migrations.RunPython.noop),
+    ]
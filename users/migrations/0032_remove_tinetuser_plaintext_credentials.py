@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0031_hash_existing_credentials'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='tinetuser',
+            name='api_key',
+        ),
+        migrations.RemoveField(
+            model_name='tinetuser',
+            name='calc_key',
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0032_remove_tinetuser_plaintext_credentials'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sessiontoken',
+            name='token_digest',
+            field=models.BinaryField(max_length=32, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='appapikey',
+            name='key_digest',
+            field=models.BinaryField(max_length=32, null=True, unique=True),
+        ),
+    ]
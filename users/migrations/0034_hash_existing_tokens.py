@@ -0,0 +1,23 @@
+import hashlib
+from django.db import migrations
+
+
+def hash_tokens(apps, schema_editor):
+    """Replaces stored plaintext session tokens and app keys by their SHA-256 digest, they keep working."""
+    for model_name, field in (('SessionToken', 'token'), ('AppAPIKey', 'key')):
+        model = apps.get_model('users', model_name)
+        for obj_id, secret in model.objects.values_list('id', field).iterator():
+            model.objects.filter(id=obj_id).update(**{
+                f'{field}_digest': hashlib.sha256(secret.encode()).digest(),
+            })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0033_binary_token_digests'),
+    ]
+
+    operations = [
+        migrations.RunPython(hash_tokens, migrations.RunPython.noop),
+    ]
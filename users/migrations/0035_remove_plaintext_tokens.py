@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0034_hash_existing_tokens'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='sessiontoken',
+            name='token',
+        ),
+        migrations.RemoveField(
+            model_name='appapikey',
+            name='key',
+        ),
+        migrations.AlterField(
+            model_name='sessiontoken',
+            name='token_digest',
+            field=models.BinaryField(max_length=32, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='appapikey',
+            name='key_digest',
+            field=models.BinaryField(max_length=32, unique=True),
+        ),
+    ]
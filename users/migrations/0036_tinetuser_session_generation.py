@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 06:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0035_remove_plaintext_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tinetuser',
+            name='session_generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.3 on 2026-10-18 07:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0036_tinetuser_session_generation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='allowedappauditentry',
+            index=models.Index(condition=models.Q(('allowed_app__isnull', True)), fields=['id'], name='appaudit_orphan_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appapikey',
+            index=models.Index(condition=models.Q(('expired', False), models.Q(('expires', -1), _negated=True)), fields=['expires', 'last_used'], name='appapikey_expiring_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sessiontoken',
+            index=models.Index(fields=['expiry_date'], name='sessiontoken_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sessiontoken',
+            index=models.Index(condition=models.Q(('expired', False)), fields=['user'], name='sessiontoken_live_user_idx'),
+        ),
+    ]
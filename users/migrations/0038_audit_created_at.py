@@ -0,0 +1,36 @@
+# Generated by Django 5.0.3 on 2026-10-18 07:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0037_janitor_partial_indexes'),
+    ]
+
+    # Added without a default first so existing entries keep a null
+    # created_at instead of the time of the deploy.
+    operations = [
+        migrations.AddField(
+            model_name='allowedappauditentry',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='auditentry',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='allowedappauditentry',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AlterField(
+            model_name='auditentry',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.0.3 on 2026-10-18 07:25
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Built concurrently so the audit tables stay writable meanwhile
+    atomic = False
+
+    dependencies = [
+        ('users', '0038_audit_created_at'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='allowedappauditentry',
+            index=models.Index(models.F('username'), models.OrderBy(models.F('created_at'), descending=True, nulls_last=True), models.OrderBy(models.F('id'), descending=True), name='appaudit_user_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='auditentry',
+            index=models.Index(models.F('username'), models.OrderBy(models.F('created_at'), descending=True, nulls_last=True), models.OrderBy(models.F('id'), descending=True), name='audit_user_created_idx'),
+        ),
+    ]
@@ -1,76 +1,224 @@
-from django.db import models, connections
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, connections, transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
-import random
+import hashlib
+import hmac
+import secrets
 import string
+import threading
+import time
 from datetime import timedelta
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager
+
+# Leading characters of a user credential kept in clear as its lookup key
+CREDENTIAL_PREFIX_LENGTH = 12
+
+
+def credential_parts(key):
+    """Splits a user credential into its (lookup prefix, SHA-256 hex digest) as stored."""
+    return key[:CREDENTIAL_PREFIX_LENGTH], hashlib.sha256(key.encode()).hexdigest()
+
+
+class TINETUserManager(UserManager):
+    def get_by_api_key(self, api_key):
+        return self._get_by_credential('api_key', api_key)
+
+    def get_by_calc_key(self, calc_key):
+        return self._get_by_credential('calc_key', calc_key)
+
+    def _get_by_credential(self, field, key):
+        """Finds the user by the key's prefix on the unique index and checks the rest in constant time."""
+        if not isinstance(key, str) or len(key) <= CREDENTIAL_PREFIX_LENGTH:
+            raise self.model.DoesNotExist
+        prefix, digest = credential_parts(key)
+        user = self.get(**{f'{field}_prefix': prefix})
+        if not hmac.compare_digest(getattr(user, f'{field}_digest') or '', digest):
+            raise self.model.DoesNotExist
+        return user
 
 
 class TINETUser(AbstractUser):
     bio = models.CharField(max_length=300, default='This user doesnt have a bio yet.')
-    calc_key = models.CharField(max_length=120, null=True)
-    api_key = models.CharField(max_length=70, null=True)
+    calc_key_prefix = models.CharField(max_length=CREDENTIAL_PREFIX_LENGTH, null=True, unique=True)
+    calc_key_digest = models.CharField(max_length=64, null=True)
+    api_key_prefix = models.CharField(max_length=CREDENTIAL_PREFIX_LENGTH, null=True, unique=True)
+    api_key_digest = models.CharField(max_length=64, null=True)
+    # Bumped to revoke every signed calc session token issued before
+    session_generation = models.PositiveIntegerField(default=0)
+
+    objects = TINETUserManager()
+
+    def set_api_key(self):
+        """Generates a new API key, stores only its prefix and digest, and returns it."""
+        api_key = self._generate_credential(70)
+        self.api_key_prefix, self.api_key_digest = credential_parts(api_key)
+        return api_key
+
+    def set_calc_key(self):
+        """Generates a new calc key, stores only its prefix and digest, and returns it."""
+        calc_key = self._generate_credential(50)
+        self.calc_key_prefix, self.calc_key_digest = credential_parts(calc_key)
+        return calc_key
+
+    @staticmethod
+    def _generate_credential(length):
+        alphabet = string.ascii_letters + string.digits
+        return ''.join(secrets.choice(alphabet) for _ in range(length))
 
     def delete(self, *args, **kwargs):
         AppAPIKey.objects.filter(user=self).delete()
         SessionToken.objects.filter(user=self).delete()
         AuditEntry.objects.filter(username=self.username).delete()
+        # One indexed DELETE instead of the cascade from AllowedApp loading every row first
+        AllowedAppAuditEntry.objects.filter(username=self.username).delete()
         super().delete(*args, **kwargs)
 
 
+def generate_secret():
+    """Returns a new random token of 32 bytes, URL-safe base64 encoded."""
+    return secrets.token_urlsafe(32)
+
+
+def digest_secret(secret):
+    """Returns the 32-byte SHA-256 digest a token is stored and looked up by."""
+    return hashlib.sha256(secret.encode()).digest()
+
+
+class SessionTokenManager(models.Manager):
+    def get_by_token(self, token, **kwargs):
+        if not isinstance(token, str):
+            raise self.model.DoesNotExist
+        return self.get(token_digest=digest_secret(token), **kwargs)
+
+
 class SessionToken(models.Model):
     user = models.ForeignKey(TINETUser, on_delete=models.CASCADE, null=True)
-    token = models.CharField(max_length=256, unique=True)
+    token_digest = models.BinaryField(max_length=32, unique=True)
     expiry_date = models.DateTimeField()
     expired = models.BooleanField(default=False)
 
+    objects = SessionTokenManager()
+
     @classmethod
     def create_token(cls, user):
+        """Creates a session token and returns (session token, plaintext token), the only time the latter is known."""
         token = cls.generate_token()
         expiry_date = timezone.now() + timedelta(hours=12)
-        session_token = cls(user=user, token=token, expiry_date=expiry_date)
+        session_token = cls(user=user, token_digest=digest_secret(token), expiry_date=expiry_date)
         session_token.save()
-        return session_token
+        return session_token, token
 
     @staticmethod
     def generate_token():
-        new_session_token = ''.join(
-            random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits)
-            for _ in range(256)
-        )
-        return new_session_token
+        return generate_secret()
 
     def is_valid(self):
-        date_expired = self.expiry_date > timezone.now()
-        if not date_expired or not self.expired:
-            return True
-        else:
-            return False
+        return not self.expired and self.expiry_date > timezone.now()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expiry_date'], name='sessiontoken_expiry_idx'),
+            models.Index(fields=['user'], condition=models.Q(expired=False), name='sessiontoken_live_user_idx'),
+        ]
+
+
+class AppAPIKeyManager(models.Manager):
+    # Seconds a process trusts its own copy of a key before asking the shared
+    # cache again, which bounds how stale it is after a change elsewhere.
+    LOCAL_TIMEOUT = 5
+    # Stored in place of a deleted key, so a lookup racing the delete cannot cache it back
+    DELETED = 'deleted'
+
+    def __init__(self):
+        super().__init__()
+        self._local = {}
+        self._last_used_writes = {}
+        self._lock = threading.Lock()
+
+    def get_by_key(self, key):
+        """
+        Looks up a key by its digest, going through a process-local cache
+        and then the shared cache before the database.
+        """
+        if not isinstance(key, str):
+            raise self.model.DoesNotExist
+        key_digest = digest_secret(key)
+        digest = key_digest.hex()
+        with self._lock:
+            cached = self._local.get(digest)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        app_api_key = cache.get(self._cache_key(digest))
+        if app_api_key == self.DELETED:
+            raise self.model.DoesNotExist
+        if app_api_key is None:
+            app_api_key = self.get(key_digest=key_digest)
+            # Never overwrites the copy stored by a commit after this read
+            cache.add(self._cache_key(digest), app_api_key, timeout=settings.APP_API_KEY_CACHE_TIMEOUT)
+        with self._lock:
+            self._local[digest] = (time.monotonic() + self.LOCAL_TIMEOUT, app_api_key)
+        return app_api_key
+
+    def refresh(self, key_id, key_digest):
+        """
+        Caches the committed state of a changed or deleted key and forgets its
+        last_used throttle. Copies in other processes go within LOCAL_TIMEOUT.
+        """
+        digest = bytes(key_digest).hex()
+        with self._lock:
+            self._local.pop(digest, None)
+            self._last_used_writes.pop(key_id, None)
+        app_api_key = self.filter(id=key_id).first()
+        cache.set(
+            self._cache_key(digest), app_api_key or self.DELETED, timeout=settings.APP_API_KEY_CACHE_TIMEOUT
+        )
+        cache.delete(self._last_used_key(key_id))
+
+    def claim_last_used_write(self, key_id):
+        """Returns whether this caller should write last_used, at most once per key per interval."""
+        interval = settings.APP_API_KEY_LAST_USED_INTERVAL
+        now = time.monotonic()
+        with self._lock:
+            if self._last_used_writes.get(key_id, 0) > now:
+                return False
+            self._last_used_writes[key_id] = now + interval
+        return cache.add(self._last_used_key(key_id), True, timeout=interval)
+
+    @staticmethod
+    def _cache_key(digest):
+        return f'tinet:app-api-key:{digest}'
+
+    @staticmethod
+    def _last_used_key(key_id):
+        return f'tinet:app-api-key:{key_id}:last-used'
 
 
 class AppAPIKey(models.Model):
     user = models.ForeignKey(TINETUser, on_delete=models.CASCADE, null=True)
     name = models.CharField(max_length=20)
     description = models.CharField(max_length=100)
-    key = models.CharField(max_length=256, unique=True)
+    key_digest = models.BinaryField(max_length=32, unique=True)
     expires = models.IntegerField(default=-1)
     last_used = models.DateTimeField(default=timezone.now)
     expired = models.BooleanField(default=False)
 
+    objects = AppAPIKeyManager()
+
     @classmethod
     def create_api_key(cls, user, name, description):
+        """Creates an app key and returns (app key, plaintext key), the only time the latter is known."""
         key = cls.generate_key()
-        api_key = cls(user=user, name=name, description=description, key=key)
+        api_key = cls(user=user, name=name, description=description, key_digest=digest_secret(key))
         api_key.save()
-        return api_key
+        return api_key, key
 
     @staticmethod
     def generate_key():
-        new_api_key = ''.join(
-            random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits)
-            for _ in range(256)
-        )
-        return new_api_key
+        return generate_secret()
 
     def is_valid(self):
         if self.expires == -1 and not self.expired:
@@ -81,13 +229,71 @@ class AppAPIKey(models.Model):
 
     def mark_as_used(self):
         self.last_used = timezone.now()
-        self.save()
+        if AppAPIKey.objects.claim_last_used_write(self.id):
+            AppAPIKey.objects.filter(id=self.id).update(last_used=self.last_used)
 
     def update_expired_status(self):
         if not self.expired:
             self.expired = True
             self.save()
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['expires', 'last_used'],
+                condition=models.Q(expired=False) & ~models.Q(expires=-1),
+                name='appapikey_expiring_idx'
+            ),
+        ]
+
+
+@receiver(post_save, sender=AppAPIKey)
+@receiver(post_delete, sender=AppAPIKey)
+def invalidate_app_api_key(sender, instance, **kwargs):
+    # Deleting the key here, or on commit, would let a concurrent lookup cache the old row back
+    key_id, key_digest = instance.id, instance.key_digest
+    transaction.on_commit(lambda: AppAPIKey.objects.refresh(key_id, key_digest))
+
+
+class AllowedAppManager(models.Manager):
+
+    def grants(self, user_id):
+        """
+        Returns {app_id: allow_id} of every app the user granted, loaded with one
+        query and cached. Kept in the shared cache only, a copy per process would
+        keep a grant revoked in another worker usable.
+        """
+        grants = cache.get(self._cache_key(user_id))
+        if grants is None:
+            grants = self._load(user_id)
+            # Never overwrites the grants stored by a commit after this read
+            cache.add(self._cache_key(user_id), grants, timeout=settings.ALLOWED_APP_CACHE_TIMEOUT)
+        return grants
+
+    def get_grant(self, user_id, app_id):
+        """
+        Returns the user's grant for the app as an AllowedApp with only its keys
+        loaded, or None when there is none. No query when the grants are cached.
+        """
+        allow_id = self.grants(user_id).get(app_id)
+        if allow_id is None:
+            return None
+        allowed_app = self.model(allow_id=allow_id, user_id=user_id, app_id=app_id)
+        allowed_app._state.adding = False
+        allowed_app._state.db = self.db
+        return allowed_app
+
+    def refresh(self, user_id):
+        """Caches the committed grants of the user, replacing any copy loaded before the commit."""
+        cache.set(self._cache_key(user_id), self._load(user_id), timeout=settings.ALLOWED_APP_CACHE_TIMEOUT)
+
+    def _load(self, user_id):
+        return dict(self.filter(user_id=user_id).values_list('app_id', 'allow_id'))
+
+    @staticmethod
+    def _cache_key(user_id):
+        return f'tinet:user:{user_id}:grants'
+
 
 class AllowedApp(models.Model):
     allow_id = models.AutoField(primary_key=True)
@@ -95,21 +301,52 @@ class AllowedApp(models.Model):
     app = models.ForeignKey(AppAPIKey, on_delete=models.CASCADE, null=True)
     granted_date = models.DateTimeField(default=timezone.now)
 
+    objects = AllowedAppManager()
+
     class Meta:
         unique_together = ('user', 'app')
 
 
+@receiver(post_save, sender=AllowedApp)
+@receiver(post_delete, sender=AllowedApp)
+def invalidate_allowed_apps(sender, instance, **kwargs):
+    # Deleting the grants here, or on commit, would let a concurrent lookup cache the old ones back
+    user_id = instance.user_id
+    transaction.on_commit(lambda: AllowedApp.objects.refresh(user_id))
+
+
 class AllowedAppAuditEntry(models.Model):
     action = models.CharField(max_length=64)
     ip = models.GenericIPAddressField(null=True)
     username = models.CharField(max_length=256, null=True)
     allowed_app = models.ForeignKey(AllowedApp, on_delete=models.CASCADE, null=True)
+    # Null for entries written before it was recorded, those sort as the oldest
+    created_at = models.DateTimeField(null=True, default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(allowed_app__isnull=True), name='appaudit_orphan_idx'),
+            models.Index(
+                F('username'), F('created_at').desc(nulls_last=True), F('id').desc(),
+                name='appaudit_user_created_idx'
+            ),
+        ]
 
 
 class AuditEntry(models.Model):
     action = models.CharField(max_length=64)
     ip = models.GenericIPAddressField(null=True)
     username = models.CharField(max_length=256, null=True)
+    # Null for entries written before it was recorded, those sort as the oldest
+    created_at = models.DateTimeField(null=True, default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                F('username'), F('created_at').desc(nulls_last=True), F('id').desc(),
+                name='audit_user_created_idx'
+            ),
+        ]
 
     def __unicode__(self):
         return '{0} - {1} - {2}'.format(self.action, self.username, self.ip)
@@ -118,11 +355,39 @@ class AuditEntry(models.Model):
         return '{0} - {1} - {2}'.format(self.action, self.username, self.ip)
 
 
+class WebPopUpManager(models.Manager):
+    CACHE_KEY = 'tinet:webpopup:current'
+    CACHE_TIMEOUT = 3600
+
+    def current_id(self):
+        """
+        Returns the id of the newest popup, the one users are asked to confirm,
+        or 0 when there is none. It doubles as the popup version, since a newly
+        published popup always has a higher id.
+        """
+        popup_id = cache.get(self.CACHE_KEY)
+        if popup_id is None:
+            popup_id = self.order_by('-id').values_list('id', flat=True).first() or 0
+            cache.set(self.CACHE_KEY, popup_id, timeout=self.CACHE_TIMEOUT)
+        return popup_id
+
+    def invalidate(self):
+        cache.delete(self.CACHE_KEY)
+
+
 class WebPopUp(models.Model):
     title = models.TextField(null=True)
     description = models.TextField(null=True)
     users = models.ManyToManyField(TINETUser, through='UserWebPopUp', related_name='webpopups')
 
+    objects = WebPopUpManager()
+
+
+@receiver(post_save, sender=WebPopUp)
+@receiver(post_delete, sender=WebPopUp)
+def invalidate_current_popup(sender, **kwargs):
+    WebPopUp.objects.invalidate()
+
 
 class UserWebPopUp(models.Model):
     user = models.ForeignKey(TINETUser, on_delete=models.CASCADE)
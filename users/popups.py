@@ -0,0 +1,43 @@
+from users.models import UserWebPopUp, WebPopUp
+
+SESSION_KEY = 'web_popup'
+SOCIAL_ACCOUNT_SESSION_KEY = 'social_account_linked'
+
+
+def pending_popup_id(request):
+    """
+    Returns the id of the popup request.user still has to confirm, or None.
+    The answer is kept in the session per popup version, so the database is
+    asked at most once per session and popup.
+    """
+    popup_id = WebPopUp.objects.current_id()
+    if not popup_id:
+        return None
+    state = request.session.get(SESSION_KEY)
+    if state is None or state[0] != popup_id:
+        confirmed = UserWebPopUp.objects.filter(user=request.user, popup_id=popup_id, confirmed=True).exists()
+        state = [popup_id, confirmed]
+        request.session[SESSION_KEY] = state
+    return None if state[1] else popup_id
+
+
+def confirm_popup(request, popup_id):
+    UserWebPopUp.objects.update_or_create(user=request.user, popup_id=popup_id, defaults={'confirmed': True})
+    request.session[SESSION_KEY] = [popup_id, True]
+
+
+def social_account_linked(request):
+    """
+    Returns whether request.user has linked a social account. The answer is
+    kept in the session and updated by the allauth account added and removed
+    signals, so only the first request of a session queries it.
+    """
+    linked = request.session.get(SOCIAL_ACCOUNT_SESSION_KEY)
+    if linked is None:
+        linked = request.user.socialaccount_set.exists()
+        request.session[SOCIAL_ACCOUNT_SESSION_KEY] = linked
+    return linked
+
+
+def forget_social_account_link(request):
+    request.session.pop(SOCIAL_ACCOUNT_SESSION_KEY, None)
@@ -1,6 +1,8 @@
+from allauth.socialaccount.signals import social_account_added, social_account_removed
 from django.contrib.auth import user_logged_in, user_logged_out, user_login_failed
 from django.dispatch import receiver
-from users.models import AuditEntry
+from users.audit import record_audit_entry
+from users.popups import forget_social_account_link
 
 
 @receiver(user_logged_in)
@@ -10,7 +12,7 @@ def user_web_logged_in_callback(sender, request, user, **kwargs):
         ip = x_forwarded_for.split(',')[0]
     else:
         ip = request.META.get('REMOTE_ADDR')
-    AuditEntry.objects.create(action='logged in on web', ip=ip, username=user.username)
+    record_audit_entry('logged in on web', ip, user.username)
 
 
 @receiver(user_logged_out)
@@ -20,4 +22,10 @@ def user_web_logged_out_callback(sender, request, user, **kwargs):
         ip = x_forwarded_for.split(',')[0]
     else:
         ip = request.META.get('REMOTE_ADDR')
-    AuditEntry.objects.create(action='logged out on web', ip=ip, username=user.username)
+    record_audit_entry('logged out on web', ip, user.username)
+
+
+@receiver(social_account_added)
+@receiver(social_account_removed)
+def social_account_changed_callback(sender, request, **kwargs):
+    forget_social_account_link(request)
@@ -1,17 +1,40 @@
-from django.test import TestCase
+import json
+import shutil
+import tempfile
+from unittest import mock
+import fakeredis
+import jwt
+from allauth.socialaccount.models import SocialAccount
+from allauth.socialaccount.signals import social_account_added, social_account_removed
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.core.cache import cache
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import DatabaseError
+from django.test import RequestFactory, TestCase, override_settings
 from django.utils import timezone
-from .models import TINETUser, AppAPIKey, AllowedApp
+from .audit import MAX_FLUSH_ATTEMPTS, flush_audit_queue, get_audit_queue, record_app_audit_entry, record_audit_entry
+from .app_tokens import revoked_grants
+from .audit_archive import archive_audit_entries, read_archived_entries
+from .calc_sessions import expire_all_sessions
+from .popups import social_account_linked
+from .janitor import run_janitor
+from .models import (
+    TINETUser, AppAPIKey, AllowedApp, AllowedAppAuditEntry, AllowedAppManager, AuditEntry, SessionToken,
+    UserWebPopUp, WebPopUp, digest_secret
+)
 
 
 class AppAPIKeyModelTests(TestCase):
 
     def setUp(self):
+        cache.clear()
         self.user = TINETUser.objects.create(username='testuser', password='testpass')
         self.api_key = AppAPIKey.objects.create(
             user=self.user,
             name='Test API Key',
             description='A key for testing',
-            key='testkey123'
+            key_digest=digest_secret('testkey123')
         )
 
     def test_is_valid_with_expired_key(self):
@@ -36,6 +59,485 @@ class AppAPIKeyModelTests(TestCase):
         self.api_key.refresh_from_db()
         self.assertTrue(self.api_key.expired)
 
+    def test_mark_as_used_writes_once_per_interval(self):
+        self.api_key.mark_as_used()
+        with self.assertNumQueries(0):
+            self.api_key.mark_as_used()
+
+    def test_get_by_key_is_cached_until_changed(self):
+        self.assertEqual(AppAPIKey.objects.get_by_key('testkey123'), self.api_key)
+        with self.assertNumQueries(0):
+            self.assertEqual(AppAPIKey.objects.get_by_key('testkey123'), self.api_key)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.api_key.update_expired_status()
+        # The committed copy is stored rather than dropped
+        with self.assertNumQueries(0):
+            self.assertTrue(AppAPIKey.objects.get_by_key('testkey123').expired)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.api_key.delete()
+        with self.assertRaises(AppAPIKey.DoesNotExist):
+            AppAPIKey.objects.get_by_key('testkey123')
+
+    def test_lookup_racing_a_change_does_not_cache_the_old_key(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.api_key.update_expired_status()
+        # A lookup that read the row before the commit
+        AppAPIKey.objects.get_by_key('testkey123')
+        for callback in callbacks:
+            callback()
+        AppAPIKey.objects._local.clear()
+        self.assertTrue(AppAPIKey.objects.get_by_key('testkey123').expired)
+
+
+class TINETUserCredentialTests(TestCase):
+
+    def setUp(self):
+        self.user = TINETUser.objects.create(username='keyuser', password='testpass')
+        self.api_key = self.user.set_api_key()
+        self.calc_key = self.user.set_calc_key()
+        self.user.save()
+
+    def test_only_prefix_and_digest_are_stored(self):
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.api_key_prefix, self.api_key[:12])
+        self.assertNotIn(self.api_key, self.user.api_key_digest)
+
+    def test_lookup_by_key(self):
+        self.assertEqual(TINETUser.objects.get_by_api_key(self.api_key), self.user)
+        self.assertEqual(TINETUser.objects.get_by_calc_key(self.calc_key), self.user)
+
+    def test_lookup_rejects_wrong_secret(self):
+        with self.assertRaises(TINETUser.DoesNotExist):
+            TINETUser.objects.get_by_api_key(self.api_key[:-1] + ('a' if self.api_key[-1] != 'a' else 'b'))
+        with self.assertRaises(TINETUser.DoesNotExist):
+            TINETUser.objects.get_by_calc_key(self.calc_key[:12])
+
+
+class SessionTokenModelTests(TestCase):
+
+    def test_only_digest_of_token_is_stored(self):
+        user = TINETUser.objects.create(username='tokenuser', password='testpass')
+        session_token, token = SessionToken.create_token(user)
+        self.assertEqual(bytes(session_token.token_digest), digest_secret(token))
+        self.assertEqual(SessionToken.objects.get_by_token(token), session_token)
+        with self.assertRaises(SessionToken.DoesNotExist):
+            SessionToken.objects.get_by_token(token[:-1])
+
+
+@override_settings(AUDIT_LOG_FLUSH_INTERVAL=0)
+class CalcSessionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = TINETUser.objects.create(username='calcuser', password='testpass')
+        self.calc_key = self.user.set_calc_key()
+        self.user.save()
+
+    def login(self):
+        response = self.client.post(
+            '/api/v1/user/calc/auth',
+            json.dumps({'username': 'calcuser', 'calc_key': self.calc_key}),
+            content_type='application/json'
+        )
+        return response.json()['session_token']
+
+    def check(self, token, username='calcuser'):
+        return self.client.post(
+            '/api/v1/user/sessions/validity-check',
+            json.dumps({'username': username, 'session_token': token}),
+            content_type='application/json'
+        )
+
+    def test_signed_tokens_start_the_janitor(self):
+        with mock.patch('users.calc_sessions.get_janitor') as get_janitor:
+            self.login()
+        get_janitor.return_value.ensure_started.assert_called_once_with()
+
+    def test_signed_token_is_checked_without_queries(self):
+        token = self.login()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.check(token).status_code, 200)
+        self.assertEqual(self.check(token, username='someoneelse').status_code, 404)
+        self.assertEqual(self.check(token[:-2] + 'xx').status_code, 404)
+
+    def test_expire_all_revokes_signed_tokens(self):
+        token = self.login()
+        with self.captureOnCommitCallbacks() as callbacks:
+            expire_all_sessions(self.user)
+        # The new generation is cached only once it is committed
+        self.assertEqual(self.check(token).status_code, 200)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.check(token).status_code, 401)
+        self.assertEqual(self.check(self.login()).status_code, 200)
+
+    def test_batch_validity_check(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            app = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        AllowedApp.objects.create(user=self.user, app=app)
+        other = TINETUser.objects.create(username='other', password='testpass')
+        _, other_token = SessionToken.create_token(other)
+        sessions = [
+            {'username': 'calcuser', 'session_token': self.login()},
+            {'username': 'other', 'session_token': other_token},
+            {'username': 'nobody', 'session_token': 'garbage'},
+            {'username': 'calcuser', 'session_token': 'forged'},
+        ]
+        # The new app key is cached on commit, so its first last_used write,
+        # then one query for the database tokens and one for the grants
+        with self.assertNumQueries(3):
+            response = self.client.post(
+                '/api/v1/user/sessions/validity-check/batch',
+                json.dumps({'sessions': sessions}),
+                content_type='application/json',
+                HTTP_API_KEY='gamekey123'
+            )
+        self.assertEqual(
+            [(result['username'], result['status']) for result in response.json()['results']],
+            [('calcuser', 'valid'), ('other', 'not_granted'), ('nobody', 'invalid'), ('calcuser', 'invalid')]
+        )
+
+    def test_single_round_trip_app_login(self):
+        app = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+
+        def app_login():
+            return self.client.post(
+                '/api/v1/user/calc/login',
+                json.dumps({'username': 'calcuser', 'calc_key': self.calc_key}),
+                content_type='application/json',
+                HTTP_API_KEY='gamekey123'
+            )
+
+        response = app_login()
+        self.assertEqual(response.status_code, 403)
+        self.assertIn('grant_url', response.json())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            AllowedApp.objects.create(user=self.user, app=app)
+        response = app_login()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['username'], 'calcuser')
+        self.assertEqual(self.check(response.json()['session_token']).status_code, 200)
+
+    @override_settings(RATE_LIMITS={'calc_auth': {'ip': (1, 10), 'user': (0.01, 2)}})
+    def test_calc_auth_is_rate_limited_per_user(self):
+        def guess(**headers):
+            return self.client.post(
+                '/api/v1/user/calc/auth',
+                json.dumps({'username': 'calcuser', 'calc_key': 'wrong'}),
+                content_type='application/json',
+                **headers
+            )
+
+        # Only failed attempts count against the user
+        self.login()
+        self.login()
+        self.login()
+        self.assertEqual(guess().status_code, 500)
+        self.assertEqual(guess(HTTP_X_FORWARDED_FOR='10.0.0.2').status_code, 500)
+        with self.assertNumQueries(0):
+            response = guess(HTTP_X_FORWARDED_FOR='10.0.0.3')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '100')
+
+    @override_settings(RATE_LIMITS={'calc_auth': {'ip': (0.01, 1)}}, RATE_LIMIT_TRUSTED_PROXIES=1)
+    def test_calc_auth_ip_is_the_trusted_proxy_hop(self):
+        def login(forwarded_for):
+            return self.client.post(
+                '/api/v1/user/calc/auth',
+                json.dumps({'username': 'calcuser', 'calc_key': self.calc_key}),
+                content_type='application/json',
+                HTTP_X_FORWARDED_FOR=forwarded_for
+            )
+
+        self.assertEqual(login('10.0.0.1, 192.0.2.1').status_code, 200)
+        # Hops set by the client do not buy a new bucket
+        self.assertEqual(login('10.0.0.9, 192.0.2.1').status_code, 429)
+        self.assertEqual(login('192.0.2.2').status_code, 200)
+
+    @override_settings(CALC_SESSION_TOKENS='database', USERS_JANITOR_INTERVAL=0)
+    def test_database_tokens_are_still_accepted(self):
+        token = self.login()
+        self.assertTrue(SessionToken.objects.filter(user=self.user).exists())
+        self.assertEqual(self.check(token).status_code, 200)
+
+
+def generate_signing_key():
+    return ec.generate_private_key(ec.SECP256R1()).private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    ).decode()
+
+
+@override_settings(APP_TOKEN_SIGNING_KEYS=[generate_signing_key(), generate_signing_key()], AUDIT_LOG_FLUSH_INTERVAL=0)
+class AppAccessTokenTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = TINETUser.objects.create(username='player', password='testpass')
+        self.app = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        self.allowed_app = AllowedApp.objects.create(user=self.user, app=self.app)
+        _, self.session_token = SessionToken.create_token(self.user)
+
+    def request_token(self):
+        response = self.client.post(
+            '/api/v1/user/sessions/auth',
+            json.dumps({'session_token': self.session_token, 'issue_token': True}),
+            content_type='application/json',
+            HTTP_API_KEY='gamekey123'
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()['access_token']
+
+    def test_token_verifies_against_published_keys(self):
+        token = self.request_token()
+        key_set = jwt.PyJWKSet.from_dict(self.client.get('/api/v1/apps/jwks.json').json())
+        self.assertEqual(len(key_set.keys), 2)
+        signing_key = key_set[jwt.get_unverified_header(token)['kid']]
+        claims = jwt.decode(token, signing_key.key, algorithms=['ES256'], audience=str(self.app.id))
+        self.assertEqual(claims['username'], 'player')
+        self.assertEqual(claims['grant'], self.allowed_app.allow_id)
+
+        with self.assertRaises(jwt.InvalidAudienceError):
+            jwt.decode(token, signing_key.key, algorithms=['ES256'], audience='another-app')
+
+    def test_revoked_grants_are_listed(self):
+        self.request_token()
+        grant_id = self.allowed_app.allow_id
+        self.allowed_app.delete()
+        response = self.client.get('/api/v1/apps/revoked-grants', HTTP_API_KEY='gamekey123')
+        self.assertEqual(
+            [(entry['grant'], entry['sub']) for entry in response.json()['revoked']],
+            [(grant_id, str(self.user.id))]
+        )
+
+    def test_revoked_grants_are_kept_in_redis(self):
+        other_user = TINETUser.objects.create(username='other', password='testpass')
+        other_grant = AllowedApp.objects.create(user=other_user, app=self.app)
+        expected = [(self.allowed_app.allow_id, str(self.user.id)), (other_grant.allow_id, str(other_user.id))]
+        with mock.patch('users.app_tokens.get_redis', return_value=fakeredis.FakeRedis()):
+            self.allowed_app.delete()
+            other_grant.delete()
+            revoked = revoked_grants(self.app.id)
+        self.assertEqual(sorted((entry['grant'], entry['sub']) for entry in revoked), expected)
+
+
+class JanitorTests(TestCase):
+
+    def test_cleans_up_stale_rows(self):
+        cache.clear()
+        user = TINETUser.objects.create(username='janitoruser', password='testpass')
+        live, _ = SessionToken.create_token(user)
+        stale, _ = SessionToken.create_token(user)
+        SessionToken.objects.filter(id=stale.id).update(expiry_date=timezone.now() - timezone.timedelta(minutes=1))
+        lapsed = AppAPIKey.objects.create(
+            name='Old', description='Lapsed key', key_digest=digest_secret('oldkey'), expires=1,
+            last_used=timezone.now() - timezone.timedelta(hours=2)
+        )
+        fresh = AppAPIKey.objects.create(name='New', description='Fresh key', key_digest=digest_secret('newkey'), expires=1)
+        AppAPIKey.objects.get_by_key('oldkey')
+        AllowedAppAuditEntry.objects.create(action='test', username='janitoruser')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(run_janitor(), {'session_tokens': 1, 'app_keys': 1, 'app_audit_entries': 1})
+        self.assertEqual(list(SessionToken.objects.all()), [live])
+        self.assertTrue(AppAPIKey.objects.get_by_key('oldkey').expired)
+        fresh.refresh_from_db()
+        self.assertFalse(fresh.expired)
+        self.assertFalse(AllowedAppAuditEntry.objects.exists())
+
+
+@override_settings(AUDIT_LOG_QUEUE='users.audit.LocalAuditQueue', AUDIT_LOG_FLUSH_SIZE=100)
+class AuditQueueTests(TestCase):
+
+    def setUp(self):
+        user = TINETUser.objects.create(username='audituser', password='testpass')
+        game = AppAPIKey.objects.create(name='Game', description='A game', key_digest=digest_secret('gamekey123'))
+        old_game = AppAPIKey.objects.create(name='Old game', description='Revoked', key_digest=digest_secret('oldkey'))
+        self.live_grant = AllowedApp.objects.create(user=user, app=game)
+        self.revoked_grant = AllowedApp.objects.create(user=user, app=old_game)
+
+    @override_settings(AUDIT_LOG_FLUSH_INTERVAL=3600)
+    def test_entries_are_written_in_one_batch(self):
+        with self.assertNumQueries(0):
+            record_audit_entry('requested a new session token', '10.0.0.1', 'audituser')
+            record_audit_entry('logged in on web', 'not an ip', 'audituser')
+            record_app_audit_entry('Authenticated using calc key', '10.0.0.1', 'audituser', self.live_grant.allow_id)
+            record_app_audit_entry('Authenticated using calc key', '10.0.0.1', 'audituser', self.revoked_grant.allow_id)
+        self.assertEqual(get_audit_queue().depth(), 4)
+        self.revoked_grant.delete()
+
+        self.assertEqual(flush_audit_queue(), 4)
+        self.assertEqual(get_audit_queue().depth(), 0)
+        self.assertEqual(list(AuditEntry.objects.values_list('ip', flat=True)), ['10.0.0.1', None])
+        self.assertEqual(
+            list(AllowedAppAuditEntry.objects.values_list('allowed_app_id', flat=True)),
+            [self.live_grant.allow_id]
+        )
+
+    @override_settings(AUDIT_LOG_FLUSH_INTERVAL=3600)
+    def test_failing_batch_is_dead_lettered(self):
+        record_audit_entry('logged in on web', '10.0.0.1', 'audituser')
+        with mock.patch('users.audit.write_audit_entries', side_effect=DatabaseError):
+            for _ in range(MAX_FLUSH_ATTEMPTS - 1):
+                with self.assertRaises(DatabaseError):
+                    flush_audit_queue()
+            self.assertEqual(get_audit_queue().depth(), 1)
+            with self.assertLogs('users.audit', 'ERROR') as logs:
+                self.assertEqual(flush_audit_queue(), 0)
+        self.assertEqual(get_audit_queue().depth(), 0)
+        self.assertIn('"action": "logged in on web"', logs.output[-1])
+
+        record_audit_entry('logged out on web', '10.0.0.1', 'audituser')
+        self.assertEqual(flush_audit_queue(), 1)
+
+    @override_settings(AUDIT_LOG_FLUSH_INTERVAL=0)
+    def test_synchronous_mode_writes_immediately(self):
+        record_audit_entry('logged in on web', '10.0.0.1', 'audituser')
+        self.assertEqual(get_audit_queue().depth(), 0)
+        self.assertTrue(AuditEntry.objects.filter(username='audituser').exists())
+
+
+class AuditHistoryTests(TestCase):
+
+    def setUp(self):
+        self.user = TINETUser.objects.create(username='historyuser', password='testpass')
+        self.api_key = self.user.set_api_key()
+        self.user.save()
+        now = timezone.now()
+        AuditEntry.objects.bulk_create(
+            [AuditEntry(action=f'event {i}', username='historyuser', created_at=now + timezone.timedelta(seconds=i // 2))
+             for i in range(5)] + [AuditEntry(action='not mine', username='someoneelse', created_at=now)]
+        )
+
+    def test_feed_is_keyset_paginated(self):
+        actions = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get(f'/api/v1/user/audit?limit=2&cursor={cursor}', HTTP_API_KEY=self.api_key)
+            self.assertEqual(response.status_code, 200)
+            actions += [event['action'] for event in response.json()['events']]
+            cursor = response.json()['next_cursor']
+        self.assertEqual(actions, [f'event {i}' for i in reversed(range(5))])
+
+        response = self.client.get('/api/v1/user/audit?cursor=garbage', HTTP_API_KEY=self.api_key)
+        self.assertEqual(response.status_code, 400)
+
+    def test_entries_without_created_at_come_last(self):
+        AuditEntry.objects.bulk_create([AuditEntry(action=f'legacy {i}', username='historyuser') for i in range(2)])
+        AuditEntry.objects.filter(action__startswith='legacy').update(created_at=None)
+        actions = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get(f'/api/v1/user/audit?limit=2&cursor={cursor}', HTTP_API_KEY=self.api_key)
+            actions += [event['action'] for event in response.json()['events']]
+            cursor = response.json()['next_cursor']
+        self.assertEqual(actions, [f'event {i}' for i in reversed(range(5))] + ['legacy 1', 'legacy 0'])
+
+
+class AuditArchiveTests(TestCase):
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+        cache.clear()
+
+    def test_old_entries_are_archived_and_readable(self):
+        now = timezone.now()
+        AuditEntry.objects.bulk_create([
+            AuditEntry(action='old', ip='10.0.0.1', username='archived', created_at=now - timezone.timedelta(days=100)),
+            AuditEntry(action='older', ip='10.0.0.2', username='archived', created_at=now - timezone.timedelta(days=120)),
+            AuditEntry(action='old', ip='10.0.0.3', username='neighbour', created_at=now - timezone.timedelta(days=100)),
+            AuditEntry(action='recent', ip='10.0.0.4', username='archived', created_at=now),
+            AuditEntry(action='legacy', ip='10.0.0.5', username='archived'),
+        ])
+        AuditEntry.objects.filter(action='legacy').update(created_at=None)
+        with self.settings(AUDIT_ARCHIVE_DIR=self.archive_dir, AUDIT_RETENTION_DAYS=90):
+            self.assertEqual(archive_audit_entries(), {'user': 3, 'app': 0})
+            self.assertEqual(sorted(AuditEntry.objects.values_list('action', flat=True)), ['legacy', 'recent'])
+            self.assertEqual(archive_audit_entries(include_legacy=True), {'user': 1, 'app': 0})
+            self.assertEqual(list(AuditEntry.objects.values_list('action', flat=True)), ['recent'])
+
+            archived = list(read_archived_entries('archived'))
+            self.assertEqual(
+                [(row['action'], row['ip']) for row in archived],
+                [('legacy', '10.0.0.5'), ('older', '10.0.0.2'), ('old', '10.0.0.1')]
+            )
+            recent_only = read_archived_entries('archived', since=(now - timezone.timedelta(days=110)).date())
+            self.assertEqual([row['action'] for row in recent_only], ['old'])
+
+    def test_manifest_survives_a_failed_rewrite(self):
+        created_at = timezone.now() - timezone.timedelta(days=100)
+        AuditEntry.objects.create(action='first', ip='10.0.0.1', username='archived', created_at=created_at)
+        with self.settings(AUDIT_ARCHIVE_DIR=self.archive_dir, AUDIT_RETENTION_DAYS=90):
+            archive_audit_entries()
+            AuditEntry.objects.create(action='second', ip='10.0.0.1', username='archived', created_at=created_at)
+            with mock.patch('users.audit_archive.os.replace', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    archive_audit_entries()
+            self.assertEqual([row['action'] for row in read_archived_entries('archived')], ['first'])
+
+            self.assertEqual(archive_audit_entries(), {'user': 1, 'app': 0})
+            self.assertEqual([row['action'] for row in read_archived_entries('archived')], ['first', 'second'])
+
+
+@override_settings(AUDIT_LOG_FLUSH_INTERVAL=0)
+class PopupMiddlewareTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = TINETUser.objects.create_user(username='popupuser', password='testpass')
+        SocialAccount.objects.create(user=self.user, provider='tkbstudios', uid='popupuser')
+        self.client.force_login(self.user)
+        WebPopUp.objects.create(title='Terms', description='New terms')
+
+    def test_popup_is_shown_until_confirmed(self):
+        self.assertRedirects(self.client.get('/dashboard/'), '/popup/', fetch_redirect_response=False)
+        # Session and user only, the popup state is in the session now
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get('/dashboard/').status_code, 302)
+
+        self.client.post('/popup/')
+        self.assertTrue(UserWebPopUp.objects.filter(user=self.user, confirmed=True).exists())
+        self.assertEqual(self.client.get('/dashboard/').status_code, 200)
+
+        WebPopUp.objects.create(title='Privacy', description='New privacy policy')
+        self.assertRedirects(self.client.get('/dashboard/'), '/popup/', fetch_redirect_response=False)
+
+    def test_api_routes_bypass_popup(self):
+        self.assertEqual(self.client.get('/api/v1/user/info').status_code, 200)
+
+
+class SocialAccountLinkTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = TINETUser.objects.create_user(username='unlinked', password='testpass')
+
+    def test_unlinked_users_are_sent_to_link_account(self):
+        self.client.force_login(self.user)
+        self.assertRedirects(self.client.get('/dashboard/'), '/account/link-account/', fetch_redirect_response=False)
+        self.assertEqual(self.client.get('/api/v1/user/info').status_code, 200)
+
+    def test_link_state_is_kept_in_session_until_changed(self):
+        request = RequestFactory().get('/dashboard/')
+        request.user = self.user
+        request.session = SessionStore()
+        self.assertFalse(social_account_linked(request))
+
+        social_account = SocialAccount.objects.create(user=self.user, provider='tkbstudios', uid='unlinked')
+        social_account_added.send(sender=SocialAccount, request=request, sociallogin=None)
+        self.assertTrue(social_account_linked(request))
+        with self.assertNumQueries(0):
+            self.assertTrue(social_account_linked(request))
+
+        social_account.delete()
+        social_account_removed.send(sender=SocialAccount, request=request, socialaccount=social_account)
+        self.assertFalse(social_account_linked(request))
+
 
 class AllowedAppModelTests(TestCase):
 
@@ -45,10 +547,38 @@ class AllowedAppModelTests(TestCase):
             user=self.user,
             name='Test API Key 2',
             description='A second key for testing',
-            key='testkey456'
+            key_digest=digest_secret('testkey456')
         )
         self.allowed_app = AllowedApp.objects.create(user=self.user, app=self.api_key)
 
     def test_allowed_app_creation(self):
         self.assertEqual(self.allowed_app.user, self.user)
-        self.assertEqual(self.allowed_app.app, self.api_key)
\ No newline at end of file
+        self.assertEqual(self.allowed_app.app, self.api_key)
+
+    def test_grant_check_is_cached_until_revoked(self):
+        cache.clear()
+        self.assertEqual(AllowedApp.objects.get_grant(self.user.id, self.api_key.id), self.allowed_app)
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(AllowedApp.objects.get_grant(self.user.id, self.api_key.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.allowed_app.delete()
+        self.assertIsNone(AllowedApp.objects.get_grant(self.user.id, self.api_key.id))
+
+    def test_lookup_racing_a_revoke_does_not_cache_the_grant(self):
+        cache.clear()
+        load = AllowedAppManager._load
+        loaded = []
+
+        def load_then_revoke(manager, user_id):
+            grants = load(manager, user_id)
+            if not loaded:
+                # The revoke commits between the lookup's query and its cache write
+                loaded.append(grants)
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.allowed_app.delete()
+            return grants
+
+        with mock.patch.object(AllowedAppManager, '_load', load_then_revoke):
+            self.assertIsNotNone(AllowedApp.objects.get_grant(self.user.id, self.api_key.id))
+        self.assertIsNone(AllowedApp.objects.get_grant(self.user.id, self.api_key.id))